@@ -1,76 +1,266 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response, g
 from flask_cors import CORS
-from pdfextract import BatchExtractor, highlightPDF, highlightPDFImage, upload_folder_to_s3
+from pdfextract import BatchExtractor, highlightPDF, highlightPDFImage, upload_folder_to_s3, model_registry
 import asyncio
 import os
 import shutil
 import uuid
-import pubchempy as pcp
+import pubchem
 import json
-import boto3
+import time
+import gc
+import threading
+import traceback
+import metrics
+from jobs import Job, JobQueue
+from scheduling import scheduler
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 
-@app.route('/extract', methods=['POST', 'GET'])
-def extract_data():
+bucket_name = 'chemextract'
+
+# Models are loaded in the background so the server accepts connections at once; /ready
+# reports 503 until they are all in memory. Under gunicorn (see gunicorn.conf.py) each
+# worker does this after it is forked. CHEMEXTRACT_PRELOAD names models to load before
+# that, at import, e.g. once in the gunicorn master to share them copy-on-write; it is off
+# by default because torch is not guaranteed to work in a process forked after loading.
+warm_errors = {}
+_warming = None
+# Thread pools are sized to one extraction's share of the cores before any library starts them
+scheduler.configure()
+metrics.watch_scheduler(scheduler)
+
+
+def warm_models(names=None):
+    for name in names or model_registry.loaders:
+        try:
+            model_registry.get(name)
+            warm_errors.pop(name, None)
+        except Exception as e:
+            traceback.print_exc()
+            warm_errors[name] = str(e)
+    for name, stats in model_registry.stats().items():
+        print(f"{name}: loaded in {stats['load_seconds']:.1f}s, rss +{stats['rss_delta_bytes'] / 2**20:.0f} MiB")
+
+
+def start_warming():
+    # Loads whatever CHEMEXTRACT_PRELOAD left out; call once in every process that serves requests
+    global _warming
+    if _warming is None or not _warming.is_alive():
+        _warming = threading.Thread(target=warm_models, name='model-warmup', daemon=True)
+        _warming.start()
+    return _warming
+
+
+preload = [name for name in os.environ.get('CHEMEXTRACT_PRELOAD', '').split(',') if name]
+if preload:
+    warm_models(preload)
+    # Keep the collector from writing to every preloaded object, which would copy the pages
+    # the workers share
+    gc.freeze()
+if os.environ.get('CHEMEXTRACT_FORKING') != '1':
+    start_warming()
+
+# Extractions run on these worker threads; each job works in its own temp_files_<job id> folder.
+# By default there is one per scheduler slot, so every job that starts gets its cores at once.
+jobs = JobQueue(workers=int(os.environ.get('CHEMEXTRACT_JOB_WORKERS', 0)) or scheduler.slots)
+metrics.watch_jobs(jobs)
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Labelled by route pattern rather than path so job ids do not create new series
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.http_request_seconds.labels(route, request.method, str(response.status_code)).observe(time.perf_counter() - g.request_start)
+    return response
+
+
+@app.route('/ready')
+def ready():
+    models = {}
+    for name in model_registry.loaders:
+        if model_registry.is_loaded(name):
+            models[name] = 'loaded'
+        elif name in warm_errors:
+            models[name] = 'error: ' + warm_errors[name]
+        else:
+            models[name] = 'loading'
+    loaded = all(status == 'loaded' for status in models.values())
+    return jsonify({'ready': loaded, 'models': models, 'stats': model_registry.stats()}), 200 if loaded else 503
+
+
+@app.route('/scheduler')
+def scheduler_state():
+    # Cores per extraction, which jobs hold them and which are waiting
+    return jsonify(scheduler.snapshot()), 200
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+def job_folder(job_id):
+    return 'temp_files_' + job_id
+
+
+def valid_job_id(job_id):
+    try:
+        return str(uuid.UUID(job_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def current_job_id():
+    # The job id comes from ?job=, a "job" field in the JSON body or the cookie set when the
+    # job was submitted; None if there is none or it is not a job id
+    return valid_job_id(request.args.get('job') or (request.get_json(silent=True) or {}).get('job') or request.cookies.get('job'))
+
+
+def find_job(job_id):
+    # Jobs run in the process that accepted them, and gunicorn runs several; any other
+    # process reads the state the job saves in its folder
+    job_id = valid_job_id(job_id)
+    if job_id is None:
+        return None
+    return jobs.get(job_id) or Job.load(job_state_path(job_id))
+
+
+def job_state_path(job_id):
+    return os.path.join(job_folder(job_id), 'job.json')
+
+
+def save_files(files):
+    job_id = str(uuid.uuid4())
+    job = Job(job_id, job_state_path(job_id))
+    user_folder = job_folder(job.id)
+    if not os.path.exists(user_folder):
+        os.makedirs(user_folder)
+
+    for idx, file in enumerate(files):
+        file.save(os.path.join(user_folder, f'file_{idx}.pdf'))
+    return job
+
+
+def profile_requested():
+    # ?profile=1 or a "profile" form field; CHEMEXTRACT_PROFILE=1 profiles every job
+    return request.values.get('profile') in ('1', 'true') or None
+
+
+def extraction_options():
+    # How one job's files are processed: CHEMEXTRACT_PIPELINED=1 overlaps the stages of all
+    # its files, CHEMEXTRACT_PROCESSES=N spreads them over N worker processes (taking
+    # precedence), each needing CHEMEXTRACT_WORKER_MEMORY_BYTES of available memory
+    options = {
+        'pipelined': os.environ.get('CHEMEXTRACT_PIPELINED') == '1',
+        'processes': int(os.environ.get('CHEMEXTRACT_PROCESSES', 0)),
+    }
+    if os.environ.get('CHEMEXTRACT_WORKER_MEMORY_BYTES'):
+        options['worker_memory'] = int(os.environ['CHEMEXTRACT_WORKER_MEMORY_BYTES'])
+    return options
+
+
+def run_extraction(job, profile=None):
+    user_folder = job_folder(job.id)
     try:
-        # Generate a unique folder name for each user
-        global user_folder
-        global bucket_name
-
-
-        user_folder = 'temp_files_' + str(uuid.uuid4())
-        bucket_name = 'chemextract'
-        
-
-        files = request.files.getlist('files')
-        os.environ["TOKENIZERS_PARALLELISM"] = "false"
-        
-        # Save the files to the user's folder
-        if not os.path.exists(user_folder):
-            os.makedirs(user_folder)
-        
-        file_paths = []
-        for idx, file in enumerate(files):
-            file_path = os.path.join(user_folder, f'file_{idx}.pdf')
-            file.save(file_path)
-            file_paths.append(file_path)
-
-        # Initialize BatchExtractor
-        extractor = BatchExtractor(user_folder, user_folder)
-
-        # Extract SMILES data
-        smiles_data = asyncio.run(extractor.combine())
+        with scheduler.allocate(job.id) as cores:
+            extractor = BatchExtractor(user_folder, user_folder, progress=job, profile=profile, cores=cores, **extraction_options())
+
+            # Extract SMILES data
+            smiles_data = asyncio.run(extractor.combine())
 
         # Save the SMILES data to a file
         with open(os.path.join(user_folder, 'smiles_data.json'), 'w') as json_file:
             json.dump(smiles_data, json_file)
-        
-        # Upload the user's folder to S3
 
+        # Upload the user's folder to S3
         upload_folder_to_s3(user_folder, bucket_name)
-        return jsonify({
-            'message': 'Success',
-            'data': smiles_data,
-            'folder': user_folder
-        }), 200
+        return smiles_data
+    except Exception:
+        # Everything but job.json goes: the job queue saves the error there next, and any
+        # worker reads it from there
+        for name in os.listdir(user_folder):
+            path = os.path.join(user_folder, name)
+            if path == job_state_path(job.id):
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        raise
+
+
+def with_job_cookie(response, job):
+    response = jsonify(response)
+    response.set_cookie('job', job.id, samesite='Lax')
+    return response
+
+
+@app.route('/extract', methods=['POST', 'GET'])
+def extract_data():
+    # Synchronous form of /jobs: runs the extraction as a job and waits for it
+    job = save_files(request.files.getlist('files'))
+    jobs.submit(job, run_extraction, profile_requested())
+    job.wait()
+
+    if job.status == 'error':
+        return with_job_cookie({
+            'message': f'Error: {job.error}'
+
+        }, job), 500
+    return with_job_cookie({
+        'message': 'Success',
+        'data': job.result,
+        'folder': job_folder(job.id),
+        'job': job.id
+    }, job), 200
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    job = save_files(request.files.getlist('files'))
+    jobs.submit(job, run_extraction, profile_requested())
+    return with_job_cookie({
+        'job': job.id,
+        'folder': job_folder(job.id),
+        'status': job.status
+    }, job), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # Per-stage, per-file progress; ?partial=1 adds the results of files that are already done
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    state = job.to_dict(partial=request.args.get('partial') in ('1', 'true'))
+    allocation = scheduler.allocation(job.id)
+    if allocation is not None:
+        state['cores'] = allocation
+    if job.status == 'done':
+        state['data'] = job.result
+        state['folder'] = job_folder(job.id)
+    return jsonify(state), 200
 
-    except Exception as e:
-        shutil.rmtree(user_folder)
-        return jsonify({
-            'message': f'Error: {str(e)}'
 
-        }), 500
-    
 @app.route('/load_smiles_data')
 def get_smiles_data():
     try:
-        # Retrieve the user's folder based on request parameters or session data
-         # Adjust this according to your authentication/session mechanism
+        job_id = current_job_id()
+        if job_id is None:
+            return jsonify({'error': 'No job id given'}), 400
+        user_folder = job_folder(job_id)
         with open(os.path.join(user_folder, 'smiles_data.json'), 'r') as json_file:
             smiles_data = json.load(json_file)
-        upload_folder_to_s3(user_folder, bucket_name)
+        upload_folder_to_s3(user_folder, bucket_name, background=True)
 
         return jsonify(smiles_data), 200
     
@@ -85,52 +275,68 @@ def get_smiles_data():
 
 @app.route('/get_pubchempy_data', methods=['POST'])
 def get_pubchempy_data():
+    job_id = current_job_id()
+    if job_id is None:
+        return jsonify({'error': 'No job id given'}), 400
+    if not os.path.isdir(job_folder(job_id)):
+        return jsonify({'error': 'Job not found'}), 404
+    user_folder = job_folder(job_id)
     filename = os.path.join(user_folder, 'pubchempy_data.json')
     chemical_data = request.get_json()
     if "image" in chemical_data:
-        highlightPDFImage(user_folder, chemical_data.get("X", ''), chemical_data.get("Y", ''), chemical_data.get("Height", ""), chemical_data.get("Width", ""), chemical_data.get("page", ""))
+        highlights = highlightPDFImage(user_folder, chemical_data.get("X", ''), chemical_data.get("Y", ''), chemical_data.get("Height", ""), chemical_data.get("Width", ""), chemical_data.get("page", ""), chemical_data.get("origin"))
     else:
-        highlightPDF(user_folder, chemical_data.get("keyword", "") )
+        highlights = highlightPDF(user_folder, chemical_data.get("keyword", ""), chemical_data.get("origin"))
     
     print(chemical_data)
     if 'cid' not in chemical_data:
         return jsonify({'error': 'CID not provided'}), 400
 
     cid = chemical_data['cid']
-    compound = pcp.Compound.from_cid(cid)
+    try:
+        compound = pubchem.get_properties(cid)
+    except ValueError:
+        return jsonify({'error': f'Invalid CID {cid!r}'}), 400
+    except pubchem.PubChemError as e:
+        print(e)
+        return jsonify({'error': 'PubChem could not be reached'}), 502
+    if compound is None:
+        return jsonify({'error': f'CID {cid} not found in PubChem'}), 404
 
     if 'image' in chemical_data:
         properties = {
             "keyword": chemical_data.get("keyword", ""),
             "CID": cid,
-            "Compound Name": compound.iupac_name,
-            "Molecular Formula": compound.molecular_formula,
-            "Molecular Weight": compound.molecular_weight,
-            "Canonical SMILES": compound.canonical_smiles,
-            "Isomeric SMILES": compound.isomeric_smiles,
-            "XLogP": compound.xlogp,
-            "Exact Mass": compound.exact_mass,
-            "Charge": compound.charge,
-            "Complexity": compound.complexity,
+            "Compound Name": compound['iupac_name'],
+            "Molecular Formula": compound['molecular_formula'],
+            "Molecular Weight": compound['molecular_weight'],
+            "Canonical SMILES": compound['canonical_smiles'],
+            "Isomeric SMILES": compound['isomeric_smiles'],
+            "XLogP": compound['xlogp'],
+            "Exact Mass": compound['exact_mass'],
+            "Charge": compound['charge'],
+            "Complexity": compound['complexity'],
             "Image": chemical_data["image"],
             "page": chemical_data["page"],
 
-            "origin": chemical_data["origin"]
+            "origin": chemical_data["origin"],
+            "highlights": highlights
         }
     else:
         properties = {
             "keyword": chemical_data.get("keyword", ""),
             "CID": cid,
-            "Compound Name": compound.iupac_name,
-            "Molecular Formula": compound.molecular_formula,
-            "Molecular Weight": compound.molecular_weight,
-            "Canonical SMILES": compound.canonical_smiles,
-            "Isomeric SMILES": compound.isomeric_smiles,
-            "XLogP": compound.xlogp,
-            "Exact Mass": compound.exact_mass,
-            "Charge": compound.charge,
-            "Complexity": compound.complexity,
-            "origin": chemical_data["origin"]
+            "Compound Name": compound['iupac_name'],
+            "Molecular Formula": compound['molecular_formula'],
+            "Molecular Weight": compound['molecular_weight'],
+            "Canonical SMILES": compound['canonical_smiles'],
+            "Isomeric SMILES": compound['isomeric_smiles'],
+            "XLogP": compound['xlogp'],
+            "Exact Mass": compound['exact_mass'],
+            "Charge": compound['charge'],
+            "Complexity": compound['complexity'],
+            "origin": chemical_data["origin"],
+            "highlights": highlights
         }
 
     with open(filename, 'w') as json_file:
@@ -145,11 +351,15 @@ def get_pubchempy_data():
 @app.route('/load_pubchempy_data', methods=['GET'])
 def load_pubchempy_data():
     try:
+        job_id = current_job_id()
+        if job_id is None:
+            return jsonify({'error': 'No job id given'}), 400
+        user_folder = job_folder(job_id)
         filename = os.path.join(user_folder, 'pubchempy_data.json')
         with open(filename, 'r') as json_file:
             data = json.load(json_file)
 
-        upload_folder_to_s3(user_folder, bucket_name)
+        upload_folder_to_s3(user_folder, bucket_name, background=True)
         return jsonify(data), 200
     except FileNotFoundError:
         return jsonify({'error': 'PubChemPy data not found'}), 404
@@ -166,4 +376,5 @@ def load_pubchempy_data():
 
 
 if __name__ == '__main__':
+    pubchem.seed_from_environment()
     app.run(debug=True)
@@ -0,0 +1,172 @@
+import os
+import json
+import shutil
+import hashlib
+import time
+import threading
+import uuid
+from collections import defaultdict
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ExtractionCache:
+    # Content-addressed store for per-page extraction results. An entry is identified by
+    # the SHA-256 of the PDF bytes, the stage name and a version string covering the model,
+    # checkpoint and settings that produced it, so results are shared across requests and
+    # invalidated when a model changes. Each entry is a directory holding data.json plus any
+    # extra files (e.g. segment crops); whole entries are evicted least recently used first
+    # once the store grows past max_bytes. The directory is the only index: several
+    # processes (gunicorn workers, the process pool) share one root, so nothing about the
+    # entries is kept in memory but a running estimate of the total size. The mtime of
+    # data.json is the last access; each entry's size is written beside it in a size file.
+    def __init__(self, root: str, max_bytes: int = 2 * 1024 ** 3, stale_seconds: float = 3600, scan_every: int = 100):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        # The directory is rescanned on the first put and every scan_every puts after, to
+        # pick up what other processes wrote and evicted; in between the total is the last
+        # scan's plus this process's puts. Eviction goes down to 90% of max_bytes so that a
+        # full store is not rescanned on every put.
+        self.scan_every = scan_every
+        self._bytes = None
+        self._puts = 0
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.evictions = 0
+        # metrics.register_cache sets this to on_lookup(stage, hit)
+        self.on_lookup = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        # (last access, key, bytes) for every complete entry, oldest first. Staging
+        # directories start with a dot; ones left behind by a crashed writer are removed
+        # once they are stale, ones still being written are left alone.
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if name.startswith('.'):
+                    if now - os.path.getmtime(path) > self.stale_seconds:
+                        shutil.rmtree(path, ignore_errors=True)
+                    continue
+                entries.append((os.path.getmtime(os.path.join(path, 'data.json')), name, self._entry_size(path)))
+            except OSError:
+                # Evicted or replaced by another process meanwhile, or not an entry (the
+                # PubChem database lives under the same root)
+                continue
+        return sorted(entries)
+
+    @staticmethod
+    def _entry_size(path):
+        try:
+            with open(os.path.join(path, 'size'), 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            # Written before entries recorded their size
+            return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+    @staticmethod
+    def key(digest: str, stage: str, version: str) -> str:
+        return hashlib.sha256(f'{digest}:{stage}:{version}'.encode()).hexdigest()
+
+    def entry_path(self, digest: str, stage: str, version: str) -> str:
+        return os.path.join(self.root, self.key(digest, stage, version))
+
+    def contains(self, digest: str, stage: str, version: str) -> bool:
+        return os.path.exists(os.path.join(self.entry_path(digest, stage, version), 'data.json'))
+
+    def get(self, digest: str, stage: str, version: str):
+        data_path = os.path.join(self.entry_path(digest, stage, version), 'data.json')
+        try:
+            with open(data_path, 'r') as f:
+                data = json.load(f)
+            os.utime(data_path)
+        except (OSError, ValueError):
+            self._count(stage, False)
+            return None
+        self._count(stage, True)
+        return data
+
+    def _count(self, stage, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[stage] += 1
+        if self.on_lookup is not None:
+            self.on_lookup(stage, hit)
+
+    def read_file(self, digest: str, stage: str, version: str, name: str) -> bytes:
+        with open(os.path.join(self.entry_path(digest, stage, version), name), 'rb') as f:
+            return f.read()
+
+    def put(self, digest: str, stage: str, version: str, data, files: dict = None):
+        key = self.key(digest, stage, version)
+        path = os.path.join(self.root, key)
+        staging = os.path.join(self.root, f'.{key}.{uuid.uuid4().hex}')
+        old = f'{staging}.old'
+        os.makedirs(staging)
+        try:
+            for name, content in (files or {}).items():
+                with open(os.path.join(staging, name), 'wb') as f:
+                    f.write(content)
+            with open(os.path.join(staging, 'data.json'), 'w') as f:
+                json.dump(data, f)
+            size = sum(os.path.getsize(os.path.join(staging, name)) for name in os.listdir(staging))
+            with open(os.path.join(staging, 'size'), 'w') as f:
+                f.write(str(size))
+            # os.replace cannot overwrite a non-empty directory, so an existing entry is
+            # moved aside first. Another process may put the same entry in between; its
+            # result is the same, so losing that race is fine.
+            try:
+                os.replace(path, old)
+            except FileNotFoundError:
+                pass
+            try:
+                os.replace(staging, path)
+            except OSError as e:
+                print(f"Cache entry {key} was written by another process: {e}")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+            shutil.rmtree(old, ignore_errors=True)
+        self._evict(size)
+
+    def _evict(self, added: int):
+        with self._lock:
+            self._puts += 1
+            if self._bytes is not None and self._puts % self.scan_every:
+                self._bytes += added
+                if self._bytes <= self.max_bytes:
+                    return
+        entries = self._scan()
+        size = sum(entry_size for _, _, entry_size in entries)
+        if size > self.max_bytes:
+            # Never evict the newest entry, which may be the one just written
+            for _, key, entry_size in entries[:-1]:
+                if size <= 0.9 * self.max_bytes:
+                    break
+                shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+                size -= entry_size
+                with self._lock:
+                    self.evictions += 1
+        with self._lock:
+            self._bytes = size
+
+    def stats(self):
+        entries = self._scan()
+        with self._lock:
+            return {
+                'entries': len(entries),
+                'bytes': sum(entry_size for _, _, entry_size in entries),
+                'max_bytes': self.max_bytes,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+
+# gunicorn --config gunicorn.conf.py app:app
+# The app is imported once in the master, but no model is loaded there: torch and
+# TensorFlow start thread pools that do not survive fork() (the reason the process pool
+# uses spawn), so every worker loads its models itself after forking, in the background,
+# and /ready turns 200 in a worker once it has. CHEMEXTRACT_PRELOAD=molscribe,ner loads
+# those in the master instead, so the workers share their weights copy-on-write; only use it
+# where a forked worker has been seen to run them correctly.
+
+bind = os.environ.get('CHEMEXTRACT_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = True
+# Extractions run inside /extract requests and can take minutes
+timeout = int(os.environ.get('CHEMEXTRACT_TIMEOUT', 600))
+
+os.environ.setdefault('CHEMEXTRACT_PRELOAD', '')
+os.environ['CHEMEXTRACT_FORKING'] = '1'
+
+# Each worker writes its metrics to files here and /metrics aggregates them, so a scrape
+# covers every worker. Set before prometheus_client is imported, and emptied at start
+# because files left by an earlier run would be counted again.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f'chemextract_metrics_{bind.rsplit(":", 1)[-1]}'))
+shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def on_starting(server):
+    # Seed the PubChem cache once, in the master, before any worker starts
+    import pubchem
+    pubchem.seed_from_environment()
+
+
+def post_fork(server, worker):
+    import app
+    from scheduling import scheduler
+    # Each worker schedules its own extractions on its share of the CPUs
+    cores = int(os.environ.get('CHEMEXTRACT_CORES', 0)) or (os.cpu_count() or 1) // workers
+    scheduler.resize(max(1, cores), int(os.environ.get('CHEMEXTRACT_CORES_PER_JOB', 0)) or None)
+    # Loads every model not preloaded in the master
+    app.start_warming()
+
+
+def child_exit(server, worker):
+    # Drops the exited worker's live gauges (jobs, cores) from the aggregate
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import uuid
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+
+
+class Job:
+    # State of one extraction, shared between the worker running it and the status
+    # endpoint. Extractors report into it through update() and add_partial(). With a
+    # state_path the state is also written there (at most every save_interval seconds while
+    # progress comes in, and on every status change), so a process that does not run the job,
+    # e.g. another gunicorn worker, can answer for it through Job.load().
+    def __init__(self, job_id: str = None, state_path: str = None, save_interval: float = 0.5):
+        self.id = job_id or str(uuid.uuid4())
+        self.state_path = state_path
+        self.save_interval = save_interval
+        self._saved = 0
+        self.status = 'queued'
+        self.progress = {}
+        self.partial = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def update(self, stage: str, file: str, done: int, total: int = None):
+        with self._lock:
+            self.progress.setdefault(stage, {})[file] = {'done': done, 'total': total}
+        self.save(force=False)
+
+    def add_partial(self, kind: str, file: str, results):
+        with self._lock:
+            self.partial.setdefault(kind, {})[file] = results
+        self.save()
+
+    def save(self, force: bool = True):
+        if self.state_path is None or (not force and time.monotonic() - self._saved < self.save_interval):
+            return
+        self._saved = time.monotonic()
+        state = self.to_dict(partial=True)
+        state['result'] = self.result
+        # Written aside and renamed so a reader never sees half a file
+        partial_path = f'{self.state_path}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+            with open(partial_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(partial_path, self.state_path)
+        except Exception as e:
+            print(e)
+
+    @classmethod
+    def load(cls, state_path: str):
+        # A read-only copy of a job saved by another process, or None
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = cls(state['job'])
+        job.status = state['status']
+        job.progress = state['progress']
+        job.partial = state.get('partial', {})
+        job.result = state.get('result')
+        job.error = state.get('error')
+        job.created, job.started, job.finished = state['created'], state['started'], state['finished']
+        if job.status in ('done', 'error'):
+            job._done.set()
+        return job
+
+    def to_dict(self, partial: bool = False):
+        with self._lock:
+            state = {
+                'job': self.id,
+                'status': self.status,
+                'progress': {stage: dict(files) for stage, files in self.progress.items()},
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+            }
+            if self.error is not None:
+                state['error'] = self.error
+            if partial:
+                state['partial'] = {kind: dict(files) for kind, files in self.partial.items()}
+            return state
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+
+class JobQueue:
+    # Runs submitted jobs on a fixed number of worker threads. Finished jobs are kept
+    # for status queries until more than `keep` jobs exist, oldest dropped first.
+    def __init__(self, workers: int = 2, keep: int = 1000):
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        # listener(counts) is called whenever a job is added, dropped or changes status
+        self.listeners = []
+
+    def start(self):
+        # Threads do not survive fork(), so they are started on first submit in the process
+        # that runs the jobs rather than in a master that preloads the app
+        if self._pid == os.getpid():
+            return
+        self._queue = queue.Queue()
+        self._threads = [threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True) for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        self._pid = os.getpid()
+
+    def submit(self, job: Job, fn, *args):
+        # fn(job, *args) runs on a worker; its return value becomes job.result
+        with self._lock:
+            self.start()
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.keep:
+                oldest = next(iter(self.jobs.values()))
+                if oldest.status in ('queued', 'running'):
+                    break
+                self.jobs.popitem(last=False)
+        job.save()
+        self._changed()
+        self._queue.put((job, fn, args))
+        return job
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def counts(self):
+        with self._lock:
+            counts = {'queued': 0, 'running': 0, 'done': 0, 'error': 0}
+            for job in self.jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def _changed(self):
+        if self.listeners:
+            counts = self.counts()
+            for listener in self.listeners:
+                listener(counts)
+
+    def _work(self):
+        while True:
+            job, fn, args = self._queue.get()
+            job.status = 'running'
+            job.started = time.time()
+            job.save()
+            self._changed()
+            try:
+                job.result = fn(job, *args)
+                job.status = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job.error = str(e)
+                job.status = 'error'
+            finally:
+                job.finished = time.time()
+                job.save()
+                self._changed()
+                job._done.set()
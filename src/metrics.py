@@ -0,0 +1,84 @@
+import os
+import time
+from contextlib import contextmanager
+import profiling
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+
+# Process-wide Prometheus metrics. Recording is a lock and an add per call, so the
+# extractors update these inline; /metrics in app.py renders them.
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+stage_seconds = Histogram('chemextract_stage_seconds', 'Wall time of one call of an extraction stage', ['stage'], buckets=STAGE_BUCKETS)
+items_processed = Counter('chemextract_items', 'Pages, segments and keywords processed', ['kind'])
+pubchem_requests = Counter('chemextract_pubchem_requests', 'HTTP requests sent to PubChem by response', ['outcome'])
+pubchem_retries = Counter('chemextract_pubchem_retries', 'PubChem requests retried after a busy or failed response')
+s3_uploaded_bytes = Counter('chemextract_s3_uploaded_bytes', 'Bytes uploaded to S3')
+s3_files = Counter('chemextract_s3_files', 'Files seen by the S3 sync', ['result'])
+# Gauges are set when the value changes, never computed at scrape time, so that with
+# PROMETHEUS_MULTIPROC_DIR set (several gunicorn workers) every worker's value reaches the
+# scrape; multiprocess_mode says how the workers' values combine
+model_load_seconds = Gauge('chemextract_model_load_seconds', 'Time taken to load each model', ['model'], multiprocess_mode='livemax')
+model_rss_bytes = Gauge('chemextract_model_rss_bytes', 'Resident memory added by loading each model', ['model'], multiprocess_mode='livemax')
+http_request_seconds = Histogram('chemextract_http_request_seconds', 'Flask request latency', ['route', 'method', 'status'], buckets=STAGE_BUCKETS)
+jobs = Gauge('chemextract_jobs', 'Extraction jobs by status', ['status'], multiprocess_mode='livesum')
+cores_allocated = Gauge('chemextract_cores_allocated', 'Cores assigned to running extractions', multiprocess_mode='livesum')
+extractions_waiting = Gauge('chemextract_extractions_waiting', 'Extractions waiting for cores', multiprocess_mode='livesum')
+cache_hits = Counter('chemextract_cache_hits', 'Cache lookups that found an entry', ['cache', 'stage'])
+cache_misses = Counter('chemextract_cache_misses', 'Cache lookups that found nothing', ['cache', 'stage'])
+
+
+@contextmanager
+def stage(name):
+    # Times the block (or decorated function) into stage_seconds, and tags the thread with
+    # the stage while a profile is being captured
+    start = time.perf_counter()
+    session = profiling.current()
+    if session is not None:
+        session.enter(name)
+    try:
+        yield
+    finally:
+        if session is not None:
+            session.exit()
+        stage_seconds.labels(name).observe(time.perf_counter() - start)
+
+
+def register_cache(name, cache):
+    # The cache calls on_lookup(stage, hit) for every lookup; its own hits/misses stay
+    # per process, for its stats()
+    def on_lookup(stage, hit):
+        (cache_hits if hit else cache_misses).labels(name, stage).inc()
+    cache.on_lookup = on_lookup
+
+
+def watch_jobs(job_queue):
+    def update(counts):
+        for status, count in counts.items():
+            jobs.labels(status).set(count)
+    job_queue.listeners.append(update)
+    update(job_queue.counts())
+
+
+def watch_scheduler(scheduler):
+    def update(allocated, waiting):
+        cores_allocated.set(allocated)
+        extractions_waiting.set(waiting)
+    scheduler.listeners.append(update)
+    update(0, 0)
+
+
+def record_model_load(name, stats):
+    model_load_seconds.labels(name).set(stats['load_seconds'])
+    model_rss_bytes.labels(name).set(stats['rss_delta_bytes'])
+
+
+def render():
+    # With several gunicorn workers PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py) and
+    # every worker's metrics are aggregated from the files they write there
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
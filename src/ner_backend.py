@@ -0,0 +1,94 @@
+import os
+import inspect
+from types import SimpleNamespace
+
+
+# CPU inference backends for the token-classification NER model. Every backend is called
+# like the transformers model, model(ids, attention_mask=mask).logits, and has .config, so
+# NEREngine runs them unchanged:
+#   eager - the model as loaded, float32 PyTorch
+#   int8  - torch dynamic quantization: Linear weights stored as int8, activations
+#           quantized on the fly; about 4x smaller weights and faster matmuls on CPU
+#   onnx  - the model exported once to an ONNX graph and run on ONNX Runtime
+BACKENDS = ('eager', 'int8', 'onnx')
+
+
+def convert(model, backend: str, onnx_path: str = None, threads: int = None):
+    # threads sizes the ONNX Runtime pool; torch backends use torch's, which the scheduler sets
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown NER backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    model.eval()
+    if backend == 'int8':
+        return quantize(model)
+    if backend == 'onnx':
+        if not os.path.exists(onnx_path):
+            export_onnx(model, onnx_path)
+        return OnnxTokenClassifier(onnx_path, model.config, threads)
+    return model
+
+
+def backend_name(model):
+    return getattr(model, 'ner_backend', 'eager')
+
+
+def quantize(model):
+    import torch
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    quantized.ner_backend = 'int8'
+    return quantized
+
+
+def export_onnx(model, path: str, opset: int = 14):
+    # Exports with dynamic batch and sequence axes; written next to the target and renamed
+    # so a concurrent reader never sees a partial file. The wrapper is put in eval mode
+    # because the exporter restores its mode afterwards, which would leave the shared
+    # model in training mode with dropout on.
+    import torch
+
+    class Logits(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids, attention_mask=attention_mask).logits
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    ids = torch.ones((2, 16), dtype=torch.long)
+    options = {}
+    # Newer torch defaults to the dynamo exporter, which needs onnxscript
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        options['dynamo'] = False
+    partial = f'{path}.{os.getpid()}.tmp'
+    with torch.inference_mode():
+        torch.onnx.export(
+            Logits().eval(), (ids, torch.ones_like(ids)), partial,
+            input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'logits': {0: 'batch', 1: 'sequence'}},
+            opset_version=opset, **options,
+        )
+    os.replace(partial, path)
+    print(f"Exported the NER model to {path}")
+
+
+class OnnxTokenClassifier:
+    ner_backend = 'onnx'
+
+    def __init__(self, path: str, config, threads: int = None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        # The exporter drops inputs the graph does not use, e.g. the mask of a model that ignores it
+        self.inputs = {node.name for node in self.session.get_inputs()}
+        self.config = config
+
+    def __call__(self, input_ids, attention_mask=None):
+        import torch
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        feed = {'input_ids': input_ids.numpy(), 'attention_mask': attention_mask.numpy()}
+        logits = self.session.run(['logits'], {name: value for name, value in feed.items() if name in self.inputs})[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
@@ -1,27 +1,57 @@
 import os
 import fitz
-import cv2
 import numpy as np
-import torch
 import re
 import asyncio
-import pubchempy as pcp
-from pdf2image import convert_from_path
-from molscribe import MolScribe
-from decimer_segmentation import segment_chemical_structures, get_mrcnn_results
-from transformers import AutoTokenizer, BertForTokenClassification
+import pubchem
 from collections import defaultdict
-from  huggingface_hub import hf_hub_download
 import json
-from more_itertools import unique_everseen
 import time
 import shutil
-import boto3
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import bisect
+import importlib.metadata
+import psutil
+from extraction_cache import ExtractionCache, file_digest
+from pipeline import Pipeline, Stage
+from s3sync import S3Sync
+from triage import PageTriage
+from scheduling import scheduler
+from structure_store import StructureStore, SegmentIndex, segment_signature, HASH_VERSION, MAX_DISTANCE
+import ner_backend
+import metrics
+import profiling
+import contextlib
+
+
+class _LazyModule:
+    # Imports the named module on first attribute access. torch and OpenCV are only
+    # needed once a document is processed, so importing pdfextract (and booting the app)
+    # does not pay for them; MolScribe, TensorFlow and transformers are imported inside
+    # the model loaders for the same reason.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+torch = _LazyModule('torch')
+cv2 = _LazyModule('cv2')
 
 
 
 def delete_s3_folder(bucket_name, folder_prefix):
     try:
+        import boto3
         s3 = boto3.client('s3')
         objects_to_delete = []
 
@@ -40,33 +70,194 @@ def delete_s3_folder(bucket_name, folder_prefix):
 
 
 
-def upload_folder_to_s3(local_folder_path, bucket_name, s3_folder_path=''):
-    s3 = boto3.client('s3')
+_s3_syncs = {}
+_s3_syncs_lock = threading.Lock()
+
+
+def s3_sync(bucket_name):
+    # One S3Sync (and so one boto3 client and upload pool) per bucket for the whole process
+    with _s3_syncs_lock:
+        if bucket_name not in _s3_syncs:
+            _s3_syncs[bucket_name] = S3Sync(bucket_name)
+        return _s3_syncs[bucket_name]
+
+
+def upload_folder_to_s3(local_folder_path, bucket_name, s3_folder_path='', background=False):
+    # Uploads the files that changed since the last call for this folder; with
+    # background=True returns a future instead of waiting for the uploads
+    prefix = local_folder_path + "/" + s3_folder_path.strip("/") if s3_folder_path else local_folder_path
+    sync = s3_sync(bucket_name)
+    if background:
+        return sync.sync_in_background(local_folder_path, prefix)
+    stats = sync.sync(local_folder_path, prefix)
+    print(f"Uploaded {stats['uploaded']} files ({stats['bytes']} bytes) to s3://{bucket_name}/{prefix}, {stats['skipped']} unchanged")
+    return stats
+
 
-    for root, dirs, files in os.walk(local_folder_path):
-        for file in files:
-            local_file_path = os.path.join(root, file)
-            s3_file_path = os.path.join(s3_folder_path, os.path.relpath(local_file_path, local_folder_path))
-            s3.upload_file(local_file_path, bucket_name,local_folder_path +"/"+s3_file_path)
 async def fetch_from_pcp(keyword, type, output):
     try:
-        compound = pcp.get_compounds(keyword, type)[0]
-        return compound.canonical_smiles
-    except pcp.PubChemHTTPError as e:
-        if hasattr(e, 'args') and len(e.args) > 0:
-            error_name = e.args[0]
-            if error_name == 'PUGREST.ServerBusy':
-                print(f"Rate limit exceeded. Retrying after {e.headers['Retry-After']} seconds...")
-                retry_after = int(e.headers['Retry-After'])
-                await asyncio.sleep(retry_after)
-                return await fetch_from_pcp(keyword, type, output)
-    except (IndexError, KeyError):
-        return None
+        async with pubchem.PubChemClient() as client:
+            compound = await client.resolve(keyword, type)
+        return compound['canonical_smiles'] if compound is not None else None
     except Exception as e:
         print(f"Error fetching compound smiles: {e}")
         return None
 
 
+def _param_bytes(model):
+    # Best-effort weight size: torch modules, MolScribe's encoder/decoder, or a Keras model
+    if isinstance(model, torch.nn.Module):
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+    if hasattr(model, 'keras_model'):
+        return model.keras_model.count_params() * 4
+    if isinstance(model, tuple):
+        return sum(_param_bytes(m) or 0 for m in model)
+    modules = [m for m in getattr(model, '__dict__', {}).values() if isinstance(m, torch.nn.Module)]
+    if modules:
+        return sum(_param_bytes(m) for m in modules)
+    return None
+
+
+MOLSCRIBE_CHECKPOINT = ('yujieq/MolScribe', 'swin_base_char_aux_1m.pth')
+NER_MODEL = 'pruas/BENT-PubMedBERT-NER-Chemical'
+
+
+def _package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+# Anything that changes extraction output must be part of these, or stale cache entries are served
+DETECTION_VERSION = f"decimer-segmentation=={_package_version('decimer-segmentation')}"
+RECOGNITION_VERSION = f"{DETECTION_VERSION};{'/'.join(MOLSCRIBE_CHECKPOINT)};MolScribe=={_package_version('MolScribe')}"
+NER_VERSION = f"{NER_MODEL};transformers=={_package_version('transformers')}"
+
+extraction_cache = ExtractionCache(
+    os.environ.get('CHEMEXTRACT_CACHE_DIR', 'extraction_cache'),
+    max_bytes=int(os.environ.get('CHEMEXTRACT_CACHE_BYTES', 2 * 1024 ** 3)),
+)
+metrics.register_cache('extraction', extraction_cache)
+
+# Cross-document drawing -> SMILES store, off unless CHEMEXTRACT_STRUCTURE_STORE names a database
+structure_store = None
+if os.environ.get('CHEMEXTRACT_STRUCTURE_STORE'):
+    structure_store = StructureStore(os.environ['CHEMEXTRACT_STRUCTURE_STORE'], int(os.environ.get('CHEMEXTRACT_STRUCTURE_STORE_ENTRIES', 100000)))
+    metrics.register_cache('structures', structure_store)
+
+
+def _load_molscribe():
+    from huggingface_hub import hf_hub_download
+    from molscribe import MolScribe
+    ckpt_path = hf_hub_download(*MOLSCRIBE_CHECKPOINT)
+    return MolScribe(ckpt_path)
+
+
+def _load_mrcnn():
+    # decimer_segmentation builds its Mask R-CNN at import time; reuse that instance. Its
+    # TensorFlow pools are sized to one job's cores before anything runs on them.
+    scheduler.configure_tensorflow(importlib.import_module('tensorflow'))
+    decimer = importlib.import_module('decimer_segmentation.decimer_segmentation')
+    model = getattr(decimer, 'model', None)
+    if model is None:
+        model = decimer.load_model()
+    return model
+
+
+def _load_ner():
+    from transformers import AutoTokenizer, BertForTokenClassification
+    tokenizer = AutoTokenizer.from_pretrained(NER_MODEL)
+    model = BertForTokenClassification.from_pretrained(NER_MODEL)
+    return tokenizer, with_ner_backend(model)
+
+
+def apply_masks(img, masks):
+    # decimer_segmentation's mask-to-crop step, returning (crops, (y0, x0, y1, x1) boxes).
+    # That module builds the Mask R-CNN (downloading it the first time) when it is imported,
+    # so it is imported here, only once a detection has found something; offline stand-ins
+    # replace this function along with the models (see testing/stub_models.py).
+    from decimer_segmentation.decimer_segmentation import apply_masks as decimer_apply_masks
+    return decimer_apply_masks(img, masks)
+
+
+def ner_onnx_path():
+    folder = os.environ.get('CHEMEXTRACT_ONNX_DIR', 'onnx_models')
+    return os.path.join(folder, re.sub(r'[^A-Za-z0-9.=-]+', '_', NER_VERSION) + '.onnx')
+
+
+def with_ner_backend(model, backend: str = None):
+    # CHEMEXTRACT_NER_BACKEND picks eager (default), int8 or onnx; see ner_backend.py
+    backend = backend or os.environ.get('CHEMEXTRACT_NER_BACKEND', 'eager')
+    try:
+        # ONNX Runtime fixes its pool size when the session is made: one extraction's cores
+        return ner_backend.convert(model, backend, ner_onnx_path(), threads=scheduler.cores_per_job)
+    except Exception as e:
+        print(f"Could not use the {backend} NER backend, using eager: {e}")
+        return model
+
+
+class ModelRegistry:
+    loaders = {
+        'molscribe': _load_molscribe,
+        'mrcnn': _load_mrcnn,
+        'ner': _load_ner,
+    }
+
+    def __init__(self):
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._locks = {name: threading.Lock() for name in self.loaders}
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._locks[name]:
+            if name not in self._models:
+                process = psutil.Process()
+                rss_before = process.memory_info().rss
+                start = time.time()
+                model = self.loaders[name]()
+                load_seconds = time.time() - start
+                with self._lock:
+                    self._stats[name] = {
+                        'load_seconds': load_seconds,
+                        'rss_delta_bytes': process.memory_info().rss - rss_before,
+                        'param_bytes': _param_bytes(model),
+                    }
+                    self._models[name] = model
+                metrics.record_model_load(name, self._stats[name])
+                print(f"Loading {name} took {load_seconds} seconds")
+            return self._models[name]
+
+    def molscribe(self):
+        return self.get('molscribe')
+
+    def mrcnn(self):
+        return self.get('mrcnn')
+
+    def ner(self):
+        return self.get('ner')
+
+    def warm(self, names=None):
+        for name in names or self.loaders:
+            self.get(name)
+        return self.stats()
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+model_registry = ModelRegistry()
+
+
 def extract_text_from_pdf(file_path: str, page_number: int = 0) -> str:
     doc = fitz.open(file_path)
     page = doc.load_page(page_number)
@@ -74,6 +265,37 @@ def extract_text_from_pdf(file_path: str, page_number: int = 0) -> str:
     return text
 
 
+def render_pages(file_path: str, dpi: int = 200, grayscale: bool = False, workers: int = 2, page_numbers: list = None):
+    # Yields (page_number, RGB array) in page order, rendering with PyMuPDF on a small
+    # thread pool. At most 2 * workers pages are in flight, so memory does not grow with
+    # page count. Grayscale renders are expanded back to 3 channels for the detector.
+    # page_numbers restricts rendering to those pages.
+    local = threading.local()
+
+    def render(page_number):
+        with metrics.stage('render'):
+            if not hasattr(local, 'doc'):
+                local.doc = fitz.open(file_path)
+            pix = local.doc.load_page(page_number).get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if grayscale else fitz.csRGB, alpha=False)
+            img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            metrics.items_processed.labels('pages').inc()
+            return np.repeat(img, 3, axis=2) if grayscale else img.copy()
+
+    if page_numbers is None:
+        page_numbers = range(page_count(file_path))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for page_number in page_numbers:
+            # In the caller's context, which carries its profiling session
+            pending.append((page_number, pool.submit(contextvars.copy_context().run, render, page_number)))
+            if len(pending) >= 2 * workers:
+                page_number, future = pending.pop(0)
+                yield page_number, future.result()
+        for page_number, future in pending:
+            yield page_number, future.result()
+
+
 def extract_text_from_pdf_all_pages(file_path: str) -> list:
     doc = fitz.open(file_path)
     text_pages = []
@@ -86,287 +308,680 @@ def extract_text_from_pdf_all_pages(file_path: str) -> list:
     return text_pages
 
 
-def split_text(text: str, max_length: int) -> list:
-    # Split the text into chunks of maximum length
-    chunks = [text[i:i + max_length] for i in range(0, len(text), max_length)]
-    return chunks
+def page_count(file_path: str) -> int:
+    with fitz.open(file_path) as doc:
+        return len(doc)
+
+
+def report_progress(progress, stage: str, filename: str, done: int, total: int = None):
+    # progress is any object with update(stage, file, done, total), e.g. a jobs.Job
+    if progress is not None:
+        progress.update(stage, os.path.basename(filename), done, total)
+
+
+class NEREngine:
+    # Tokenizes a whole document once and runs overlapping max_length token windows
+    # through the model in padded batches. Entities come back as character spans.
+    def __init__(self, tokenizer, model, max_length: int = 512, stride: int = 128, batch_size: int = 8):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_length = max_length
+        self.stride = stride
+        self.batch_size = batch_size
+        self.backend = ner_backend.backend_name(model)
+        self.forward_passes = 0
+
+    def windows(self, num_tokens):
+        body = self.max_length - 2
+        step = max(1, body - self.stride)
+        windows = []
+        start = 0
+        while True:
+            end = min(start + body, num_tokens)
+            windows.append((start, end))
+            if end >= num_tokens:
+                return windows
+            start += step
+
+    def predict_labels(self, input_ids, progress=None):
+        # Each token keeps the label from the window where it sits furthest from an edge;
+        # progress(done, total) is called with the number of windows processed so far
+        labels = [0] * len(input_ids)
+        margins = [-1] * len(input_ids)
+        windows = self.windows(len(input_ids))
+        cls_id, sep_id, pad_id = self.tokenizer.cls_token_id, self.tokenizer.sep_token_id, self.tokenizer.pad_token_id
+
+        with torch.inference_mode():
+            for batch_start in range(0, len(windows), self.batch_size):
+                batch = windows[batch_start:batch_start + self.batch_size]
+                width = max(end - start for start, end in batch) + 2
+                ids = torch.full((len(batch), width), pad_id, dtype=torch.long)
+                mask = torch.zeros((len(batch), width), dtype=torch.long)
+                for row, (start, end) in enumerate(batch):
+                    window_ids = [cls_id] + input_ids[start:end] + [sep_id]
+                    ids[row, :len(window_ids)] = torch.tensor(window_ids)
+                    mask[row, :len(window_ids)] = 1
+
+                with profiling.torch_ops():
+                    predicted = torch.argmax(self.model(ids, attention_mask=mask).logits, dim=2).tolist()
+                self.forward_passes += 1
+
+                for row, (start, end) in enumerate(batch):
+                    for position in range(start, end):
+                        margin = min(position - start, end - 1 - position)
+                        if margin > margins[position]:
+                            margins[position] = margin
+                            labels[position] = predicted[row][position - start + 1]
+                if progress is not None:
+                    progress(batch_start + len(batch), len(windows))
+        return labels
+
+    def predict(self, text: str, progress=None) -> list:
+        if not text.strip():
+            return []
+        encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        offsets = encoding['offset_mapping']
+        word_ids = encoding.word_ids()
+        labels = self.predict_labels(encoding['input_ids'], progress)
+        id2label = self.model.config.id2label
+
+        # Group tagged tokens into entities (B- starts a new one), then widen every
+        # entity to whole words so partially tagged subwords are not lost.
+        entities = []
+        previous = None
+        for position, label in enumerate(labels):
+            if label == 0:
+                previous = None
+                continue
+            begins = str(id2label.get(label, '')).startswith('B')
+            if previous is not None and (not begins or word_ids[position] == word_ids[previous]):
+                entities[-1][1] = position
+            else:
+                entities.append([position, position])
+            previous = position
+
+        spans = []
+        for first, last in entities:
+            while first > 0 and word_ids[first - 1] == word_ids[first]:
+                first -= 1
+            while last < len(word_ids) - 1 and word_ids[last + 1] == word_ids[last]:
+                last += 1
+            span = (offsets[first][0], offsets[last][1])
+            if spans and span[0] <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], span[1]))
+            else:
+                spans.append(span)
+        return spans
+
+
+class OccurrenceIndex:
+    # Aho-Corasick automaton over a set of keywords. One linear scan of the document
+    # finds every (overlapping) occurrence of every keyword; page numbers come from a
+    # table of page start offsets.
+    def __init__(self, keywords, text: str, page_starts: list):
+        self.keywords = list(dict.fromkeys(keyword for keyword in keywords if keyword))
+        self.page_starts = page_starts
+        self.occurrences = {keyword: [] for keyword in self.keywords}
+        self._build()
+        self._scan(text)
+
+    def _build(self):
+        goto = [{}]
+        output = [[]]
+        for keyword in self.keywords:
+            state = 0
+            for ch in keyword:
+                if ch not in goto[state]:
+                    goto.append({})
+                    output.append([])
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            output[state].append(keyword)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, child in goto[state].items():
+                queue.append(child)
+                fallback = fail[state]
+                while fallback and ch not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[child] = goto[fallback].get(ch, 0) if goto[fallback].get(ch) != child else 0
+                output[child] = output[child] + output[fail[child]]
+
+        self._goto, self._fail, self._output = goto, fail, output
+
+    def _scan(self, text):
+        goto, fail, output, occurrences = self._goto, self._fail, self._output, self.occurrences
+        state = 0
+        for position, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                for keyword in output[state]:
+                    occurrences[keyword].append(position + 1 - len(keyword))
+
+    def page(self, offset: int) -> int:
+        return bisect.bisect_right(self.page_starts, offset) - 1
+
+    def spans(self, keyword: str) -> list:
+        return [(start, start + len(keyword)) for start in self.occurrences.get(keyword, [])]
+
+
+class WordIndex:
+    # Words of one PDF from get_text("words"), in reading order per page. Built once at
+    # extraction time so highlighting a keyword runs page.search_for only on the pages
+    # whose words contain it, instead of on every page of every document. Containment is
+    # tested on substrings, as search_for matches inside slash- and hyphen-joined words.
+    def __init__(self, pages: list):
+        self.pages = pages
+        # search_for ignores case, so the page text is lowercased
+        self.texts = [' '.join(word[4] for word in words).lower() for words in pages]
+
+    @classmethod
+    def from_pdf(cls, file_path: str):
+        with fitz.open(file_path) as doc:
+            pages = [
+                [[round(x0, 2), round(y0, 2), round(x1, 2), round(y1, 2), word] for x0, y0, x1, y1, word, *_ in page.get_text("words", sort=True)]
+                for page in doc
+            ]
+        return cls(pages)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'r') as f:
+            return cls(json.load(f)['pages'])
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'pages': self.pages}, f)
+
+    def candidate_pages(self, keyword: str) -> list:
+        # Pages holding every word of the keyword; a superset of the pages search_for hits
+        parts = keyword.lower().split()
+        if not parts:
+            return []
+        return [page for page, text in enumerate(self.texts) if all(part in text for part in parts)]
+
+    def find(self, keyword: str, file_path: str) -> list:
+        # Returns (page, [rect]) for every hit of search_for on the candidate pages
+        pages = self.candidate_pages(keyword)
+        if not pages:
+            return []
+        matches = []
+        with fitz.open(file_path) as doc:
+            for page in pages:
+                for rect in doc.load_page(page).search_for(keyword):
+                    matches.append((page, [[round(rect.x0, 2), round(rect.y0, 2), round(rect.x1, 2), round(rect.y1, 2)]]))
+        return matches
+
+
+def words_path(file_path: str, pathtosave: str = None) -> str:
+    folder_path = pathtosave + '/' + 'WORDS' if pathtosave else 'WORDS'
+    return f'{folder_path}/{os.path.splitext(os.path.basename(file_path))[0]}.json'
 
 
 class StructureExtractor:
-    def __init__(self, filename: str, pathtosave: str = None):
+    def __init__(self, filename: str, pathtosave: str = None, batch_size: int = 16, dpi: int = None, grayscale: bool = False, render_workers: int = 2,
+                 triage: PageTriage = None, crop_dpi: int = None, crop_padding: float = 4, dedup: bool = None):
         self.filename = filename
         self.filename_without_extension = os.path.splitext(self.filename)[0]
         self.pathtosave = pathtosave
-        ckpt_path =  hf_hub_download('yujieq/MolScribe', 'swin_base_char_aux_1m.pth')
-        self.model = MolScribe(ckpt_path)
+        self._model = None
+        # batch_size=1 recognizes segments one at a time with predict_image
+        self.batch_size = batch_size
+        # Pages are rendered at dpi for detection. With crop_dpi set, each detected box (plus
+        # crop_padding points) is rendered again from the PDF at crop_dpi for recognition, so
+        # detection can run on a cheap low-resolution page while MolScribe still gets sharp
+        # crops; without it the crops are cut from the detection render. Also set through
+        # CHEMEXTRACT_DETECT_DPI and CHEMEXTRACT_CROP_DPI.
+        self.dpi = dpi or int(os.environ.get('CHEMEXTRACT_DETECT_DPI', 200))
+        self.crop_dpi = crop_dpi or int(os.environ.get('CHEMEXTRACT_CROP_DPI', 0)) or None
+        self.crop_padding = crop_padding
+        self._docs = threading.local()
+        # Repeated drawings are recognized once; CHEMEXTRACT_DEDUP=0 turns it off
+        self.dedup = os.environ.get('CHEMEXTRACT_DEDUP', '1') != '0' if dedup is None else dedup
+        self.grayscale = grayscale
+        self.render_workers = render_workers
         self.pngs = []
         self.segments = []
         self.smiles = []
+        self._digest = None
+        self._page_count = None
+        self.progress = None
+        # Pages the triage rules out are neither rendered nor detected. triage=False or
+        # CHEMEXTRACT_TRIAGE=0 detects on every page, CHEMEXTRACT_TRIAGE=thumbnails adds the
+        # thumbnail check
+        if triage is None and os.environ.get('CHEMEXTRACT_TRIAGE', '1') != '0':
+            triage = PageTriage(thumbnails=os.environ.get('CHEMEXTRACT_TRIAGE') == 'thumbnails')
+        self.triage = triage or None
+        self._triage_pages = None
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = file_digest(self.filename)
+        return self._digest
+
+    @property
+    def page_count(self):
+        if self._page_count is None:
+            self._page_count = page_count(self.filename)
+        return self._page_count
+
+    def report(self, stage: str, done: int, total: int = None):
+        report_progress(self.progress, stage, self.filename, done, total)
+
+    def settings(self):
+        # Constructor arguments giving another extractor (e.g. in a worker process) the same
+        # output; a disabled triage is passed as False so the worker does not fall back to
+        # the environment's
+        return {
+            'batch_size': self.batch_size, 'dpi': self.dpi, 'grayscale': self.grayscale, 'render_workers': self.render_workers,
+            'triage': self.triage or False, 'crop_dpi': self.crop_dpi, 'crop_padding': self.crop_padding, 'dedup': self.dedup,
+        }
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = model_registry.molscribe()
+        return self._model
+
+    def detection_version(self):
+        triage = self.triage.version() if self.triage is not None else 'none'
+        return f'{DETECTION_VERSION};dpi={self.dpi};gray={self.grayscale};triage={triage};{self.crop_version()}'
+
+    def crop_version(self):
+        return f'crop_dpi={self.crop_dpi};padding={self.crop_padding}' if self.crop_dpi else 'crop_dpi=none'
+
+    def triage_path(self):
+        folder_path = (self.pathtosave + '/' if self.pathtosave else '') + 'TRIAGE'
+        os.makedirs(folder_path, exist_ok=True)
+        return f'{folder_path}/{os.path.basename(self.filename_without_extension)}.json'
+
+    def page_triage(self):
+        # Per-page decision and reason, also written to TRIAGE/<file>.json
+        if self._triage_pages is None:
+            if self.triage is None:
+                self._triage_pages = [{'page': page, 'detect': True, 'reason': 'triage disabled'} for page in range(self.page_count)]
+            else:
+                with metrics.stage('triage'):
+                    self._triage_pages = self.triage.pages(self.filename)
+                skipped = sum(not page['detect'] for page in self._triage_pages)
+                metrics.items_processed.labels('pages_skipped').inc(skipped)
+                print(f"Triage: {len(self._triage_pages) - skipped} of {len(self._triage_pages)} pages of {self.filename} need detection")
+                with open(self.triage_path(), 'w') as f:
+                    json.dump(self._triage_pages, f)
+            self.report('triage', len(self._triage_pages), len(self._triage_pages))
+        return self._triage_pages
+
+    def detect_pages(self):
+        return [page['page'] for page in self.page_triage() if page['detect']]
+
+    def recognition_version(self):
+        return f'{RECOGNITION_VERSION};dpi={self.dpi};gray={self.grayscale};{self.crop_version()};{self.dedup_version()}'
+
+    def dedup_version(self):
+        # Which crops share a recognition depends on the hash, the match threshold and
+        # whether the structure store supplies SMILES from other documents
+        if not self.dedup:
+            return 'dedup=False'
+        return f'dedup=True;{HASH_VERSION};max_distance={MAX_DISTANCE};store={structure_store is not None}'
+
+    def pages(self):
+        # Streams rendered pages, saving each one to Page_PNGS as it is produced
+        if self.pathtosave:
+            folder_path = self.pathtosave + '/' + 'Page_PNGS'
+        else:
+            folder_path = 'Page_PNGS'
+
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+
+        page_numbers = self.detect_pages()
+        for done, (index, extracted_page) in enumerate(render_pages(self.filename, self.dpi, self.grayscale, self.render_workers, page_numbers), 1):
+            png_path = f'{folder_path}/{os.path.basename(self.filename_without_extension)}_{index}.png'
+            cv2.imwrite(png_path, extracted_page)
+            self.report('render', done, len(page_numbers))
+            yield index, extracted_page
 
     def PDFtoPNG(self):
+        # self.pngs holds (page number, image) for the pages that passed triage
         if not self.pngs:
-            pngs = convert_from_path(self.filename)
-            if self.pathtosave:
-                folder_path = self.pathtosave + '/' + 'Page_PNGS'
-            else:
-                folder_path = 'Page_PNGS'
-            
-            if not os.path.exists(folder_path):
-                os.makedirs(folder_path)
+            self.pngs = list(self.pages())
 
-            for index, page in enumerate(pngs):
-                extracted_page = np.array(page)
-                png_path = f'{folder_path}/{os.path.basename(self.filename_without_extension)}_{index}.png'
-                cv2.imwrite(png_path, extracted_page)
-                self.pngs.append(extracted_page)
+        return [extracted_page for _, extracted_page in self.pngs]
 
-        return self.pngs
+    def segments_folder(self):
+        if self.pathtosave:
+            folder_path = self.pathtosave + '/' + 'segments'
+        else:
+            folder_path = 'segments'
+
+        if not os.path.exists(folder_path):
+            os.makedirs(folder_path)
+        return folder_path
+
+    def smiles_path(self):
+        if self.pathtosave:
+            folder_path = self.pathtosave + '/' + 'SMILES'
+        else:
+            folder_path = 'SMILES'
+
+        subfolder = 'PDF_SMILES'
+        if not os.path.exists(f'{folder_path}/{subfolder}'):
+            os.makedirs(f'{folder_path}/{subfolder}')
+
+        return f'{folder_path}/{subfolder}/{os.path.basename(self.filename_without_extension)}.json'
+
+    def load_detections(self):
+        cached = extraction_cache.get(self.digest, 'detection', self.detection_version())
+        if cached is None:
+            return None
+        pages = []
+        try:
+            for page, boxes in enumerate(cached['pages']):
+                detections = []
+                for i, box in enumerate(boxes):
+                    data = extraction_cache.read_file(self.digest, 'detection', self.detection_version(), f'{page}_{i}.png')
+                    detections.append((cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED), tuple(box)))
+                pages.append(detections)
+        except OSError as e:
+            # Evicted by another process after data.json was read
+            print(e)
+            return None
+        return pages
+
+    def store_detections(self, pages, cache: bool = True):
+        # pages holds one list of (crop, box) per page; fills self.segments in page order
+        article = os.path.basename(self.filename_without_extension)
+        for page, detections in enumerate(pages):
+            for minisegment, (X, Y, Height, Width) in detections:
+                self.segments.append([minisegment, page, [X, Y], Height, Width, article])
+
+        if cache:
+            boxes = [[list(box) for _, box in detections] for detections in pages]
+            crops = {
+                f'{page}_{i}.png': cv2.imencode('.png', minisegment)[1].tobytes()
+                for page, detections in enumerate(pages) for i, (minisegment, _) in enumerate(detections)
+            }
+            extraction_cache.put(self.digest, 'detection', self.detection_version(), {'pages': boxes}, crops)
+
+        folder_path = self.segments_folder()
+        for idx, minisegment in enumerate(self.segments):
+            cv2.imwrite(f'{folder_path}/{article}_{idx}.png', minisegment[0])
 
     async def segment(self):
         try:
             if not self.segments:
-                if self.pathtosave:
-                    folder_path = self.pathtosave + '/' + 'segments'
+                pages = self.load_detections()
+                if pages is not None:
+                    self.store_detections(pages, cache=False)
+                    self.report('detect', len(pages), len(pages))
                 else:
-                    folder_path = 'segments'
-
-                if not os.path.exists(folder_path):
-                    os.makedirs(folder_path)
-
-                if not self.pngs:
-                    self.PDFtoPNG()
-
-                for index, img in enumerate(self.pngs):
-                    start = time.time()
-                    minisegments = segment_chemical_structures(img, expand=False)
-                    print(f"making segments took {time.time() - start} seconds")
-                    _, bounding_boxes, _ = get_mrcnn_results(img)
-                    averages = [str(row[0]) for row in bounding_boxes] + [str(row[1]) for row in bounding_boxes]
-                    Widths = [str(row[2]-row[0]) for row in bounding_boxes]
-                    Heights = [str(row[3]-row[1]) for row in bounding_boxes]
-                    grouped_averages = [[averages[i], averages[i + len(bounding_boxes)]] for i in range(len(bounding_boxes))]
-                
-                    minis = []
-                    for idx, minisegment in enumerate(minisegments):
-                        minisegment_array = np.array(minisegment)
-                        minisegment = minisegment_array[:, :, :3]
-                    
-                        minisegment = [minisegment, idx, grouped_averages[idx], Widths[idx], Heights[idx], os.path.basename(self.filename_without_extension)]
-                        minis.append(minisegment)
-                        
-                        cv2.imwrite(f'{folder_path}/{os.path.basename(self.filename_without_extension)}_{idx}.png', minisegment[0])
-
-
-                    self.segments.extend(minis)
+                    pages = [[] for _ in range(self.page_count)]
+                    detect_count = len(self.detect_pages())
+                    for done, (page, img) in enumerate(self.pngs or self.pages(), 1):
+                        start = time.time()
+                        pages[page] = self.detect(img, page)
+                        self.report('detect', done, detect_count)
+                        print(f"making segments took {time.time() - start} seconds")
+                    self.store_detections(pages)
 
             return self.segments
         except Exception as e:
             print(e)
             return None
 
+    @metrics.stage('detect')
+    def detect(self, img, page: int = None):
+        # One Mask R-CNN pass per page; crops come from the same masks as the boxes, or are
+        # rendered again at crop_dpi when that is set and the page number is given.
+        # Boxes are returned as (X, Y, Height, Width) in PDF points for highlightPDFImage.
+        results = model_registry.mrcnn().detect([img], verbose=0)[0]
+        if results['masks'].shape[-1] == 0:
+            return []
+        segments, boxes = apply_masks(img, results['masks'])
+        scale = 72 / self.dpi
+        detections = []
+        for segment, (y0, x0, y1, x1) in sorted(zip(segments, boxes), key=lambda item: (item[1][0], item[1][1])):
+            box = tuple(float(v) for v in (x0 * scale, y0 * scale, (y1 - y0) * scale, (x1 - x0) * scale))
+            crop = self.render_crop(page, box) if self.crop_dpi and page is not None else np.array(segment)[:, :, :3]
+            detections.append((crop, box))
+        metrics.items_processed.labels('segments').inc(len(detections))
+        return detections
+
+    @metrics.stage('crop')
+    def render_crop(self, page: int, box):
+        # Renders the box (X, Y, Height, Width in PDF points) straight from the PDF at
+        # crop_dpi. Unlike the mask crops, text or lines inside the box are kept.
+        if not hasattr(self._docs, 'doc'):
+            self._docs.doc = fitz.open(self.filename)
+        pdf_page = self._docs.doc.load_page(page)
+        X, Y, Height, Width = box
+        clip = fitz.Rect(X, Y, X + Width, Y + Height) + (-self.crop_padding, -self.crop_padding, self.crop_padding, self.crop_padding)
+        pix = pdf_page.get_pixmap(dpi=self.crop_dpi, clip=clip & pdf_page.rect, colorspace=fitz.csGRAY if self.grayscale else fitz.csRGB, alpha=False)
+        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        return np.repeat(img, 3, axis=2) if self.grayscale else img.copy()
+
+    @metrics.stage('recognize')
+    def recognize(self, images):
+        metrics.items_processed.labels('recognized').inc(len(images))
+        with profiling.torch_ops():
+            if self.batch_size > 1:
+                predictions = self.model.predict_images(images, batch_size=self.batch_size)
+            else:
+                predictions = [self.model.predict_image(image) for image in images]
+        return [prediction['smiles'] for prediction in predictions]
+
+    def recognize_unique(self, images, memo: SegmentIndex = None):
+        # Runs MolScribe once per distinct drawing. memo indexes the drawings of this document
+        # already seen across calls and is filled in here; drawings missing from it are looked
+        # up in the structure store before anything is recognized.
+        if not self.dedup:
+            return self.recognize(images)
+        memo = SegmentIndex() if memo is None else memo
+        with metrics.stage('dedup'):
+            signatures = [segment_signature(image) for image in images]
+        version = f'{RECOGNITION_VERSION};{HASH_VERSION}'
+        entries, new = [], []
+        with memo.lock:
+            for image, signature in zip(images, signatures):
+                entry = memo.find(signature)
+                if entry is None:
+                    found, smiles = structure_store.get(signature, version) if structure_store is not None else (False, None)
+                    entry = memo.add(signature, smiles, pending=not found)
+                    if not found:
+                        new.append((entry, image, signature))
+                entries.append(entry)
+        try:
+            if new:
+                for (entry, _, signature), smiles in zip(new, self.recognize([image for _, image, _ in new])):
+                    entry['smiles'] = smiles
+                    if structure_store is not None:
+                        structure_store.put(signature, smiles, version)
+        finally:
+            # Another call waiting on these must not hang if recognition failed
+            for entry, _, _ in new:
+                entry['ready'].set()
+        metrics.items_processed.labels('segments_deduplicated').inc(len(images) - len(new))
+        for entry in entries:
+            entry['ready'].wait()
+        return [entry['smiles'] for entry in entries]
+
+    def load_recognition(self):
+        cached = extraction_cache.get(self.digest, 'recognition', self.recognition_version())
+        if cached is None or cached['count'] != len(self.segments):
+            return None
+        return [cached['pages'][str(img[1])].pop(0) for img in self.segments]
+
+    def store_recognition(self, recognized):
+        pages = defaultdict(list)
+        for img, SMILES in zip(self.segments, recognized):
+            pages[str(img[1])].append(SMILES)
+        extraction_cache.put(self.digest, 'recognition', self.recognition_version(), {'pages': pages, 'count': len(recognized)})
+
+    def build_output(self, recognized, chemicals):
+        output = []
+        for i, (img, SMILES, chemical) in enumerate(zip(self.segments, recognized, chemicals)):
+            cid = chemical['cid'] if chemical is not None else None
+            keyword = chemical['iupac_name'] if chemical is not None else None
+
+            to_add = {
+                'SMILES': SMILES,
+                'page': img[1],
+                'cid': cid,
+                'keyword': keyword,
+                'X': img[2][0],
+                'Y': img[2][1],
+                'Height': img[3],
+                'Width': img[4],
+                'article': img[5],
+                'image': f'segments/{os.path.basename(self.filename_without_extension)}_{i}.png'
+            }
+            output.append(to_add)
+
+        self.smiles = output
+        with open(self.smiles_path(), 'w') as f:
+            json.dump(self.smiles, f)
+        return self.smiles
+
     async def toSMILES(self):
             if not self.smiles:
-                output = []
-                if self.pathtosave:
-                    folder_path = self.pathtosave + '/' + 'SMILES'
-                else:
-                    folder_path = 'SMILES'
-                if not os.path.exists(folder_path):
-                    os.makedirs(folder_path)
-                
-                subfolder = 'PDF_SMILES'
-
-                if not os.path.exists(f'{folder_path}/{subfolder}'):
-                    os.makedirs(f'{folder_path}/{subfolder}')
-                
-                smiles_txt_path = f'{folder_path}/{subfolder}/{os.path.basename(self.filename_without_extension)}.json'
-                
+                smiles_txt_path = self.smiles_path()
                 if os.path.exists(smiles_txt_path):
-                
                     return json.load(open(smiles_txt_path, 'r'))
-                
-                
+
                 if not self.segments:
                     start = time.time()
                     await self.segment()
                     print(f"Segmentation took {time.time() - start} seconds")
 
-                
                 start = time.time()
-                for i, img in enumerate(self.segments):
-                    
-                    SMILES = self.model.predict_image(img[0])['smiles']
-                    
-                    try:
-                        chemical = pcp.get_compounds(SMILES, 'smiles')[0]
-                        cid = chemical.cid
-                        keyword = chemical.iupac_name
-                        
-                    except pcp.BadRequestError:
-                        cid = None
-                        keyword = None
-                          
-                    to_add = {
-                        'SMILES': SMILES,
-                        'page': img[1],
-                        'cid': cid,
-                        'keyword': keyword,
-                        'X': img[2][0],
-                        'Y': img[2][1],
-                        'Height': img[3],
-                        'Width': img[4],
-                        'article': img[5],
-                        'image': f'segments/{os.path.basename(self.filename_without_extension)}_{i}.png'
-                    }
-                    output.append(to_add)
-                    
-                self.smiles = output
+                recognized = self.load_recognition()
+                if recognized is None:
+                    # Recognize in a few batches at a time so progress can be reported between them
+                    images = [img[0] for img in self.segments]
+                    step = max(1, self.batch_size) * 4
+                    recognized = []
+                    memo = SegmentIndex()
+                    for chunk in range(0, len(images), step):
+                        recognized.extend(self.recognize_unique(images[chunk:chunk + step], memo))
+                        self.report('recognize', len(recognized), len(images))
+                    self.store_recognition(recognized)
+                self.report('recognize', len(recognized), len(recognized))
+                print(f"Recognition of {len(recognized)} segments took {time.time() - start} seconds")
+
+                self.report('resolve', 0, len(recognized))
+                with metrics.stage('resolve'):
+                    async with pubchem.PubChemClient() as client:
+                        chemicals = await client.resolve_many(recognized, 'smiles')
+                self.report('resolve', len(recognized), len(recognized))
+                self.build_output(recognized, chemicals)
                 end = time.time()
                 print(f"SMILES extraction took {end - start} seconds")
-                with open(smiles_txt_path, 'w') as f:
-                    json.dump(self.smiles, f)
-                
 
             return self.smiles
-        # except Exception as e:
-        #     print(e)
-        #     return None
 
 
 class TextExtractor:
-    tokenizer = AutoTokenizer.from_pretrained('pruas/BENT-PubMedBERT-NER-Chemical')
-    model = BertForTokenClassification.from_pretrained('pruas/BENT-PubMedBERT-NER-Chemical')
-
     def __init__(self, filename: str, pathtosave: str = None):
+        self._engine = None
         self.filename = filename
         self.pathtosave = pathtosave
         self.filename_without_extension = os.path.splitext(self.filename)[0]
         self.keywords = None
         self.text = None
         self.total_text = None
-        self.preprocessed_keywords = []
-    def find_all_occurrences(self,input_string, substring):
-        try:
-            occurrences = []
-            start_index = 0
-
-            while True:
-                index = input_string.find(substring, start_index)
-                if index == -1:
-                    break
-                occurrences.append(index)
-                start_index = index + 1
-            return occurrences
-        except Exception as e:
-            print(e)
-        
+        self._digest = None
+        self.progress = None
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = file_digest(self.filename)
+        return self._digest
+
+    def report(self, stage: str, done: int, total: int = None):
+        report_progress(self.progress, stage, self.filename, done, total)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            tokenizer, model = model_registry.ner()
+            self._engine = NEREngine(tokenizer, model)
+        return self._engine
 
+    def ner_version(self):
+        backend = f';backend={self.engine.backend}' if self.engine.backend != 'eager' else ''
+        return f'{NER_VERSION}{backend};window={self.engine.max_length}/{self.engine.stride}'
 
     def extract(self) -> list:
         if self.text is None:
-            self.text = extract_text_from_pdf_all_pages(self.filename)
+            with metrics.stage('text'):
+                self.text = extract_text_from_pdf_all_pages(self.filename)
             delimiter = ' '
             self.total_text = delimiter.join(self.text)
 
         return self.text
 
-    async def process_page(self, page_text):
-        
-        start = time.time()
-        # Asynchronously process a single page's keywords
-        all_keywords_with_page_number_and_index = defaultdict(list)
-        split_page = split_text(page_text, 800)
-        for text_splice in split_page:
-            inputs = self.tokenizer.encode_plus(text_splice, return_tensors="pt", add_special_tokens=True)
-            outputs = self.model(inputs.input_ids, attention_mask=inputs.attention_mask)
-            predicted_labels = torch.argmax(outputs.logits, dim=2)[0]
-            predicted_tokens = self.tokenizer.convert_ids_to_tokens(inputs.input_ids[0])
-            keywords = []
-            for token, label_idx in zip(predicted_tokens, predicted_labels):
-                    if label_idx != 0:
-                        keywords.append(token)
-            self.preprocessed_keywords.append(keywords) 
-            # combined_tokens = []
-            # for token in keywords:
-            #     if token.startswith("##") and combined_tokens:
-            #         combined_tokens[-1] += token[2:]
-            #     else:
-            #         combined_tokens.append(token)
-            
-            words =text_splice.split()
-            
-            new_keywords = []
-            for token in keywords:
-                if token.startswith("##"):
-                    partial_word = token[2:]
-                    
-                    if len(partial_word) > 2 and partial_word.isnumeric() == False:
-                       
-                       matches = filter(lambda word: partial_word in word, words)
-                       new_keywords.extend(list(matches))
-                else:
-                    new_keywords.append(token)
-
-                   
-            keywords = new_keywords
-            
-           
-            for token in keywords:
-                
-                    keyword = token.strip()
-                  
-                    if keyword in self.total_text and len(keyword)>3:
-                        
-                       
-                        
-                        start_index = self.find_all_occurrences(self.total_text, keyword)
-                        end_index = [index + len(keyword) for index in start_index]
-                        indeces = list(zip(start_index, end_index))
-
-
-                        all_keywords_with_page_number_and_index[keyword].append((
-                            keyword,
-                            self.text.index(page_text),
-                            indeces
-                            
-                        ))
-
-        flattened_keywords = [item for sublist in all_keywords_with_page_number_and_index.values() for item in sublist]
-        
-        unique_keywords = []
-        seen_keywords = set()
-
-        for entry in flattened_keywords:
-            
-            if entry[0] not in seen_keywords:
-                unique_keywords.append({
-                    "keyword": entry[0],
-                    "page": entry[1],
-                    "index": entry[2]
-                })
-                seen_keywords.add(entry[0])
-        end = time.time()
-        print(f"Page processing took {end - start} seconds")
-        return unique_keywords
-
-
-
-
+    def save_words(self):
+        # The word index highlightPDF looks keywords up in; highlighting builds it from the
+        # PDF itself when it is missing
+        path = words_path(self.filename, self.pathtosave)
+        if not os.path.exists(path):
+            WordIndex.from_pdf(self.filename).save(path)
+
+    def page_offsets(self):
+        # Start offset of every page inside total_text (pages are joined with one space)
+        offsets = []
+        position = 0
+        for page_text in self.text:
+            offsets.append(position)
+            position += len(page_text) + 1
+        return offsets
 
     async def getKeywords(self):
         start = time.time()
         if self.keywords is None:
-            text = self.extract()
-            delimiter = ' '
-            self.total_text = delimiter.join(text)
-
-            # Asynchronously process keywords for each page
-            page_tasks = [self.process_page(page) for page in text]
-            all_keywords = await asyncio.gather(*page_tasks)
+            cached = extraction_cache.get(self.digest, 'ner', self.ner_version())
+            if cached is not None:
+                self.keywords = [keyword for page in sorted(cached['pages'], key=int) for keyword in cached['pages'][page]]
+                self.report('ner', 1, 1)
+                print(f"Keyword extraction took {time.time() - start} seconds (cached)")
+                return self.keywords
+
+            self.extract()
+            page_starts = self.page_offsets()
+
+            with metrics.stage('ner'):
+                spans = self.engine.predict(self.total_text, lambda done, total: self.report('ner', done, total))
+            print(f"NER took {time.time() - start} seconds ({self.engine.forward_passes} forward passes)")
+
+            # One entry per keyword per page, in order of first appearance
+            found = []
+            for span_start, span_end in spans:
+                keyword = self.total_text[span_start:span_end].strip()
+                if len(keyword) > 3:
+                    found.append((keyword, span_start))
+
+            with metrics.stage('occurrences'):
+                occurrences = OccurrenceIndex([keyword for keyword, _ in found], self.total_text, page_starts)
+            entries = list(dict.fromkeys((keyword, occurrences.page(offset)) for keyword, offset in found))
+            self.keywords = [{
+                "keyword": keyword,
+                "page": page,
+                "index": occurrences.spans(keyword)
+            } for keyword, page in entries]
+            metrics.items_processed.labels('keywords').inc(len(self.keywords))
+
+            pages = defaultdict(list)
+            for keyword in self.keywords:
+                pages[str(keyword["page"])].append(keyword)
+            extraction_cache.put(self.digest, 'ner', self.ner_version(), {'pages': pages})
 
-            # Combine keywords from all pages
-            self.keywords = [keyword for page_keywords in all_keywords for keyword in page_keywords]
-        
         end = time.time()
         print(f"Keyword extraction took {end - start} seconds")
         return self.keywords
@@ -388,53 +1003,39 @@ class TextExtractor:
            return json.loads(open(f'{folder_path}/{subfolder}/{os.path.basename(self.filename_without_extension)}.json', 'r').read())
         if self.keywords is None:
            await self.getKeywords()
+        # Built here rather than in extract(), which testing scripts call without an output
+        # folder; keywords set directly (bench_keywords.py) may come without a PDF
+        if os.path.exists(self.filename):
+            self.save_words()
         
 
         
             
 
-        async def fetch_compound(keyword):
-            start = time.time()
-            try:
-                compound = pcp.get_compounds(keyword["keyword"], 'name')[0]
-                end = time.time()
-                print(f"Fetching compound smiles for {keyword['keyword']} took {end - start} seconds")
-                return compound
-            except pcp.PubChemHTTPError as e:
-                if hasattr(e, 'args') and len(e.args) > 0:
-                    error_name = e.args[0]
-                    if error_name == 'PUGREST.ServerBusy':
-                        print(f"Rate limit exceeded. Retrying after {e.headers['Retry-After']} seconds...")
-                        retry_after = 2
-                        await asyncio.sleep(retry_after)
-                        return await fetch_compound(keyword)
-            except (IndexError, KeyError):
-                return None
-            except Exception as e:
-                print(f"Error fetching compound smiles: {e}")
-                return None
-
-        tasks = [fetch_compound(keyword) for keyword in self.keywords]
+        # Resolve every distinct normalized name once, then fan the result out to all of its occurrences
+        names = list(dict.fromkeys(pubchem.normalize_identifier('name', keyword["keyword"]) for keyword in self.keywords))
         start = time.time()
-        filtered_compounds= await asyncio.gather(*tasks)
+        self.report('text_resolve', 0, len(names))
+        with metrics.stage('text_resolve'):
+            async with pubchem.PubChemClient() as client:
+                compounds = dict(zip(names, await client.resolve_many(names, 'name')))
+        self.report('text_resolve', len(names), len(names))
         end = time.time()
-        print(f"Fetching compound smiles took {end - start} seconds")
-        filtered_SMILES = [compound.canonical_smiles if compound is not None else None for compound in filtered_compounds]
-
-        tor = []
-        for compound in filtered_compounds:
-            SMILES =  compound.canonical_smiles if compound is not None else None
-            cid = compound.cid if compound is not None else None
-            tor.append({
-                "keyword": self.keywords[filtered_SMILES.index(SMILES)]["keyword"],
-                "SMILES": SMILES,
-                "cid": cid,
-                "page": self.keywords[filtered_SMILES.index(SMILES)]["page"],
-                "index": self.keywords[filtered_SMILES.index(SMILES)]["index"]
+        print(f"Fetching compound smiles for {len(names)} distinct names ({len(self.keywords)} keywords) took {end - start} seconds ({client.requests} requests, {client.retries} retries)")
+
+        filtered_keywords = []
+        for keyword in self.keywords:
+            compound = compounds[pubchem.normalize_identifier('name', keyword["keyword"])]
+            if compound is None or compound['canonical_smiles'] is None:
+                continue
+            filtered_keywords.append({
+                "keyword": keyword["keyword"],
+                "SMILES": compound['canonical_smiles'],
+                "cid": compound['cid'],
+                "page": keyword["page"],
+                "index": keyword["index"]
             })
 
-        filtered_keywords = [keyword for keyword in tor if keyword["SMILES"] is not None]
-
         with open(f'{folder_path}/{subfolder}/{os.path.basename(self.filename_without_extension)}.json', 'w') as f:
             json.dump(filtered_keywords, f)
 
@@ -443,215 +1044,518 @@ class TextExtractor:
         return filtered_keywords
 
 
+def _init_worker(threads: int, backend: str = None):
+    # Runs once in every BatchExtractor worker process: size the thread pools to this
+    # worker's share of the cores and load the models, with the parent's NER backend,
+    # before the first document arrives
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if backend:
+        os.environ['CHEMEXTRACT_NER_BACKEND'] = backend
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    model_registry.warm()
+
+
+class _QueueProgress:
+    # Stands in for the job in a worker process and sends its updates to the parent
+    def __init__(self, queue):
+        self.queue = queue
+
+    def update(self, stage: str, file: str, done: int, total: int = None):
+        self.queue.put((stage, file, done, total))
+
+
+def _extract_file(filename: str, pathtosave: str = None, settings: dict = None, progress=None):
+    # settings are the parent StructureExtractor's, so a worker gives the same output
+    structure = StructureExtractor(filename, pathtosave, **(settings or {}))
+    text = TextExtractor(filename, pathtosave)
+    if progress is not None:
+        structure.progress = text.progress = _QueueProgress(progress)
+    pdf_smiles = asyncio.run(structure.toSMILES())
+    text_smiles = asyncio.run(text.toSMILES())
+    return pdf_smiles, text_smiles, psutil.Process().memory_info().rss
+
+
+def _freeze(value):
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+def combine_results(pdf_results, text_results, pdf_origins, text_origins, pathtosave=None):
+    # Hash join of text hits onto structure hits by SMILES, in one pass over each. Produces
+    # text hits merged with the (last) structure of the same SMILES in text order, then
+    # every structure, then the text hits with no structure; records without a CID are
+    # dropped, the rest sorted by CID descending and exact duplicates removed, keeping
+    # the first.
+    prefix = pathtosave + "/" if pathtosave else ""
+    structures = {}
+    pdf_records = []
+    for pdf_smiles, origin in zip(pdf_results, pdf_origins):
+        for keyword in pdf_smiles:
+            record = {
+                "SMILES": keyword["SMILES"],
+                "cid": keyword["cid"],
+                "page": keyword["page"],
+                "keyword": keyword["keyword"],
+                "X": keyword["X"],
+                "Y": keyword["Y"],
+                "Height": keyword["Height"],
+                "Width": keyword["Width"],
+                "origin": origin,
+                "image": prefix + keyword["image"]
+            }
+            pdf_records.append(record)
+            if record["SMILES"] is not None:
+                structures[record["SMILES"]] = record
+
+    merged, unmatched = [], []
+    for text_smiles, origin in zip(text_results, text_origins):
+        for keyword in text_smiles:
+            structure = structures.get(keyword["SMILES"])
+            if structure is not None:
+                merged.append(dict(structure, keyword=keyword["keyword"], index=keyword["index"]))
+            else:
+                unmatched.append({
+                    "SMILES": keyword["SMILES"],
+                    "cid": keyword["cid"],
+                    "page": keyword["page"],
+                    "keyword": keyword["keyword"],
+                    "index": keyword["index"],
+                    "origin": origin
+                })
+
+    combined = [record for records in (merged, pdf_records, unmatched) for record in records if record["cid"] is not None]
+    combined.sort(key=lambda record: record["cid"], reverse=True)
+
+    seen = set()
+    output = []
+    for record in combined:
+        key = _freeze(record)
+        if key not in seen:
+            seen.add(key)
+            output.append(record)
+    return output
+
+
+# Worker threads per pipeline stage; 'render' sizes the PyMuPDF pool inside the render stage
+PIPELINE_WORKERS = {
+    'render': 2,
+    'detect': 1,
+    'recognize': 1,
+    'resolve': 4,
+    'text': 1,
+    'ner': 1,
+    'text_resolve': 2,
+}
+
+
 class BatchExtractor:
     SMILES = None
     pdf_list = []
     text_list = []
     pathtosave = None
-    def __init__(self, path: str, pathtosave: str = None):
+    def __init__(self, path: str, pathtosave: str = None, pipelined: bool = False, workers: dict = None,
+                 processes: int = 0, worker_memory: int = 4 * 1024 ** 3, progress=None, profile: bool = None, cores: int = None):
             
             print(os.path.isdir(path))
+            self.pathtosave = pathtosave
+            self.pipelined = pipelined
+            # processes > 0 spreads files over that many worker processes, capped so that
+            # every worker gets worker_memory bytes of the memory currently available
+            self.processes = processes
+            self.worker_memory = worker_memory
+            # Cores this extraction may use, normally its allocation from the scheduler;
+            # worker processes split them
+            self.cores = cores
+            self.workers = dict(PIPELINE_WORKERS, **(workers or {}))
+            self.pipeline_stats = None
+            # progress receives per-stage updates and each file's results as soon as they
+            # are ready, through update(stage, file, done, total) and add_partial(kind, file, results)
+            self.progress = progress
+            # profile=True (or CHEMEXTRACT_PROFILE=1) samples this extraction and writes
+            # PROFILE/summary.txt, summary.json and stacks.txt under pathtosave
+            self.profile = os.environ.get('CHEMEXTRACT_PROFILE') == '1' if profile is None else profile
             if os.path.isdir(path):
                 self.pdf_list = []
                 self.text_list =[]
-            
-                self.pathtosave = pathtosave
 
                 files = os.listdir(path)
                 for filename in files:
                     if filename.endswith(".pdf"):
                         print(f'{path}/{filename}')
-                        self.pdf_list.append(StructureExtractor(f'{path}/{filename}', pathtosave))
+                        self.pdf_list.append(StructureExtractor(f'{path}/{filename}', pathtosave, render_workers=self.workers['render']))
                         self.text_list.append(TextExtractor(f'{path}/{filename}', pathtosave))
             elif os.path.isfile(path):
                 if path.endswith(".pdf"):
-                    self.pdf_list = [StructureExtractor(path, pathtosave)]
+                    self.pdf_list = [StructureExtractor(path, pathtosave, render_workers=self.workers['render'])]
                     self.text_list = [TextExtractor(path, pathtosave)]
+            for extractor in self.pdf_list + self.text_list:
+                extractor.progress = progress
            
             print("hi")
 
+    def publish(self, kind: str, extractor, results):
+        if self.progress is not None:
+            self.progress.add_partial(kind, os.path.basename(extractor.filename), results)
+
     async def toSMILES(self):
         try:
-            tor = {}
-            tor["PDF_SMILES"] = []
-            tor["Text_SMILES"] = []
-
-            for extractor in self.pdf_list:
-                pdf_smiles = await extractor.toSMILES()
-                tor["PDF_SMILES"].append(pdf_smiles)  # Await the asynchronous call
-
-            for extractor in self.text_list:
-                text_smiles = await extractor.toSMILES()
-                tor["Text_SMILES"].append(text_smiles)
-
-            self.SMILES = tor
-            return tor
+            with metrics.stage('batch'), (profiling.capture(self.pathtosave or '.') if self.profile else contextlib.nullcontext()):
+                if self.processes and len(self.pdf_list) > 1:
+                    tor = await asyncio.to_thread(self.run_processes)
+                    self.SMILES = tor
+                    return tor
+
+                if self.pipelined:
+                    tor = await asyncio.to_thread(self.run_pipelines)
+                    self.SMILES = tor
+                    return tor
+
+                tor = {}
+                tor["PDF_SMILES"] = []
+                tor["Text_SMILES"] = []
+
+                for extractor in self.pdf_list:
+                    pdf_smiles = await extractor.toSMILES()
+                    tor["PDF_SMILES"].append(pdf_smiles)  # Await the asynchronous call
+                    self.publish("PDF_SMILES", extractor, pdf_smiles)
+
+                for extractor in self.text_list:
+                    text_smiles = await extractor.toSMILES()
+                    tor["Text_SMILES"].append(text_smiles)
+                    self.publish("Text_SMILES", extractor, text_smiles)
+
+                self.SMILES = tor
+                return tor
         except Exception as e:
             print(e)
             return None
 
+    def process_count(self):
+        by_memory = psutil.virtual_memory().available // self.worker_memory
+        return max(1, min(self.processes, len(self.pdf_list), by_memory, self.cores or self.processes))
+
+    def run_processes(self):
+        workers = self.process_count()
+        threads = max(1, (self.cores or os.cpu_count() or 1) // workers)
+        print(f"Extracting {len(self.pdf_list)} files on {workers} processes with {threads} threads each")
+        if self.profile:
+            print("Profiling covers this process only, the worker processes are not sampled")
+
+        tor = {"PDF_SMILES": [], "Text_SMILES": []}
+        # spawn rather than fork: TensorFlow and torch thread pools do not survive a fork
+        context = multiprocessing.get_context('spawn')
+        backend = os.environ.get('CHEMEXTRACT_NER_BACKEND', 'eager')
+        if model_registry.is_loaded('ner'):
+            backend = ner_backend.backend_name(model_registry.ner()[1])
+        # Workers put their progress updates on a queue that a thread here hands to the job
+        manager = context.Manager() if self.progress is not None else contextlib.nullcontext()
+        with manager, ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(threads, backend)) as pool:
+            updates = manager.Queue() if self.progress is not None else None
+            if updates is not None:
+                def forward():
+                    for update in iter(updates.get, None):
+                        self.progress.update(*update)
+                forwarder = threading.Thread(target=forward, daemon=True)
+                forwarder.start()
+            futures = [pool.submit(_extract_file, extractor.filename, self.pathtosave, extractor.settings(), updates) for extractor in self.pdf_list]
+            for extractor, text_extractor, future in zip(self.pdf_list, self.text_list, futures):
+                try:
+                    pdf_smiles, text_smiles, rss = future.result()
+                    print(f"{extractor.filename} done, worker rss {rss / 2**20:.0f} MiB")
+                    if rss > self.worker_memory:
+                        print(f"Worker exceeded its memory budget of {self.worker_memory / 2**20:.0f} MiB")
+                except Exception as e:
+                    print(f"Error extracting {extractor.filename}: {e}")
+                    pdf_smiles, text_smiles = [], []
+                extractor.smiles = pdf_smiles
+                tor["PDF_SMILES"].append(pdf_smiles)
+                tor["Text_SMILES"].append(text_smiles)
+                report_progress(self.progress, 'files', extractor.filename, 1, 1)
+                self.publish("PDF_SMILES", extractor, pdf_smiles)
+                self.publish("Text_SMILES", text_extractor, text_smiles)
+            if updates is not None:
+                updates.put(None)
+                forwarder.join()
+        return tor
+
+    def structure_pipeline(self, docs):
+        detections = defaultdict(dict)
+        lock = threading.Lock()
+
+        def rasterize():
+            for doc in docs:
+                extractor = self.pdf_list[doc]
+                # Pages ruled out by triage count as detected with nothing found
+                with lock:
+                    for page in extractor.page_triage():
+                        if not page['detect']:
+                            detections[doc][page['page']] = []
+                for page, img in extractor.pages():
+                    yield doc, page, img
+
+        def detect(item):
+            doc, page, img = item
+            extractor = self.pdf_list[doc]
+            found = extractor.detect(img, page)
+            with lock:
+                detections[doc][page] = found
+                extractor.report('detect', len(detections[doc]), extractor.page_count)
+            return [(doc, page, k, crop) for k, (crop, _) in enumerate(found)]
+
+        # One memo per document, as in StructureExtractor.toSMILES, so a document's results do
+        # not depend on which others share the run; across documents that is the structure
+        # store's job. A batch can straddle two documents, so it is recognized per document.
+        memos = defaultdict(SegmentIndex)
+
+        def recognize(batch):
+            smiles = {}
+            for doc in dict.fromkeys(doc for doc, _, _, _ in batch):
+                items = [item for item in batch if item[0] == doc]
+                with lock:
+                    memo = memos[doc]
+                for (_, page, k, _), SMILES in zip(items, self.pdf_list[doc].recognize_unique([crop for _, _, _, crop in items], memo)):
+                    smiles[(doc, page, k)] = SMILES
+            return [(doc, page, k, smiles[(doc, page, k)]) for doc, page, k, _ in batch]
+
+        def resolve(batch):
+            async def run():
+                async with pubchem.PubChemClient() as client:
+                    return await client.resolve_many([SMILES for _, _, _, SMILES in batch], 'smiles')
+            return [item + (chemical,) for item, chemical in zip(batch, asyncio.run(run()))]
+
+        pipeline = Pipeline(rasterize(), [
+            Stage('detect', detect, workers=self.workers['detect'], queue_size=2 * self.workers['detect']),
+            Stage('recognize', recognize, workers=self.workers['recognize'], batch_size=self.pdf_list[docs[0]].batch_size if docs else 1, queue_size=64),
+            Stage('resolve', resolve, workers=self.workers['resolve'], batch_size=32, queue_size=256),
+        ], source_name='render')
+        return pipeline, detections
+
+    def assemble_structures(self, doc, detections, results, errors):
+        # Rebuild what StructureExtractor.toSMILES would have produced, in page order
+        extractor = self.pdf_list[doc]
+        page_count = extractor.page_count
+        complete = not errors and len(detections) == page_count
+        pages = [detections.get(page, []) for page in range(page_count)]
+        extractor.store_detections(pages, cache=complete)
+
+        recognized, chemicals = [], []
+        for page, found in enumerate(pages):
+            for k in range(len(found)):
+                SMILES, chemical = results.get((page, k), (None, None))
+                recognized.append(SMILES)
+                chemicals.append(chemical)
+        if complete and len(results) == len(recognized):
+            extractor.store_recognition(recognized)
+        extractor.report('recognize', len(results), len(recognized))
+        extractor.report('resolve', len(results), len(recognized))
+        output = extractor.build_output(recognized, chemicals)
+        self.publish("PDF_SMILES", extractor, output)
+        return output
+
+    def text_pipeline(self, docs):
+        def text(doc):
+            self.text_list[doc].extract()
+            return [doc]
+
+        def ner(doc):
+            asyncio.run(self.text_list[doc].getKeywords())
+            return [doc]
+
+        def text_resolve(doc):
+            text_smiles = asyncio.run(self.text_list[doc].toSMILES())
+            self.publish("Text_SMILES", self.text_list[doc], text_smiles)
+            return [(doc, text_smiles)]
+
+        return Pipeline(iter(docs), [
+            Stage('text', text, workers=self.workers['text']),
+            Stage('ner', ner, workers=self.workers['ner']),
+            Stage('text_resolve', text_resolve, workers=self.workers['text_resolve']),
+        ], source_name='documents')
+
+    def run_pipelines(self):
+        # Documents with saved or cached structure results skip the pipeline and are read back directly
+        structure_docs = [
+            doc for doc, extractor in enumerate(self.pdf_list)
+            if not os.path.exists(extractor.smiles_path())
+            and not extraction_cache.contains(extractor.digest, 'detection', extractor.detection_version())
+        ]
+        structure, detections = self.structure_pipeline(structure_docs)
+        text = self.text_pipeline(list(range(len(self.text_list))))
+
+        structure.start()
+        text.start()
+        structure_results = structure.join()
+        text_results = dict(text.join())
+
+        by_doc = defaultdict(dict)
+        for doc, page, k, SMILES, chemical in structure_results:
+            by_doc[doc][(page, k)] = (SMILES, chemical)
+        errors = sum(len(stage.errors) for stage in [structure.source] + structure.stages)
+
+        tor = {"PDF_SMILES": [], "Text_SMILES": []}
+        for doc, extractor in enumerate(self.pdf_list):
+            if doc in structure_docs:
+                tor["PDF_SMILES"].append(self.assemble_structures(doc, detections[doc], by_doc[doc], errors))
+            else:
+                tor["PDF_SMILES"].append(asyncio.run(extractor.toSMILES()))
+                self.publish("PDF_SMILES", extractor, tor["PDF_SMILES"][-1])
+        for doc, extractor in enumerate(self.text_list):
+            tor["Text_SMILES"].append(text_results.get(doc) or [])
+
+        self.pipeline_stats = {'structure': structure.stats(), 'text': text.stats()}
+        for name, stats in self.pipeline_stats.items():
+            print(f"{name} pipeline took {stats['wall_seconds']:.2f} seconds")
+            for stage, stage_stats in stats.items():
+                if stage != 'wall_seconds':
+                    print(f"  {stage}: {stage_stats['items']} items, {stage_stats['busy_seconds']:.2f}s busy, {stage_stats['utilization']:.0%} utilized")
+        return tor
+
 
 
     async def combine(self):
         try:
             if self.SMILES is None:
                 await self.toSMILES()
-            
-            folder_path = 'SMILES'
-            subfolder = 'COMBINED_SMILES'
-            print("hi")
-            if not os.path.exists(f'{folder_path}/{subfolder}'):
-                os.makedirs(f'{self.pathtosave}/{folder_path}/{subfolder}')
-            print("hi")
-            if os.path.exists(f'{self.pathtosave}/{folder_path}/{subfolder}/OUTPUT.json'):
-                return json.loads(open(f'{self.pathtosave}/{folder_path}/{subfolder}/OUTPUT.json', 'r').read())
-
-            pdf_canonical_smiles = []
-            text_canonical_smiles = []
-            pdf_canonical_smiles = [{"SMILES": keyword["SMILES"],"cid": keyword["cid"],"page": keyword["page"],"keyword": keyword["keyword"],"X": keyword["X"],"Y": keyword["Y"],"Height" :keyword["Height"], "Width" : keyword["Width"]  , "origin": self.pdf_list[self.SMILES["PDF_SMILES"].index(pdf_smiles)].filename_without_extension,"image": keyword["image"]} for pdf_smiles in self.SMILES["PDF_SMILES"] for keyword in pdf_smiles]
-
-            text_canonical_smiles = [{ "SMILES": keyword["SMILES"],"keyword": keyword["keyword"],"cid": keyword["cid"],"page": keyword["page"],"index": keyword["index"],"origin": self.text_list[self.SMILES["Text_SMILES"].index(text_smiles)].filename_without_extension} for text_smiles in self.SMILES["Text_SMILES"] for keyword in text_smiles]
-            final_list = []
-            pdf_smiles_map = {entry["SMILES"]: entry for entry in pdf_canonical_smiles if entry["SMILES"] is not None}
-            print(":3")
-            for text_smiles in text_canonical_smiles:
-                if text_smiles["SMILES"] in pdf_smiles_map:
-                    pdf_entry = pdf_smiles_map[text_smiles["SMILES"]]
-                    final_entry = {
-                        "SMILES": pdf_entry["SMILES"],
-                        "cid": pdf_entry["cid"],
-                        "page": pdf_entry["page"],
-                        "keyword": text_smiles["keyword"],
-                        "X": pdf_entry["X"],
-                        "Y": pdf_entry["Y"],
-                        "Height": pdf_entry["Height"],
-                        "Width": pdf_entry["Width"],
-                        "origin": pdf_entry["origin"],
-                        "image": self.pathtosave + "/" + pdf_entry["image"] if self.pathtosave else pdf_entry["image"]
-                    }
-                    if "index" in text_smiles:
-                        final_entry["index"] = text_smiles["index"]
-                    final_list.append(final_entry)
-
-                
-
-            
-                # Create a list comprehension to filter out text_smiles not present in final_list
-            text_canonical_smiles = [text_smiles for text_smiles in text_canonical_smiles if text_smiles["SMILES"] not in [smiles["SMILES"] for smiles in final_list]]
-            print(":3")
-            for pdf_smiles in pdf_canonical_smiles:
-                if  self.pathtosave:
-                    final_list.append({
-                        "SMILES": pdf_smiles["SMILES"],
-                        "cid": pdf_smiles["cid"],
-                        "page": pdf_smiles["page"],
-                        "keyword": pdf_smiles["keyword"],
-                        "X": pdf_smiles["X"],
-                        "Y": pdf_smiles["Y"],
-                        "Height": pdf_smiles["Height"],
-                        "Width": pdf_smiles["Width"],
-                        "origin": pdf_smiles["origin"],
-                        "image": self.pathtosave + "/"+ pdf_smiles["image"],
-                    })
-                else:
-                    final_list.append({
-                        "SMILES": pdf_smiles["SMILES"],
-                        "cid": pdf_smiles["cid"],
-                        "page": pdf_smiles["page"],
-                        "keyword": pdf_smiles["keyword"],
-                        "X": pdf_smiles["X"],
-                        "Y": pdf_smiles["Y"],
-                        "Height": pdf_smiles["Height"],
-                        "Width": pdf_smiles["Width"],
-                        "origin": pdf_smiles["origin"],
-                        "image": pdf_smiles["image"]
-                    })
-
-            
-            
-            for text_smiles in text_canonical_smiles:
-                final_list.append({
-                    "SMILES": text_smiles["SMILES"],
-                    "cid": text_smiles["cid"],
-                    "page": text_smiles["page"],
-                    "keyword": text_smiles["keyword"],
-                    "index": text_smiles["index"],
-                    "origin": text_smiles["origin"]
-                })
-            
-            final_list = [item for item in final_list if item['cid'] is not None]
-            print(":3")
-
-            sorted_data_by_cid = sorted(final_list, key=lambda x: x.get('cid', float('-inf')), reverse=True)
 
-            print(":3")
-            
-            try: 
-                sorted_data_by_cid = tuple(sorted_data_by_cid)
-            except Exception as e:
-                print(e)
-
-            try: 
-                sorted_data_by_cid = list(unique_everseen(sorted_data_by_cid))
-                print(sorted_data_by_cid)
-            except Exception as e:
-                print(e)
-            
-            with open(f'{self.pathtosave}/{folder_path}/{subfolder}/OUTPUT.json', 'w') as f:
-                json.dump(final_list, f)
+            folder_path = self.pathtosave + '/' + 'SMILES' if self.pathtosave else 'SMILES'
+            subfolder = 'COMBINED_SMILES'
+            os.makedirs(f'{folder_path}/{subfolder}', exist_ok=True)
+            if os.path.exists(f'{folder_path}/{subfolder}/OUTPUT.json'):
+                return json.loads(open(f'{folder_path}/{subfolder}/OUTPUT.json', 'r').read())
 
-            return sorted_data_by_cid
+            start = time.time()
+            with metrics.stage('combine'):
+                combined = combine_results(
+                    self.SMILES["PDF_SMILES"], self.SMILES["Text_SMILES"],
+                    [extractor.filename_without_extension for extractor in self.pdf_list],
+                    [extractor.filename_without_extension for extractor in self.text_list],
+                    self.pathtosave,
+                )
+            print(f"Combining {len(combined)} records took {time.time() - start} seconds")
+
+            with open(f'{folder_path}/{subfolder}/OUTPUT.json', 'w') as f:
+                json.dump(combined, f)
+
+            return combined
         except Exception as e:
             print(e)
             return None
-def highlightPDF(userfolder, keyword):
-    for filename in os.listdir(userfolder):
-        print("hi")
-        if filename.endswith('.pdf'):  # Check if the file is a PDF
-            pdf_path = os.path.join(userfolder, filename)
-            try:
-                pdf_document = fitz.open(pdf_path)
-                for page_number in range(len(pdf_document)):
-                    page = pdf_document.load_page(page_number)
-                    text_instances = page.search_for(keyword)
-                    try:
-                        for inst in text_instances:
-                            highlight = page.add_highlight_annot(inst)
-
-                    except ValueError as e:
-                        print(f"Error adding highlight annotation to page {page_number + 1} of {filename}: {e}")
-                pdf_document.save(os.path.join(userfolder, "highlighted_" + filename))
-                pdf_document.close()
-            except Exception as e:
-                print(f"Error processing PDF file {filename}: {e}")
-def highlightPDFImage(userfolder, X,Y,Height,Width,page):
-    for filename in os.listdir(userfolder):
-        print("hi")
-        if filename.endswith('.pdf'):  # Check if the file is a PDF
-            pdf_path = os.path.join(userfolder, filename)
-            try:
-                pdf_document = fitz.open(pdf_path)
-                
-
-                pdf_page = pdf_document.load_page(int(page))
-                try:
-                   
-                    highlight = pdf_page.add_rect_annot([X,Y,X+Width,Y+Height])
-
-                except ValueError as e:
-                    print(f"Error adding highlight annotation to page { page + 1} of {filename}: {e}")
-                pdf_document.save(os.path.join(userfolder, "highlighted_" + filename))
-                pdf_document.close()
-            except Exception as e:
-                print(f"Error processing PDF file {filename}: {e}")
-
-                        
-            
-                        
-
 
 
+HIGHLIGHT_AUTHOR = 'ChemExtract'
+_word_indexes = {}
+_highlight_locks = defaultdict(threading.Lock)
+_highlight_lock = threading.Lock()
 
 
+def word_index(userfolder, pdf_path):
+    # Loads the index written at extraction time (building it for folders extracted
+    # before it existed) and keeps the most recently used ones in memory
+    path = words_path(pdf_path, userfolder)
+    with _highlight_lock:
+        index = _word_indexes.pop(path, None)
+    if index is None:
+        if os.path.exists(path):
+            index = WordIndex.load(path)
+        else:
+            index = WordIndex.from_pdf(pdf_path)
+            index.save(path)
+    with _highlight_lock:
+        _word_indexes[path] = index
+        while len(_word_indexes) > 32:
+            _word_indexes.pop(next(iter(_word_indexes)))
+    return index
+
+
+def highlight_documents(userfolder, origin=None):
+    # The uploaded PDFs, never the highlighted_ copies; origin narrows it to one document
+    names = [name for name in sorted(os.listdir(userfolder)) if name.endswith('.pdf') and not name.startswith('highlighted_')]
+    if origin:
+        names = [name for name in names if os.path.splitext(name)[0] == os.path.basename(origin)]
+    return [os.path.join(userfolder, name) for name in names]
+
+
+def annotate(userfolder, pdf_path, marks):
+    # Replaces the annotations of the previous call in highlighted_<file>.pdf with marks,
+    # a list of (page, rect, kind) where kind is 'highlight' or 'rect'. Only the pages
+    # involved are touched and the file is saved incrementally; it is recopied from the
+    # original once the appended revisions make it twice the original size.
+    filename = os.path.basename(pdf_path)
+    output = os.path.join(userfolder, "highlighted_" + filename)
+    state_path = os.path.join(userfolder, 'WORDS', os.path.splitext(filename)[0] + '.highlighted.json')
+    with _highlight_lock:
+        lock = _highlight_locks[output]
+    with lock:
+        previous = []
+        if os.path.exists(output) and os.path.getsize(output) <= 2 * os.path.getsize(pdf_path) + 2 ** 20:
+            if os.path.exists(state_path):
+                with open(state_path, 'r') as f:
+                    previous = json.load(f)
+        else:
+            shutil.copyfile(pdf_path, output)
+
+        pdf_document = fitz.open(output)
+        for page_number in previous:
+            page = pdf_document.load_page(page_number)
+            for annot in list(page.annots()):
+                if annot.info.get('title') == HIGHLIGHT_AUTHOR:
+                    page.delete_annot(annot)
+        for page_number, rect, kind in marks:
+            page = pdf_document.load_page(page_number)
+            try:
+                annot = page.add_highlight_annot(fitz.Rect(rect)) if kind == 'highlight' else page.add_rect_annot(fitz.Rect(rect))
+                annot.set_info(title=HIGHLIGHT_AUTHOR)
+                annot.update()
+            except ValueError as e:
+                print(f"Error adding highlight annotation to page {page_number + 1} of {filename}: {e}")
+
+        if pdf_document.can_save_incrementally():
+            pdf_document.saveIncr()
+            pdf_document.close()
+        else:
+            staging = output + '.tmp'
+            pdf_document.save(staging)
+            pdf_document.close()
+            os.replace(staging, output)
+
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path, 'w') as f:
+            json.dump(sorted({page for page, _, _ in marks}), f)
+
+
+@metrics.stage('highlight')
+def highlightPDF(userfolder, keyword, origin=None):
+    # Returns the highlighted word rects as [{"origin", "page", "rects"}] for the frontend
+    # to overlay, and writes them to highlighted_<file>.pdf
+    highlights = []
+    for pdf_path in highlight_documents(userfolder, origin):
+        try:
+            matches = word_index(userfolder, pdf_path).find(keyword, pdf_path)
+            annotate(userfolder, pdf_path, [(page, rect, 'highlight') for page, rects in matches for rect in rects])
+            base = os.path.splitext(pdf_path)[0]
+            highlights.extend({"origin": base, "page": page, "rects": rects} for page, rects in matches)
+        except Exception as e:
+            print(f"Error processing PDF file {pdf_path}: {e}")
+    return highlights
 
 
+@metrics.stage('highlight_image')
+def highlightPDFImage(userfolder, X, Y, Height, Width, page, origin=None):
+    highlights = []
+    try:
+        X, Y, Height, Width, page = float(X), float(Y), float(Height), float(Width), int(page)
+    except ValueError as e:
+        print(f"Error reading structure box: {e}")
+        return highlights
+    rect = [X, Y, X + Width, Y + Height]
+    for pdf_path in highlight_documents(userfolder, origin):
+        try:
+            annotate(userfolder, pdf_path, [(page, rect, 'rect')])
+            highlights.append({"origin": os.path.splitext(pdf_path)[0], "page": page, "rects": [rect]})
+        except Exception as e:
+            print(f"Error processing PDF file {pdf_path}: {e}")
+    return highlights
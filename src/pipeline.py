@@ -0,0 +1,150 @@
+import time
+import queue
+import threading
+import contextvars
+
+
+_DONE = object()
+
+
+class Stage:
+    # One step of a Pipeline. fn takes an item (or a list of up to batch_size items when
+    # batch_size > 1) and returns an iterable of items for the next stage. Each stage runs
+    # on its own worker threads and reads from a bounded queue, so a slow stage blocks
+    # the ones feeding it instead of letting work pile up in memory.
+    def __init__(self, name: str, fn, workers: int = 1, batch_size: int = 1, queue_size: int = 8):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.items = 0
+        self.calls = 0
+        self.busy = 0.0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def record(self, items, seconds):
+        with self._lock:
+            self.items += items
+            self.calls += 1
+            self.busy += seconds
+
+    def stats(self, wall):
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'calls': self.calls,
+            'busy_seconds': self.busy,
+            'utilization': self.busy / (wall * self.workers) if wall else 0.0,
+            'errors': len(self.errors),
+        }
+
+
+class Pipeline:
+    def __init__(self, source, stages: list, source_name: str = 'source'):
+        # source is an iterable of input items, drained on its own thread; the time spent
+        # producing items is reported under source_name like any other stage
+        self.source = Stage(source_name, None)
+        self._source = source
+        self.stages = stages
+        self.results = []
+        self.wall = 0.0
+        self._threads = []
+        self._queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+        self._remaining = [stage.workers for stage in stages]
+        self._lock = threading.Lock()
+        self._started = None
+
+    def _put(self, index, item):
+        if index < len(self._queues):
+            self._queues[index].put(item)
+        elif item is not _DONE:
+            with self._lock:
+                self.results.append(item)
+
+    def _feed(self):
+        iterator = iter(self._source)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                self.source.record(1, time.time() - start)
+                self._put(0, item)
+        except Exception as e:
+            print(f"{self.source.name} failed: {e}")
+            self.source.errors.append(e)
+        finally:
+            self._put(0, _DONE)
+
+    def _take(self, index):
+        # Blocks for the first item, then fills the batch with whatever is already queued
+        stage = self.stages[index]
+        first = self._queues[index].get()
+        if first is _DONE:
+            return None
+        batch = [first]
+        while len(batch) < stage.batch_size:
+            try:
+                item = self._queues[index].get(timeout=0.05)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                self._queues[index].put(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _work(self, index):
+        stage = self.stages[index]
+        while True:
+            batch = self._take(index)
+            if batch is None:
+                break
+            start = time.time()
+            try:
+                outputs = list(stage.fn(batch if stage.batch_size > 1 else batch[0]))
+            except Exception as e:
+                print(f"{stage.name} failed: {e}")
+                stage.errors.append(e)
+                outputs = []
+            stage.record(len(batch), time.time() - start)
+            for output in outputs:
+                self._put(index + 1, output)
+
+        # Let sibling workers see the end of the stream; the last one forwards it downstream
+        self._queues[index].put(_DONE)
+        with self._lock:
+            self._remaining[index] -= 1
+            last = self._remaining[index] == 0
+        if last:
+            self._put(index + 1, _DONE)
+
+    def start(self):
+        self._started = time.time()
+        # Every thread runs in a copy of the caller's context, so context variables such as
+        # the profiling session follow the work onto them
+        self._threads = [threading.Thread(target=contextvars.copy_context().run, args=(self._feed,), name=self.source.name, daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                self._threads.append(threading.Thread(target=contextvars.copy_context().run, args=(self._work, index), name=f'{stage.name}-{worker}', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+        self.wall = time.time() - self._started
+        return self.results
+
+    def run(self):
+        return self.start().join()
+
+    def stats(self):
+        stats = {stage.name: stage.stats(self.wall) for stage in [self.source] + self.stages}
+        stats['wall_seconds'] = self.wall
+        return stats
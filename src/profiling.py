@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager, nullcontext
+from collections import Counter, defaultdict
+
+# Opt-in profiling of one extraction. While capture() is active a sampler thread reads the
+# stack of every thread that is inside a metrics.stage() block, so samples are attributed
+# to stages even when the pipeline runs them on worker threads, and model calls wrapped in
+# torch_ops() record op-level timings. The session belongs to the extraction that started
+# it: it is held in a context variable, so concurrent extractions in the same process do
+# not record into each other's profile. Threads do not inherit context variables, so code
+# that hands work to other threads runs it in contextvars.copy_context() (see
+# pipeline.Pipeline and render_pages). When nothing is being captured, current() is None
+# and the hooks cost a single lookup.
+
+_session = contextvars.ContextVar('profile_session', default=None)
+# The torch profiler is process-wide, so only one model call at a time records ops
+_torch_lock = threading.Lock()
+
+
+class ProfileSession:
+    def __init__(self, folder: str, interval: float = 0.005, torch_ops: bool = True, top: int = 25):
+        self.folder = folder
+        self.interval = interval
+        self.torch_ops = torch_ops
+        self.top = top
+        self.stages = {}
+        self.samples = Counter()
+        self.self_counts = defaultdict(Counter)
+        self.cumulative_counts = defaultdict(Counter)
+        self.stage_samples = Counter()
+        self.ops = defaultdict(lambda: defaultdict(lambda: [0, 0.0, 0.0]))
+        self._ops_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self.started = None
+        self.wall = 0.0
+
+    def enter(self, stage: str):
+        self.stages.setdefault(threading.get_ident(), []).append(stage)
+
+    def exit(self):
+        stack = self.stages.get(threading.get_ident())
+        if stack:
+            stack.pop()
+
+    def current_stage(self):
+        stack = self.stages.get(threading.get_ident())
+        return stack[-1] if stack else 'other'
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                try:
+                    stage = self.stages[ident][-1]
+                except (KeyError, IndexError):
+                    continue
+                if ident == me:
+                    continue
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.stage_samples[stage] += 1
+                self.self_counts[stage][functions[0]] += 1
+                for function in set(functions):
+                    self.cumulative_counts[stage][function] += 1
+                self.samples[';'.join([stage] + functions[::-1])] += 1
+
+    def record_ops(self, stage, profile):
+        with self._ops_lock:
+            for event in profile.key_averages():
+                totals = self.ops[stage][event.key]
+                totals[0] += event.count
+                totals[1] += event.self_cpu_time_total
+                totals[2] += event.cpu_time_total
+
+    def start(self):
+        self.started = time.time()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.wall = time.time() - self.started
+
+    def top_ops(self, stage):
+        ops = [{'op': op, 'count': count, 'self_cpu_us': self_cpu, 'cpu_us': cpu} for op, (count, self_cpu, cpu) in self.ops.get(stage, {}).items()]
+        return sorted(ops, key=lambda op: op['self_cpu_us'], reverse=True)[:self.top]
+
+    def summary(self):
+        stages = {}
+        for stage in [stage for stage, _ in self.stage_samples.most_common()] + [stage for stage in self.ops if stage not in self.stage_samples]:
+            count = self.stage_samples[stage]
+            stages[stage] = {
+                'samples': count,
+                'approx_seconds': count * self.interval,
+                'self': self.self_counts[stage].most_common(self.top),
+                'cumulative': self.cumulative_counts[stage].most_common(self.top),
+                'torch_ops': self.top_ops(stage),
+            }
+        return {'wall_seconds': self.wall, 'interval_seconds': self.interval, 'stages': stages}
+
+    def write(self):
+        folder = os.path.join(self.folder, 'PROFILE')
+        os.makedirs(folder, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(folder, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        # One "stage;outer;...;inner count" line per distinct stack, the input format of
+        # flamegraph.pl and speedscope
+        with open(os.path.join(folder, 'stacks.txt'), 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        with open(os.path.join(folder, 'summary.txt'), 'w') as f:
+            f.write(f"wall {summary['wall_seconds']:.2f}s, sampled every {self.interval * 1000:.0f} ms\n")
+            for stage, stats in summary['stages'].items():
+                f.write(f"\n{stage}: {stats['samples']} samples (~{stats['approx_seconds']:.2f}s)\n")
+                for function, count in stats['self'][:10]:
+                    f.write(f"  {count:>7} self  {function}\n")
+                for op in stats['torch_ops'][:10]:
+                    f.write(f"  {op['self_cpu_us'] / 1000:>7.1f} ms  {op['op']} x{op['count']}\n")
+        return folder
+
+
+def current():
+    return _session.get()
+
+
+@contextmanager
+def capture(folder: str, interval: float = 0.005, torch_ops: bool = True):
+    # Profiles the extraction run inside the block and writes PROFILE/ under folder; a
+    # capture nested in another is skipped
+    if _session.get() is not None:
+        print("A profile is already being captured, not profiling this extraction")
+        yield None
+        return
+
+    session = ProfileSession(folder, interval, torch_ops)
+    token = _session.set(session)
+    session.start()
+    try:
+        yield session
+    finally:
+        session.stop()
+        _session.reset(token)
+        print(f"Profile written to {session.write()}")
+
+
+def torch_ops():
+    # Wrap model calls with this; records torch op timings into the active session
+    session = _session.get()
+    if session is None or not session.torch_ops:
+        return nullcontext()
+    return _torch_ops(session)
+
+
+@contextmanager
+def _torch_ops(current):
+    # Calls that overlap one already being recorded on another thread run unrecorded
+    if not _torch_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        from torch.profiler import profile, ProfilerActivity
+        stage = current.current_stage()
+        with profile(activities=[ProfilerActivity.CPU]) as prof:
+            yield
+        current.record_ops(stage, prof)
+    finally:
+        _torch_lock.release()
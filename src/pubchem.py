@@ -0,0 +1,402 @@
+import os
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+import aiohttp
+import metrics
+from sqlite_cache import SQLiteCache
+
+
+PUG_REST = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug'
+
+PROPERTIES = [
+    'cid',
+    'iupac_name',
+    'molecular_formula',
+    'molecular_weight',
+    'canonical_smiles',
+    'isomeric_smiles',
+    'xlogp',
+    'exact_mass',
+    'charge',
+    'complexity',
+]
+
+
+# PUG REST property names for PROPERTIES; PubChem now answers Canonical/IsomericSMILES
+# requests with ConnectivitySMILES/SMILES, so both spellings are accepted
+REST_PROPERTIES = {
+    'iupac_name': ('IUPACName',),
+    'molecular_formula': ('MolecularFormula',),
+    'molecular_weight': ('MolecularWeight',),
+    'canonical_smiles': ('CanonicalSMILES', 'ConnectivitySMILES'),
+    'isomeric_smiles': ('IsomericSMILES', 'SMILES'),
+    'xlogp': ('XLogP',),
+    'exact_mass': ('ExactMass',),
+    'charge': ('Charge',),
+    'complexity': ('Complexity',),
+}
+
+
+def rest_properties(row: dict) -> dict:
+    properties = {'cid': row['CID']}
+    for name, keys in REST_PROPERTIES.items():
+        properties[name] = next((row[key] for key in keys if key in row), None)
+    return properties
+
+
+def normalize_identifier(namespace: str, identifier) -> str:
+    # PubChem name search is case-insensitive, so names differing only in case share one lookup
+    identifier = ' '.join(str(identifier).split())
+    return identifier.lower() if namespace == 'name' else identifier
+
+
+class ResolutionCache(SQLiteCache):
+    # SQLite-backed cache for name -> CID, SMILES -> CID and CID -> properties.
+    # A lookup stored with cid NULL is a negative entry (PubChem had no match) and
+    # expires after negative_ttl instead of ttl. Each table is trimmed to max_entries
+    # rows, dropping the least recently accessed first.
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS seeds (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS lookups (
+            namespace TEXT NOT NULL,
+            identifier TEXT NOT NULL,
+            cid INTEGER,
+            fetched REAL NOT NULL,
+            accessed REAL NOT NULL,
+            PRIMARY KEY (namespace, identifier)
+        );
+        CREATE TABLE IF NOT EXISTS compounds (
+            cid INTEGER PRIMARY KEY,
+            properties TEXT NOT NULL,
+            fetched REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS lookups_accessed ON lookups (accessed);
+        CREATE INDEX IF NOT EXISTS compounds_accessed ON compounds (accessed);
+    '''
+    TABLES = ('lookups', 'compounds')
+
+    def __init__(self, path: str, ttl: float = 30 * 24 * 3600, negative_ttl: float = 24 * 3600, max_entries: int = 200000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        super().__init__(path, max_entries)
+
+    def get_cid(self, namespace: str, identifier):
+        # Returns (found, cid); found with cid None means a cached miss
+        identifier = normalize_identifier(namespace, identifier)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT cid, fetched FROM lookups WHERE namespace = ? AND identifier = ?',
+                (namespace, identifier)).fetchone()
+            if row is None or now - row[1] > (self.ttl if row[0] is not None else self.negative_ttl):
+                self._count(False)
+                return False, None
+            self._db.execute(
+                'UPDATE lookups SET accessed = ? WHERE namespace = ? AND identifier = ?',
+                (now, namespace, identifier))
+            self._count(True)
+            return True, row[0]
+
+    def put_cid(self, namespace: str, identifier, cid):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)',
+                (namespace, normalize_identifier(namespace, identifier), cid, now, now))
+            self._trim()
+
+    def get_properties(self, cid):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT properties, fetched FROM compounds WHERE cid = ?', (cid,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self._count(False)
+                return None
+            self._db.execute('UPDATE compounds SET accessed = ? WHERE cid = ?', (now, cid))
+            self._count(True)
+            return json.loads(row[0])
+
+    def put_properties(self, properties: dict):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO compounds VALUES (?, ?, ?, ?)',
+                (properties['cid'], json.dumps(properties), now, now))
+            self._trim()
+
+    def reserve_token(self, name: str, rate: float, capacity: float) -> float:
+        # One TokenBucket.reserve() against the bucket stored in this database. The write
+        # transaction locks the file, so every process using it draws on the same tokens.
+        with self._lock:
+            db = self._db
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = db.execute('SELECT tokens, updated FROM rate_limits WHERE name = ?', (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                tokens -= 1
+                db.execute('INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)', (name, tokens, max(now, row[1]) if row else now))
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        return max(0.0, -tokens / rate)
+
+    def seed(self, path: str, force: bool = False) -> int:
+        # JSON Lines, one compound per line: the PROPERTIES fields plus optional
+        # "names" and "smiles" lists that should resolve to it. A file already loaded into
+        # this database, unchanged since, is skipped unless force is set.
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime FROM seeds WHERE path = ?', (path,)).fetchone()
+        if row is not None and tuple(row) == (stat.st_size, stat.st_mtime) and not force:
+            print(f"{path} is already seeded into {self.path}")
+            return 0
+        count = 0
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                properties = {name: record.get(name) for name in PROPERTIES}
+                self.put_properties(properties)
+                for name in record.get('names', []):
+                    self.put_cid('name', name, properties['cid'])
+                smiles = set(record.get('smiles', []))
+                smiles.update(s for s in (properties['canonical_smiles'], properties['isomeric_smiles']) if s)
+                for s in smiles:
+                    self.put_cid('smiles', s, properties['cid'])
+                count += 1
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO seeds VALUES (?, ?, ?)', (path, stat.st_size, stat.st_mtime))
+        print(f"Seeded {count} compounds from {path} into {self.path}")
+        return count
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'lookups': self._db.execute('SELECT COUNT(*) FROM lookups').fetchone()[0],
+                'compounds': self._db.execute('SELECT COUNT(*) FROM compounds').fetchone()[0],
+            }
+
+
+# Kept with the extraction cache rather than in whatever directory the server was started from
+resolution_cache = ResolutionCache(os.environ.get('CHEMEXTRACT_PUBCHEM_DB') or os.path.join(os.environ.get('CHEMEXTRACT_CACHE_DIR', 'extraction_cache'), 'pubchem', 'pubchem_cache.sqlite3'))
+metrics.register_cache('pubchem', resolution_cache)
+
+
+def seed_from_environment():
+    # Loads CHEMEXTRACT_PUBCHEM_SEED; called once by whatever starts the server (the
+    # gunicorn master, app.py's __main__), not by every process importing this module
+    if os.environ.get('CHEMEXTRACT_PUBCHEM_SEED'):
+        resolution_cache.seed(os.environ['CHEMEXTRACT_PUBCHEM_SEED'])
+
+
+class PubChemError(Exception):
+    pass
+
+
+class TokenBucket:
+    # Shared by every client in the process, so the limit holds across concurrent
+    # extractions. Callers may overdraw the bucket; they then sleep until their slot.
+    # With a cache the tokens are kept in its database instead, so the limit also holds
+    # across processes: gunicorn workers and the extraction process pool.
+    def __init__(self, rate: float, capacity: float, cache: ResolutionCache = None, name: str = 'pubchem'):
+        self.rate = rate
+        self.capacity = capacity
+        self.cache = cache
+        self.name = name
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        if self.cache is not None:
+            try:
+                return self.cache.reserve_token(self.name, self.rate, self.capacity)
+            except sqlite3.Error as e:
+                # Rate limit on this process's own tokens rather than fail the request
+                print(f"Error reserving a shared token: {e}")
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+# PubChem allows at most 5 requests per second per host, however many processes send them
+rate_limiter = TokenBucket(rate=5, capacity=5, cache=resolution_cache)
+
+
+class PubChemClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str = None, limiter: TokenBucket = None, cache: ResolutionCache = None,
+                 max_retries: int = 4, backoff: float = 0.5, timeout: float = 30, connections: int = 10, chunk_size: int = 100):
+        self.base_url = (base_url or os.environ.get('CHEMEXTRACT_PUBCHEM_URL', PUG_REST)).rstrip('/')
+        self.limiter = limiter or rate_limiter
+        self.cache = cache or resolution_cache
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.connections = connections
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.retries = 0
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.session = None
+
+    async def _post(self, path: str, data: dict):
+        # Returns parsed JSON, or None when PubChem reports no match (404) or rejects the input (400)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            self.requests += 1
+            retry_after = None
+            try:
+                async with self.session.post(f'{self.base_url}/{path}', data=data) as response:
+                    metrics.pubchem_requests.labels(str(response.status)).inc()
+                    if response.status == 200:
+                        return await response.json(content_type=None)
+                    if response.status in (400, 404):
+                        return None
+                    if response.status not in self.RETRY_STATUSES:
+                        raise PubChemError(f'{response.status} from {path}: {await response.text()}')
+                    retry_after = response.headers.get('Retry-After')
+                    error = PubChemError(f'{response.status} from {path}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.pubchem_requests.labels('connection_error').inc()
+                error = e
+
+            if attempt == self.max_retries:
+                break
+            self.retries += 1
+            metrics.pubchem_retries.inc()
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * 2 ** attempt
+            await asyncio.sleep(delay * random.uniform(1, 1.25))
+        raise PubChemError(f'giving up on {path} after {self.max_retries + 1} attempts: {error}')
+
+    async def cid(self, identifier, namespace: str):
+        result = await self._post(f'compound/{namespace}/cids/JSON', {namespace: identifier})
+        cids = result['IdentifierList']['CID'] if result else []
+        # SMILES searches answer 0 for structures PubChem does not know
+        return cids[0] if cids and cids[0] else None
+
+    async def properties(self, cids, return_exceptions: bool = True) -> dict:
+        # CIDs whose chunk failed after retries are left out, and not cached; with
+        # return_exceptions False the first such failure is raised instead
+        properties = {}
+        missing = []
+        for cid in dict.fromkeys(cids):
+            cached = self.cache.get_properties(cid)
+            if cached is None:
+                missing.append(cid)
+            else:
+                properties[cid] = cached
+
+        names = ','.join(key for keys in REST_PROPERTIES.values() for key in keys[:1])
+        chunks = [missing[i:i + self.chunk_size] for i in range(0, len(missing), self.chunk_size)]
+        results = await asyncio.gather(*(
+            self._post(f'compound/cid/property/{names}/JSON', {'cid': ','.join(map(str, chunk))}) for chunk in chunks
+        ), return_exceptions=True)
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                if not return_exceptions:
+                    raise result
+                print(f"Error fetching properties of {len(chunk)} CIDs: {result}")
+                continue
+            for row in (result or {}).get('PropertyTable', {}).get('Properties', []):
+                fetched = rest_properties(row)
+                self.cache.put_properties(fetched)
+                properties[fetched['cid']] = fetched
+        return properties
+
+    async def resolve_many(self, identifiers, namespace: str) -> list:
+        # Returns one properties dict (or None) per identifier, in order. Identifiers whose
+        # lookup failed after retries resolve to None and are left out of the cache.
+        identifiers = [normalize_identifier(namespace, identifier) for identifier in identifiers]
+        cids = {}
+        pending = []
+        for identifier in dict.fromkeys(identifiers):
+            found, cid = self.cache.get_cid(namespace, identifier)
+            if found:
+                cids[identifier] = cid
+            else:
+                pending.append(identifier)
+
+        looked_up = await asyncio.gather(*(self.cid(identifier, namespace) for identifier in pending), return_exceptions=True)
+        for identifier, cid in zip(pending, looked_up):
+            if isinstance(cid, Exception):
+                print(f"Error resolving {identifier}: {cid}")
+                continue
+            self.cache.put_cid(namespace, identifier, cid)
+            cids[identifier] = cid
+
+        properties = await self.properties(cid for cid in cids.values() if cid is not None)
+        return [properties.get(cids.get(identifier)) for identifier in identifiers]
+
+    async def resolve(self, identifier, namespace: str):
+        return (await self.resolve_many([identifier], namespace))[0]
+
+
+async def _resolve(identifier, namespace):
+    async with PubChemClient() as client:
+        return await client.resolve(identifier, namespace)
+
+
+async def _get_properties(cid):
+    async with PubChemClient() as client:
+        # Raises PubChemError when PubChem cannot be reached, so callers can tell it from a missing CID
+        return (await client.properties([cid], return_exceptions=False)).get(cid)
+
+
+def resolve(identifier, namespace: str):
+    return asyncio.run(_resolve(identifier, namespace))
+
+
+def get_properties(cid):
+    return asyncio.run(_get_properties(int(cid)))
+
+
+if __name__ == '__main__':
+    # python pubchem.py seed compounds.jsonl
+    import argparse
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    seed_parser = commands.add_parser('seed', help='load compounds from a JSON Lines file into the resolution cache')
+    seed_parser.add_argument('path')
+    seed_parser.add_argument('--force', action='store_true', help='load the file even if it was loaded before')
+    args = parser.parse_args()
+    resolution_cache.seed(args.path, force=args.force)
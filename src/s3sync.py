@@ -0,0 +1,137 @@
+import os
+import json
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from extraction_cache import file_digest
+import metrics
+
+
+MANIFEST = '.s3manifest.json'
+
+
+class S3Sync:
+    # Incremental upload of a local folder to S3. A manifest kept inside the folder records
+    # size, mtime and SHA-256 of every file as last uploaded; a file is only re-uploaded
+    # when its size or mtime changed and its hash no longer matches. One boto3 client is
+    # shared by a pool of upload threads, and files over multipart_threshold go up in
+    # parts. Files deleted locally are dropped from the manifest but left in the bucket.
+    def __init__(self, bucket: str, client=None, workers: int = 8, multipart_threshold: int = 8 * 1024 ** 2,
+                 multipart_chunksize: int = 8 * 1024 ** 2):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        self.bucket = bucket
+        self.client = client or boto3.client('s3')
+        self.config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize, max_concurrency=4)
+        self.uploads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-upload')
+        self.background = ThreadPoolExecutor(max_workers=2, thread_name_prefix='s3-sync')
+        self.uploaded = 0
+        self.skipped = 0
+        self.bytes = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def folder_lock(self, folder):
+        with self._lock:
+            return self._locks.setdefault(os.path.abspath(folder), threading.Lock())
+
+    @staticmethod
+    def scan(folder):
+        files = {}
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, folder).replace(os.sep, '/')
+                if rel == MANIFEST:
+                    continue
+                stat = os.stat(path)
+                files[rel] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        return files
+
+    def load_manifest(self, folder, prefix):
+        try:
+            with open(os.path.join(folder, MANIFEST), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('bucket') != self.bucket or manifest.get('prefix') != prefix:
+            return {}
+        return manifest['files']
+
+    def save_manifest(self, folder, prefix, files):
+        path = os.path.join(folder, MANIFEST)
+        staging = f'{path}.{uuid.uuid4().hex}'
+        with open(staging, 'w') as f:
+            json.dump({'bucket': self.bucket, 'prefix': prefix, 'files': files}, f)
+        os.replace(staging, path)
+
+    def upload(self, folder, rel, key):
+        self.client.upload_file(os.path.join(folder, rel), self.bucket, key, Config=self.config)
+
+    def sync(self, folder: str, prefix: str = None):
+        # prefix defaults to the folder path itself, which is where upload_folder_to_s3 has
+        # always put things; returns how many files were uploaded and skipped
+        prefix = folder if prefix is None else prefix
+        with self.folder_lock(folder):
+            previous = self.load_manifest(folder, prefix)
+            current = self.scan(folder)
+            scanned = len(current)
+
+            changed = []
+            for rel, entry in current.items():
+                old = previous.get(rel)
+                if old is not None and old['size'] == entry['size'] and old['mtime_ns'] == entry['mtime_ns']:
+                    entry['sha256'] = old['sha256']
+                    continue
+                entry['sha256'] = file_digest(os.path.join(folder, rel))
+                if old is None or old['sha256'] != entry['sha256']:
+                    changed.append(rel)
+
+            futures = {rel: self.uploads.submit(self.upload, folder, rel, f'{prefix}/{rel}') for rel in changed}
+            failed = []
+            for rel, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error uploading {rel} to s3://{self.bucket}/{prefix}/{rel}: {e}")
+                    failed.append(rel)
+                    # Keep the old entry, if any, so the file is retried on the next sync
+                    if rel in previous:
+                        current[rel] = previous[rel]
+                    else:
+                        del current[rel]
+
+            self.save_manifest(folder, prefix, current)
+
+        uploaded = [rel for rel in changed if rel not in failed]
+        stats = {
+            'uploaded': len(uploaded),
+            'skipped': scanned - len(changed),
+            'failed': len(failed),
+            'bytes': sum(current[rel]['size'] for rel in uploaded),
+        }
+        with self._lock:
+            self.uploaded += stats['uploaded']
+            self.skipped += stats['skipped']
+            self.bytes += stats['bytes']
+        for result in ('uploaded', 'skipped', 'failed'):
+            metrics.s3_files.labels(result).inc(stats[result])
+        metrics.s3_uploaded_bytes.inc(stats['bytes'])
+        return stats
+
+    def sync_in_background(self, folder: str, prefix: str = None):
+        # Nobody waits on the future, so failures are logged here rather than lost with it
+        def report(future):
+            error = future.exception()
+            if error is not None:
+                print(f"Error syncing {folder} to s3://{self.bucket}: {error!r}")
+            elif future.result()['failed']:
+                print(f"{future.result()['failed']} files of {folder} failed to upload to s3://{self.bucket}; they are retried on the next sync")
+
+        future = self.background.submit(self.sync, folder, prefix)
+        future.add_done_callback(report)
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {'uploaded': self.uploaded, 'skipped': self.skipped, 'bytes': self.bytes}
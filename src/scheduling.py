@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class CoreScheduler:
+    # Gives every extraction a budget of cores and runs only as many at once as the
+    # machine has room for; the rest wait in arrival order. torch, TensorFlow and OpenCV
+    # size their thread pools per process rather than per thread, so all jobs in a process
+    # get the same budget and the pools are sized to it. Without this each library would
+    # start one thread per core and two concurrent extractions would oversubscribe the CPU.
+    def __init__(self, cores: int = None, cores_per_job: int = None):
+        self.running = OrderedDict()
+        self.waiting = OrderedDict()
+        # listener(allocated, waiting) is called on every change, e.g. to update metrics
+        self.listeners = []
+        self._condition = threading.Condition()
+        self.resize(cores, cores_per_job)
+
+    def resize(self, cores: int = None, cores_per_job: int = None):
+        # Defaults to all cores, split between two concurrent extractions
+        with self._condition:
+            self.cores = max(1, cores or os.cpu_count() or 1)
+            self.cores_per_job = max(1, min(self.cores, cores_per_job or self.cores // 2))
+            self._condition.notify_all()
+
+    @property
+    def slots(self):
+        return self.cores // self.cores_per_job
+
+    def configure(self):
+        # Call before torch or TensorFlow is imported: their pools read these at start-up
+        threads = str(self.cores_per_job)
+        for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+            os.environ.setdefault(name, threads)
+        os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+    def configure_tensorflow(self, tf):
+        # TensorFlow fixes its pools when it first runs an op, so this only works before then
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(self.cores_per_job)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+        except RuntimeError as e:
+            print(f"TensorFlow threads already set: {e}")
+
+    def apply_threads(self, cores: int):
+        # torch and OpenCV can be resized at any time, but only process-wide
+        import torch
+        torch.set_num_threads(cores)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+        import cv2
+        cv2.setNumThreads(cores)
+
+    def allocated(self):
+        return sum(allocation['cores'] for allocation in self.running.values())
+
+    def _changed(self):
+        # Called with the condition held
+        for listener in self.listeners:
+            listener(self.allocated(), len(self.waiting))
+
+    @contextmanager
+    def allocate(self, job_id: str):
+        # Blocks until it is this job's turn and its cores are free; yields the core count
+        requested = time.time()
+        with self._condition:
+            self.waiting[job_id] = requested
+            self._changed()
+            while next(iter(self.waiting)) != job_id or self.allocated() + self.cores_per_job > self.cores:
+                self._condition.wait()
+            del self.waiting[job_id]
+            cores = self.cores_per_job
+            self.running[job_id] = {'cores': cores, 'since': time.time(), 'waited': time.time() - requested}
+            self._changed()
+            # The next job in line may fit as well
+            self._condition.notify_all()
+        try:
+            self.apply_threads(cores)
+            yield cores
+        finally:
+            with self._condition:
+                self.running.pop(job_id, None)
+                self._changed()
+                self._condition.notify_all()
+
+    def allocation(self, job_id: str):
+        with self._condition:
+            if job_id in self.running:
+                return dict(self.running[job_id], state='running')
+            if job_id in self.waiting:
+                return {'state': 'waiting', 'position': list(self.waiting).index(job_id) + 1, 'since': self.waiting[job_id]}
+            return None
+
+    def snapshot(self):
+        with self._condition:
+            return {
+                'cores': self.cores,
+                'cores_per_job': self.cores_per_job,
+                'slots': self.slots,
+                'allocated': self.allocated(),
+                'running': [dict(allocation, job=job_id) for job_id, allocation in self.running.items()],
+                'waiting': [{'job': job_id, 'since': since} for job_id, since in self.waiting.items()],
+            }
+
+
+scheduler = CoreScheduler(int(os.environ.get('CHEMEXTRACT_CORES', 0)) or None, int(os.environ.get('CHEMEXTRACT_CORES_PER_JOB', 0)) or None)
@@ -0,0 +1,66 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteCache:
+    # Plumbing shared by the SQLite-backed caches (pubchem.ResolutionCache,
+    # structure_store.StructureStore): a connection per process behind a lock, hit and miss
+    # counts for metrics, and trimming of TABLES to max_entries rows, least recently
+    # accessed first. Subclasses set SCHEMA and TABLES; every table in TABLES needs an
+    # accessed column.
+    SCHEMA = ''
+    TABLES = ()
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        # metrics.register_cache sets this to on_lookup(stage, hit)
+        self.on_lookup = None
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _count(self, hit: bool):
+        # Called with the lock held
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.on_lookup is not None:
+            self.on_lookup('', hit)
+
+    def _connect(self):
+        # The schema is created on every new connection because a ':memory:' database
+        # starts empty in each process
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(self.SCHEMA)
+        self._pid = os.getpid()
+
+    @property
+    def _db(self):
+        # A SQLite connection must not be used across fork(), so a worker forked from a
+        # preloading master opens its own on first use
+        if self._pid != os.getpid():
+            self._connect()
+        return self._connection
+
+    def _trim(self):
+        # Called with the lock held after a write. Counting rows is cheap but not free, so
+        # only check every 100 writes
+        self._puts += 1
+        if self._puts % 100:
+            return
+        for table in self.TABLES:
+            count = self._db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            if count > self.max_entries:
+                self._drop_oldest(table, count - self.max_entries)
+
+    def _drop_oldest(self, table: str, count: int):
+        self._db.execute(f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY accessed LIMIT ?)', (count,))
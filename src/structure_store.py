@@ -0,0 +1,148 @@
+import time
+import threading
+from collections import defaultdict, namedtuple
+import numpy as np
+from sqlite_cache import SQLiteCache
+
+
+HASH_VERSION = 'phash-2'
+THUMBNAIL_SIZE = 64
+BANDS = 8
+# Largest distance() between two crops treated as the same drawing. Re-rendering a drawing
+# at another position or resolution stays under about 15; changing one atom label (OH to
+# NH) moves it above 20.
+MAX_DISTANCE = 16
+
+Signature = namedtuple('Signature', ['aspect', 'bands', 'thumbnail'])
+
+
+def segment_signature(image) -> Signature:
+    # Normalizes a structure crop (grayscale, trimmed to its ink, padded to a square and
+    # scaled to THUMBNAIL_SIZE) and computes a 64-bit perceptual hash of it: the sign of the
+    # 8x8 lowest DCT frequencies against their median. Near-duplicates share most hash
+    # bits but not necessarily all of them, so the hash is split into BANDS bands used only
+    # to find candidates; whether two crops are the same drawing is decided on the
+    # thumbnails by distance().
+    import cv2
+    gray = image if image.ndim == 2 else cv2.cvtColor(np.ascontiguousarray(image[:, :, :3]), cv2.COLOR_RGB2GRAY)
+    ink = np.argwhere(gray < 200)
+    if len(ink):
+        (y0, x0), (y1, x1) = ink.min(axis=0), ink.max(axis=0) + 1
+        gray = gray[y0:y1, x0:x1]
+    height, width = gray.shape
+    side = max(height, width, 1)
+    square = np.full((side, side), 255, np.uint8)
+    square[(side - height) // 2:(side - height) // 2 + height, (side - width) // 2:(side - width) // 2 + width] = gray
+    thumbnail = cv2.GaussianBlur(cv2.resize(square, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA), (3, 3), 0)
+    low = cv2.dct(cv2.resize(thumbnail, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))[:8, :8].flatten()
+    bits = np.packbits(low > np.median(low[1:]))
+    aspect = int(round(4 * np.log2(max(width, 1) / max(height, 1))))
+    return Signature(aspect, [int(value) for value in bits], thumbnail)
+
+
+def distance(a, b) -> float:
+    # Strongest local difference between two thumbnails: differences along every edge from
+    # resampling are faint and spread out, a changed label or bond is a dense patch
+    import cv2
+    return float(cv2.blur(np.abs(a.astype(np.float32) - b.astype(np.float32)), (5, 5)).max())
+
+
+class SegmentIndex:
+    # In-memory near-duplicate index for one document. Each entry holds the SMILES of one
+    # distinct drawing; an entry added before its drawing is recognized is pending until
+    # ready is set, and callers that find it wait for it.
+    def __init__(self):
+        self.buckets = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def find(self, signature: Signature):
+        best, best_distance = None, MAX_DISTANCE
+        seen = set()
+        for band, value in enumerate(signature.bands):
+            for entry in self.buckets[(signature.aspect, band, value)]:
+                if id(entry) in seen:
+                    continue
+                seen.add(id(entry))
+                d = distance(signature.thumbnail, entry['thumbnail'])
+                if d <= best_distance:
+                    best, best_distance = entry, d
+        return best
+
+    def add(self, signature: Signature, smiles=None, pending: bool = False):
+        entry = {'thumbnail': signature.thumbnail, 'smiles': smiles, 'ready': threading.Event()}
+        if not pending:
+            entry['ready'].set()
+        for band, value in enumerate(signature.bands):
+            self.buckets[(signature.aspect, band, value)].append(entry)
+        return entry
+
+
+class StructureStore(SQLiteCache):
+    # SQLite map from drawing to recognized SMILES, shared by every document and request,
+    # so a drawing recognized once (a common reagent or scaffold) skips MolScribe in later
+    # papers. Matching works as in SegmentIndex; entries are keyed by the recognition
+    # version as well, and trimmed to max_entries, least recently used first.
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS structures (
+            id INTEGER PRIMARY KEY,
+            version TEXT NOT NULL,
+            thumbnail BLOB NOT NULL,
+            smiles TEXT,
+            accessed REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS bands (
+            version TEXT NOT NULL,
+            aspect INTEGER NOT NULL,
+            band INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            structure INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS bands_lookup ON bands (version, aspect, band, value);
+        CREATE INDEX IF NOT EXISTS bands_structure ON bands (structure);
+        CREATE INDEX IF NOT EXISTS structures_accessed ON structures (accessed);
+    '''
+    TABLES = ('structures',)
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        super().__init__(path, max_entries)
+
+    def get(self, signature: Signature, version: str):
+        # Returns (found, smiles)
+        with self._lock:
+            candidates = set()
+            for band, value in enumerate(signature.bands):
+                candidates.update(row[0] for row in self._db.execute(
+                    'SELECT structure FROM bands WHERE version = ? AND aspect = ? AND band = ? AND value = ?',
+                    (version, signature.aspect, band, value)))
+            best, best_distance = None, MAX_DISTANCE
+            for structure in candidates:
+                row = self._db.execute('SELECT thumbnail, smiles FROM structures WHERE id = ?', (structure,)).fetchone()
+                if row is None:
+                    continue
+                thumbnail = np.frombuffer(row[0], np.uint8).reshape(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+                d = distance(signature.thumbnail, thumbnail)
+                if d <= best_distance:
+                    best, best_distance = (structure, row[1]), d
+            if best is None:
+                self._count(False)
+                return False, None
+            self._count(True)
+            self._db.execute('UPDATE structures SET accessed = ? WHERE id = ?', (time.time(), best[0]))
+            return True, best[1]
+
+    def put(self, signature: Signature, smiles, version: str):
+        with self._lock:
+            cursor = self._db.execute('INSERT INTO structures (version, thumbnail, smiles, accessed) VALUES (?, ?, ?, ?)',
+                                      (version, np.ascontiguousarray(signature.thumbnail, np.uint8).tobytes(), smiles, time.time()))
+            self._db.executemany('INSERT INTO bands VALUES (?, ?, ?, ?, ?)',
+                                 [(version, signature.aspect, band, value, cursor.lastrowid) for band, value in enumerate(signature.bands)])
+            self._trim()
+
+    def _drop_oldest(self, table: str, count: int):
+        oldest = [row[0] for row in self._db.execute('SELECT id FROM structures ORDER BY accessed LIMIT ?', (count,))]
+        self._db.executemany('DELETE FROM bands WHERE structure = ?', [(structure,) for structure in oldest])
+        self._db.executemany('DELETE FROM structures WHERE id = ?', [(structure,) for structure in oldest])
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': self._db.execute('SELECT COUNT(*) FROM structures').fetchone()[0]}
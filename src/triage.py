@@ -0,0 +1,102 @@
+import fitz
+from collections import Counter
+import numpy as np
+
+
+TRIAGE_VERSION = 'triage-1'
+
+
+class PageTriage:
+    # Decides from PyMuPDF metadata which pages could hold a chemical structure, so that
+    # text-only pages are neither rasterized nor passed to the Mask R-CNN. Structures are
+    # either vector line art (bonds at an angle) or embedded images, so a page with neither
+    # is skipped; pages with only tiny images (icons) are skipped too. Drawings and images
+    # at the same spot on most pages (journal logos, header rules) are page furniture and
+    # do not count. With thumbnails=True, pages whose only evidence is a raster image are
+    # rendered at a low resolution and skipped when there is almost no ink outside the text
+    # blocks. Anything the checks cannot rule out, scanned pages included, is kept.
+    def __init__(self, min_strokes: int = 4, min_image_side: float = 24, scanned_coverage: float = 0.8,
+                 thumbnails: bool = False, thumbnail_dpi: int = 36, min_ink: float = 0.002):
+        self.min_strokes = min_strokes
+        self.min_image_side = min_image_side
+        self.scanned_coverage = scanned_coverage
+        self.thumbnails = thumbnails
+        self.thumbnail_dpi = thumbnail_dpi
+        self.min_ink = min_ink
+
+    def version(self):
+        return f'{TRIAGE_VERSION};strokes={self.min_strokes};image={self.min_image_side};thumbnails={self.thumbnails};ink={self.min_ink}'
+
+    def pages(self, file_path: str):
+        # One {'page', 'detect', 'reason', ...counts} dict per page, in page order
+        with fitz.open(file_path) as doc:
+            drawings = [self.drawings(page) for page in doc]
+            images = [self.images(page) for page in doc]
+            furniture = self.furniture([[key for key, _ in found] for found in drawings]) | self.furniture(images)
+            return [
+                self.page(page, sum(count for key, count in page_drawings if key not in furniture), [key for key in page_images if key not in furniture])
+                for page, page_drawings, page_images in zip(doc, drawings, images)
+            ]
+
+    @staticmethod
+    def furniture(pages):
+        # Rects present on more than half of the pages of a document of 3 or more pages
+        if len(pages) < 3:
+            return set()
+        counts = Counter(key for keys in pages for key in set(keys))
+        return {key for key, count in counts.items() if count > len(pages) / 2}
+
+    def images(self, page):
+        rects = [fitz.Rect(info['bbox']) & page.rect for info in page.get_image_info()]
+        return [tuple(round(v) for v in rect) for rect in rects if min(rect.width, rect.height) >= self.min_image_side]
+
+    def page(self, page, strokes, images):
+        area = abs(page.rect) or 1
+        images = [fitz.Rect(key) for key in images]
+        coverage = sum(abs(rect) for rect in images) / area
+        has_text = bool(page.get_text('text').strip())
+        result = {'page': page.number, 'strokes': strokes, 'images': len(images), 'image_coverage': round(coverage, 3)}
+
+        if not has_text and images:
+            return dict(result, detect=True, reason='scanned page')
+        if coverage >= self.scanned_coverage:
+            return dict(result, detect=True, reason='page-sized image')
+        if strokes >= self.min_strokes:
+            return dict(result, detect=True, reason=f'{strokes} vector strokes')
+        if images:
+            if self.thumbnails:
+                ink = self.ink_outside_text(page)
+                result['ink'] = round(ink, 4)
+                if ink < self.min_ink:
+                    return dict(result, detect=False, reason='thumbnail: no drawing outside text')
+            return dict(result, detect=True, reason=f'{len(images)} images')
+        if strokes:
+            return dict(result, detect=False, reason=f'only {strokes} vector strokes')
+        return dict(result, detect=False, reason='no images or drawings')
+
+    @staticmethod
+    def drawings(page):
+        # (rect, segments) for each path with a line at an angle, or a stroked curve. A ring
+        # is partly horizontal or vertical, so all of such a path's segments count; table
+        # rules, underlines and frames have no angled line and are ignored, as are filled
+        # curves, which are mostly text drawn as outlines.
+        found = []
+        for path in page.get_drawings():
+            lines = [item for item in path['items'] if item[0] in ('l', 'c')]
+            angled = any(
+                item[0] == 'l' and abs(item[2].x - item[1].x) > 0.1 * abs(item[2].y - item[1].y) and abs(item[2].y - item[1].y) > 0.1 * abs(item[2].x - item[1].x)
+                for item in lines
+            ) or (path['type'] != 'f' and any(item[0] == 'c' for item in lines))
+            if angled:
+                found.append((tuple(round(v) for v in path['rect']), len(lines)))
+        return found
+
+    def ink_outside_text(self, page):
+        # Fraction of dark thumbnail pixels once the text blocks are blanked out
+        pix = page.get_pixmap(dpi=self.thumbnail_dpi, colorspace=fitz.csGRAY, alpha=False)
+        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width).copy()
+        scale = self.thumbnail_dpi / 72
+        for x0, y0, x1, y1, _, _, block_type in page.get_text('blocks'):
+            if block_type == 0:
+                img[int(y0 * scale):int(np.ceil(y1 * scale)), int(x0 * scale):int(np.ceil(x1 * scale))] = 255
+        return float((img < 128).mean())
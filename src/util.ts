@@ -3,6 +3,17 @@ import { goto } from '$app/navigation';
 
 export let data = [];
 
+// The backend serves many users at once, so every request names the job it is about.
+// The id comes back from /extract and is kept for the session, across page reloads.
+export function currentJob(): string | null {
+  return sessionStorage.getItem('job');
+}
+
+function jobQuery(): string {
+  const job = currentJob();
+  return job ? `?job=${encodeURIComponent(job)}` : '';
+}
+
 
 
 
@@ -66,6 +77,9 @@ export async function postPDFs(files: FileList) {
 
     const data = await response.json();
     console.log(data);
+    if (data.job) {
+      sessionStorage.setItem('job', data.job);
+    }
     return data
   } catch (error) {
     console.error('Error sending request:', error);
@@ -73,7 +87,7 @@ export async function postPDFs(files: FileList) {
 }
 
 export async function getSmilesData() {
-  const response = await fetch('http://127.0.0.1:5000/load_smiles_data' , {
+  const response = await fetch(`http://127.0.0.1:5000/load_smiles_data${jobQuery()}` , {
     method: 'GET',
     credentials: 'include',
   });
@@ -84,7 +98,7 @@ export async function getSmilesData() {
 }
 
 export async function getPubchemData() {
-  const response = await fetch('http://127.0.0.1:5000/load_pubchempy_data' , {
+  const response = await fetch(`http://127.0.0.1:5000/load_pubchempy_data${jobQuery()}` , {
 
     method: 'GET',
     credentials: 'include',
@@ -107,7 +121,7 @@ export async function sendData(chemical_info: ChemicalInfo) {
     headers: {
       'Content-Type': 'application/json'
     },
-    body: JSON.stringify(chemical_info)
+    body: JSON.stringify({ ...chemical_info, job: currentJob() })
   });
 
   goto('/info')
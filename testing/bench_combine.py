@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import zlib
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from pdfextract import combine_results
+
+# Scaling benchmark for BatchExtractor.combine on synthetic results. Checks the hash join
+# against the merge it replaced (kept below as reference_combine) while that one still
+# finishes in reasonable time.
+# Usage: python testing/bench_combine.py --sizes 1000 10000 100000 --reference-max 10000
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='total structure + text records')
+parser.add_argument('--docs', type=int, default=10)
+parser.add_argument('--reference-max', type=int, default=10000, help='largest size to also run the old merge on')
+args = parser.parse_args()
+
+
+def synthetic_results(size, docs, seed=0):
+    # Half structure hits, half text hits, over a pool of SMILES shared between them so
+    # that roughly a third of the text hits join; some repeats and missing CIDs included
+    rng = random.Random(seed)
+    pool = [f'C{"C" * (i % 30)}O{i}' for i in range(max(1, size // 4))]
+    pdf_results = [[] for _ in range(docs)]
+    text_results = [[] for _ in range(docs)]
+    for i in range(size // 2):
+        doc = rng.randrange(docs)
+        SMILES = rng.choice(pool) if rng.random() < 0.9 else None
+        cid = zlib.crc32(SMILES.encode()) % 100000 if SMILES is not None and rng.random() < 0.95 else None
+        pdf_results[doc].append({
+            'SMILES': SMILES, 'page': rng.randrange(30), 'cid': cid, 'keyword': None,
+            'X': rng.random() * 500, 'Y': rng.random() * 700, 'Height': 50.0, 'Width': 80.0,
+            'article': f'file_{doc}', 'image': f'segments/file_{doc}_{i}.png',
+        })
+    for i in range(size // 2):
+        doc = rng.randrange(docs)
+        SMILES = rng.choice(pool) if rng.random() < 0.35 else f'N{i}'
+        record = {'keyword': f'name-{i % 5000}', 'SMILES': SMILES, 'cid': zlib.crc32(SMILES.encode()) % 100000, 'page': rng.randrange(30), 'index': [[i, i + 8]]}
+        text_results[doc].append(record)
+        if rng.random() < 0.05:
+            text_results[doc].append(dict(record))
+    origins = [f'temp_files_bench/file_{doc}' for doc in range(docs)]
+    return pdf_results, text_results, origins
+
+
+def reference_combine(pdf_results, text_results, origins, pathtosave):
+    # The merge as it was before the hash join, with self.* replaced by arguments
+    SMILES = {"PDF_SMILES": pdf_results, "Text_SMILES": text_results}
+    pdf_canonical_smiles = [{"SMILES": keyword["SMILES"], "cid": keyword["cid"], "page": keyword["page"], "keyword": keyword["keyword"], "X": keyword["X"], "Y": keyword["Y"], "Height": keyword["Height"], "Width": keyword["Width"], "origin": origins[SMILES["PDF_SMILES"].index(pdf_smiles)], "image": keyword["image"]} for pdf_smiles in SMILES["PDF_SMILES"] for keyword in pdf_smiles]
+    text_canonical_smiles = [{"SMILES": keyword["SMILES"], "keyword": keyword["keyword"], "cid": keyword["cid"], "page": keyword["page"], "index": keyword["index"], "origin": origins[SMILES["Text_SMILES"].index(text_smiles)]} for text_smiles in SMILES["Text_SMILES"] for keyword in text_smiles]
+    final_list = []
+    pdf_smiles_map = {entry["SMILES"]: entry for entry in pdf_canonical_smiles if entry["SMILES"] is not None}
+    for text_smiles in text_canonical_smiles:
+        if text_smiles["SMILES"] in pdf_smiles_map:
+            pdf_entry = pdf_smiles_map[text_smiles["SMILES"]]
+            final_entry = {"SMILES": pdf_entry["SMILES"], "cid": pdf_entry["cid"], "page": pdf_entry["page"], "keyword": text_smiles["keyword"], "X": pdf_entry["X"], "Y": pdf_entry["Y"], "Height": pdf_entry["Height"], "Width": pdf_entry["Width"], "origin": pdf_entry["origin"], "image": pathtosave + "/" + pdf_entry["image"]}
+            if "index" in text_smiles:
+                final_entry["index"] = text_smiles["index"]
+            final_list.append(final_entry)
+    text_canonical_smiles = [text_smiles for text_smiles in text_canonical_smiles if text_smiles["SMILES"] not in [smiles["SMILES"] for smiles in final_list]]
+    for pdf_smiles in pdf_canonical_smiles:
+        final_list.append({"SMILES": pdf_smiles["SMILES"], "cid": pdf_smiles["cid"], "page": pdf_smiles["page"], "keyword": pdf_smiles["keyword"], "X": pdf_smiles["X"], "Y": pdf_smiles["Y"], "Height": pdf_smiles["Height"], "Width": pdf_smiles["Width"], "origin": pdf_smiles["origin"], "image": pathtosave + "/" + pdf_smiles["image"]})
+    for text_smiles in text_canonical_smiles:
+        final_list.append({"SMILES": text_smiles["SMILES"], "cid": text_smiles["cid"], "page": text_smiles["page"], "keyword": text_smiles["keyword"], "index": text_smiles["index"], "origin": text_smiles["origin"]})
+    final_list = [item for item in final_list if item['cid'] is not None]
+    sorted_data_by_cid = sorted(final_list, key=lambda x: x.get('cid', float('-inf')), reverse=True)
+    # unique_everseen on dicts: they are unhashable, so it falls back to a list scan
+    deduped = []
+    for item in sorted_data_by_cid:
+        if item not in deduped:
+            deduped.append(item)
+    return deduped
+
+
+for size in args.sizes:
+    pdf_results, text_results, origins = synthetic_results(size, args.docs)
+
+    start = time.time()
+    combined = combine_results(pdf_results, text_results, origins, origins, 'temp_files_bench')
+    elapsed = time.time() - start
+    line = f"{size:>7} records: hash join {elapsed:8.3f}s, {len(combined)} combined"
+
+    if size <= args.reference_max:
+        start = time.time()
+        expected = reference_combine(pdf_results, text_results, origins, 'temp_files_bench')
+        line += f", old merge {time.time() - start:8.3f}s"
+        assert combined == expected, 'combine_results differs from the old merge'
+    print(line)
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Regression benchmark for keyword resolution on a keyword-heavy document: every name
+# appears on many pages, so TextExtractor.toSMILES should make one lookup per distinct
+# name instead of one per keyword entry. Runs against the local PubChem stub. The
+# extractor is given its keywords directly and has no PDF behind it, so toSMILES must not
+# need one (no word index is written).
+# Usage: python testing/bench_keywords.py --pages 40 --names 50 --latency 0.02
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pages', type=int, default=40)
+parser.add_argument('--names', type=int, default=50)
+parser.add_argument('--latency', type=float, default=0.02, help='simulated PubChem response time in seconds')
+parser.add_argument('--rate', type=float, default=5, help='requests per second allowed by the limiter')
+args = parser.parse_args()
+
+from pubchem_stub import start_stub, synthetic_compounds
+
+stub = start_stub(synthetic_compounds(args.names), latency=args.latency)
+os.environ['CHEMEXTRACT_PUBCHEM_URL'] = stub.url
+os.environ['CHEMEXTRACT_PUBCHEM_DB'] = ':memory:'
+
+import pubchem
+from pdfextract import TextExtractor
+
+pubchem.rate_limiter = pubchem.TokenBucket(args.rate, args.rate)
+
+random.seed(0)
+keywords = []
+for page in range(args.pages):
+    for i in random.sample(range(args.names), k=min(args.names, 30)):
+        name = f'compound-{i}'
+        keywords.append({'keyword': name.upper() if page % 3 == 0 else name, 'page': page, 'index': [[page, i]]})
+print(f"{len(keywords)} keyword entries, {args.names} distinct names, {args.pages} pages")
+
+
+async def per_keyword():
+    # What toSMILES used to do: one uncached lookup per keyword entry
+    cache = pubchem.ResolutionCache(':memory:', ttl=-1, negative_ttl=-1)
+    async with pubchem.PubChemClient(cache=cache) as client:
+        for keyword in keywords:
+            await client.resolve(keyword['keyword'], 'name')
+    return client.requests
+
+
+with tempfile.TemporaryDirectory() as folder:
+    extractor = TextExtractor(os.path.join(folder, 'synthetic.pdf'), folder)
+    extractor.keywords = keywords
+
+    start = time.time()
+    before = stub.requests
+    results = asyncio.run(extractor.toSMILES())
+    deduped = time.time() - start
+    deduped_requests = stub.requests - before
+    assert not os.path.exists(os.path.join(folder, 'WORDS')), 'a word index was written without a PDF'
+
+for keyword, result in zip(keywords, results):
+    assert result['page'] == keyword['page'] and result['index'] == keyword['index'], (keyword, result)
+print(f"deduplicated: {deduped:.2f}s, {deduped_requests} requests, {len(results)} results")
+
+if len(keywords) / args.rate < 120:
+    start = time.time()
+    requests = asyncio.run(per_keyword())
+    print(f"per-keyword:  {time.time() - start:.2f}s, {requests} requests")
+else:
+    print(f"per-keyword:  skipped, would take at least {len(keywords) / args.rate:.0f}s at {args.rate} requests/s")
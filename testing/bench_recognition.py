@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from pdfextract import StructureExtractor, model_registry
+
+# Compares per-image MolScribe recognition with the batched predict_images path on CPU.
+# Usage: python testing/bench_recognition.py testing/research.pdf --batch-sizes 1 8 16 32
+
+parser = argparse.ArgumentParser()
+parser.add_argument('pdf', nargs='?', default=os.path.join(os.path.dirname(__file__), 'research.pdf'))
+parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 16, 32])
+parser.add_argument('--repeat', type=int, default=1, help='tile the segments to simulate larger SI files')
+parser.add_argument('--threads', type=int, default=None)
+args = parser.parse_args()
+
+if args.threads:
+    torch.set_num_threads(args.threads)
+
+model_registry.warm(['molscribe', 'mrcnn'])
+
+with tempfile.TemporaryDirectory() as folder:
+    extractor = StructureExtractor(args.pdf, folder)
+    asyncio.run(extractor.segment())
+    images = [segment[0] for segment in extractor.segments] * args.repeat
+
+print(f"{len(images)} segments, torch threads: {torch.get_num_threads()}")
+if not images:
+    sys.exit("no segments found in " + args.pdf)
+
+baseline = None
+for batch_size in args.batch_sizes:
+    extractor.batch_size = batch_size
+    start = time.time()
+    smiles = extractor.recognize(images)
+    elapsed = time.time() - start
+    if baseline is None:
+        baseline = smiles
+    agreement = sum(a == b for a, b in zip(baseline, smiles)) / len(images)
+    mode = 'per-image' if batch_size == 1 else f'batch={batch_size}'
+    print(f"{mode:>10}: {elapsed:.2f}s, {len(images) / elapsed:.2f} segments/s, agreement {agreement:.0%}")
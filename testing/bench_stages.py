@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Per-stage benchmark on generated PDFs: rendering, detection, recognition, NER, occurrence
+# search, PubChem resolution against the local stub, combine and highlighting. Each stage
+# runs --repeat times from a cold extraction cache; results are written as JSON, and
+# --compare prints the ratio against an earlier result file. Exits with status 1 if any
+# stage failed, including an extraction step that only logged its error.
+# Usage: python testing/bench_stages.py --stub-models --pages 20 --structures 4 --keyword-density 0.05
+#        python testing/bench_stages.py --stub-models --dpi 100 --crop-dpi 300
+#        python testing/bench_stages.py --stub-models --compare testing/bench_results/<commit>.json
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pages', type=int, default=10)
+parser.add_argument('--structures', type=int, default=2, help='structures drawn per page')
+parser.add_argument('--keyword-density', type=float, default=0.05, help='fraction of words that are chemical names')
+parser.add_argument('--names', type=int, default=50, help='distinct chemical names')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--dpi', type=int, default=200, help='detection render resolution')
+parser.add_argument('--crop-dpi', type=int, default=None, help='re-render detected boxes at this resolution for recognition')
+parser.add_argument('--stages', nargs='+', default=None, help='run only these stages')
+parser.add_argument('--stub-models', action='store_true', help='use the offline models from stub_models.py')
+parser.add_argument('--pdf', default=None, help='benchmark this PDF instead of a generated one')
+parser.add_argument('--output', default=None, help='defaults to testing/bench_results/<commit>.json')
+parser.add_argument('--compare', default=None, help='earlier result file to compare against')
+args = parser.parse_args()
+
+import stub_models
+from pubchem_stub import start_stub, COMPOUNDS
+
+names = stub_models.chemical_names(args.names)
+stub = start_stub(COMPOUNDS + stub_models.stub_compounds(names))
+os.environ['CHEMEXTRACT_PUBCHEM_URL'] = stub.url
+os.environ['CHEMEXTRACT_PUBCHEM_DB'] = ':memory:'
+
+import pubchem
+import pdfextract
+from extraction_cache import ExtractionCache
+from pdfextract import StructureExtractor, TextExtractor, OccurrenceIndex, combine_results, highlightPDF, highlightPDFImage, model_registry
+
+pubchem.rate_limiter = pubchem.TokenBucket(1000, 1000)
+if args.stub_models:
+    stub_models.install(model_registry, names)
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def cold_cache(root):
+    shutil.rmtree(os.path.join(root, 'cache'), ignore_errors=True)
+    pdfextract.extraction_cache = ExtractionCache(os.path.join(root, 'cache'))
+
+
+def fresh_output(root):
+    output = os.path.join(root, 'out')
+    shutil.rmtree(output, ignore_errors=True)
+    os.makedirs(output)
+    return output
+
+
+class Bench:
+    # Each stage is (setup, run): setup prepares fresh inputs outside the timed region and
+    # returns them, run(inputs) is timed and returns the number of items it processed
+    def __init__(self, root, pdf):
+        self.root = root
+        self.pdf = pdf
+        self.stages = {}
+        self.failed = []
+
+    def stage(self, name):
+        # Decorates a function returning (setup, run); it is called once, at registration
+        def register(fn):
+            self.stages[name] = fn()
+            return fn
+        return register
+
+    def run(self, selected, repeat):
+        results = {}
+        for name, (setup, run) in self.stages.items():
+            if selected and name not in selected:
+                continue
+            seconds = []
+            items = 0
+            try:
+                for _ in range(repeat):
+                    inputs = setup()
+                    start = time.perf_counter()
+                    items = run(inputs)
+                    seconds.append(time.perf_counter() - start)
+            except Exception as e:
+                print(f"{name:>12}: failed: {e!r}")
+                results[name] = {'error': repr(e)}
+                self.failed.append(name)
+                continue
+            median = statistics.median(seconds)
+            results[name] = {
+                'seconds': seconds,
+                'median_seconds': median,
+                'min_seconds': min(seconds),
+                'items': items,
+                'items_per_second': items / median if median else None,
+            }
+            print(f"{name:>12}: median {median:8.4f}s, min {min(seconds):8.4f}s, {items} items")
+        return results
+
+
+with tempfile.TemporaryDirectory() as root:
+    pdf = args.pdf or stub_models.make_pdf(os.path.join(root, 'file_0.pdf'), args.pages, args.structures, args.keyword_density, names)
+    bench = Bench(root, pdf)
+    model_registry.warm()
+
+    def structure_extractor():
+        cold_cache(root)
+        return StructureExtractor(pdf, fresh_output(root), dpi=args.dpi, crop_dpi=args.crop_dpi)
+
+    def text_extractor():
+        cold_cache(root)
+        extractor = TextExtractor(pdf, fresh_output(root))
+        extractor.extract()
+        return extractor
+
+    @bench.stage('render')
+    def render():
+        return structure_extractor, lambda extractor: len(extractor.PDFtoPNG())
+
+    def rendered():
+        extractor = structure_extractor()
+        extractor.PDFtoPNG()
+        return extractor
+
+    def segmented(extractor):
+        # segment() prints its error and returns None instead of raising
+        segments = asyncio.run(extractor.segment())
+        if segments is None:
+            raise RuntimeError('segmentation failed, see the error printed above')
+        return segments
+
+    @bench.stage('segment')
+    def segment():
+        return rendered, lambda extractor: len(segmented(extractor))
+
+    segments = rendered()
+    segmented(segments)
+    images = [segment[0] for segment in segments.segments]
+
+    @bench.stage('recognize')
+    def recognize():
+        return lambda: segments, lambda extractor: len(extractor.recognize(images))
+
+    @bench.stage('recognize_unique')
+    def recognize_unique():
+        return lambda: segments, lambda extractor: len(extractor.recognize_unique(images))
+
+    @bench.stage('ner')
+    def ner():
+        return text_extractor, lambda extractor: len(extractor.engine.predict(extractor.total_text))
+
+    keywords = text_extractor()
+    spans = keywords.engine.predict(keywords.total_text)
+    found = [keywords.total_text[start:end].strip() for start, end in spans]
+
+    @bench.stage('occurrences')
+    def occurrences():
+        def run(extractor):
+            index = OccurrenceIndex(found, extractor.total_text, extractor.page_offsets())
+            return sum(len(index.spans(keyword)) for keyword in set(found))
+        return lambda: keywords, run
+
+    @bench.stage('resolve')
+    def resolve():
+        # Fresh resolution cache each run so every name goes to the stub
+        def setup():
+            return list(dict.fromkeys(pubchem.normalize_identifier('name', keyword) for keyword in found))
+
+        def run(identifiers):
+            async def lookup():
+                cache = pubchem.ResolutionCache(':memory:')
+                async with pubchem.PubChemClient(cache=cache) as client:
+                    return await client.resolve_many(identifiers, 'name')
+            return len(asyncio.run(lookup()))
+        return setup, run
+
+    @bench.stage('combine')
+    def combine():
+        def setup():
+            rng = random.Random(0)
+            pdf_results = [[{'SMILES': rng.choice(stub_models.SMILES_POOL), 'cid': rng.randrange(1000), 'page': rng.randrange(args.pages), 'keyword': None,
+                             'X': 1.0, 'Y': 2.0, 'Height': 3.0, 'Width': 4.0, 'article': 'file_0', 'image': f'segments/file_0_{i}.png'}
+                            for i in range(len(images) * 50)]]
+            text_results = [[{'keyword': rng.choice(names), 'SMILES': rng.choice(stub_models.SMILES_POOL + names), 'cid': rng.randrange(1000),
+                              'page': rng.randrange(args.pages), 'index': [[i, i + 8]]} for i in range(len(found) * 50)]]
+            return pdf_results, text_results
+
+        def run(results):
+            return len(combine_results(results[0], results[1], ['out/file_0'], ['out/file_0'], 'out'))
+        return setup, run
+
+    @bench.stage('highlight')
+    def highlight():
+        # One click per distinct keyword against a folder whose word index is already built
+        folder = os.path.join(root, 'highlight')
+        os.makedirs(folder, exist_ok=True)
+        shutil.copyfile(pdf, os.path.join(folder, 'file_0.pdf'))
+        highlightPDF(folder, names[0], os.path.join(folder, 'file_0'))
+        distinct = list(dict.fromkeys(found))[:20] or names[:20]
+
+        def run(_):
+            for keyword in distinct:
+                highlightPDF(folder, keyword, os.path.join(folder, 'file_0'))
+            return len(distinct)
+        return lambda: None, run
+
+    @bench.stage('highlight_image')
+    def highlight_image():
+        folder = os.path.join(root, 'highlight')
+
+        def run(_):
+            for page in range(min(20, args.pages)):
+                highlightPDFImage(folder, 72, 400, 100, 100, page, os.path.join(folder, 'file_0'))
+            return min(20, args.pages)
+        return lambda: None, run
+
+    stages = bench.run(args.stages, args.repeat)
+
+result = {
+    'commit': commit(),
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'cpus': os.cpu_count(),
+    'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+    'stages': stages,
+}
+
+output = args.output or os.path.join(os.path.dirname(__file__), 'bench_results', f"{result['commit']}.json")
+os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+with open(output, 'w') as f:
+    json.dump(result, f, indent=2)
+print(f"results written to {output}")
+
+if args.compare:
+    with open(args.compare, 'r') as f:
+        previous = json.load(f)
+    if previous['config'] != result['config']:
+        print("warning: the two runs used different settings")
+    print(f"compared with {previous['commit']} (new / old median):")
+    for name, stats in stages.items():
+        if 'error' not in stats and 'median_seconds' in previous['stages'].get(name, {}):
+            ratio = stats['median_seconds'] / previous['stages'][name]['median_seconds']
+            flag = '  <-- slower' if ratio > 1.2 else ''
+            print(f"{name:>12}: {ratio:5.2f}x{flag}")
+
+if bench.failed:
+    print(f"failed stages: {', '.join(bench.failed)}")
+    sys.exit(1)
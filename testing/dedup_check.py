@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Checks the near-duplicate matching recognize_unique relies on. A page of drawings (a ring
+# with one labelled substituent) is rendered at each --dpi: copies of the same drawing,
+# drawn at sub-pixel offsets, must share one SegmentIndex entry, and drawings that differ
+# in a single label (OH against NH) must never merge. recognize_unique must then recognize
+# each distinct drawing once, exact repeats included, and the StructureStore must find the
+# copies and nothing else. Finally the sequential and pipelined BatchExtractor paths must
+# give the same results on stub PDFs with dedup on. Exits with status 1 on any failure.
+# Usage: python testing/dedup_check.py --dpi 200 300
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dpi', type=int, nargs='+', default=[200, 300], help='render resolutions; below about 200 copies stop matching reliably')
+parser.add_argument('--copies', type=int, default=8, help='copies of the repeated drawing')
+parser.add_argument('--pages', type=int, default=4, help='pages of each stub PDF in the parity check')
+args = parser.parse_args()
+
+import fitz
+import numpy as np
+import stub_models
+from pubchem_stub import start_stub, COMPOUNDS
+
+names = stub_models.chemical_names(30)
+stub = start_stub(COMPOUNDS + stub_models.stub_compounds(names))
+os.environ['CHEMEXTRACT_PUBCHEM_URL'] = stub.url
+os.environ['CHEMEXTRACT_PUBCHEM_DB'] = ':memory:'
+
+import pubchem
+import pdfextract
+from extraction_cache import ExtractionCache
+from structure_store import SegmentIndex, StructureStore, segment_signature, distance
+from pdfextract import BatchExtractor, StructureExtractor, model_registry
+
+pubchem.rate_limiter = pubchem.TokenBucket(1000, 1000)
+stub_models.install(model_registry, names)
+failures = []
+
+
+def check(condition, message):
+    print(f"{'ok' if condition else 'FAIL'}: {message}")
+    if not condition:
+        failures.append(message)
+
+
+def drawings(labels):
+    # One ring per label, each shifted by a different fraction of a point
+    doc = fitz.open()
+    page = doc.new_page()
+    rects = []
+    for k, label in enumerate(labels):
+        cx = 80 + (k % 6) * 80 + k * 0.137
+        cy = 150 + (k // 6) * 90 + k * 0.291
+        points = [fitz.Point(cx + 22 * np.cos(a), cy + 22 * np.sin(a)) for a in np.linspace(0, 2 * np.pi, 7)]
+        page.draw_polyline(points, color=(0, 0, 0), width=1.2)
+        page.draw_line(fitz.Point(cx + 22, cy), fitz.Point(cx + 34, cy - 7), color=(0, 0, 0), width=1.2)
+        page.insert_text((cx + 34, cy - 4), label, fontsize=8)
+        rects.append(fitz.Rect(cx - 26, cy - 26, cx + 50, cy + 26))
+    return doc, page, rects
+
+
+def crops(page, rects, dpi):
+    images = []
+    for rect in rects:
+        pix = page.get_pixmap(dpi=dpi, clip=rect)
+        images.append(np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, pix.n).copy())
+    return images
+
+
+others = ['NH', 'OMe', 'Cl', 'Br', 'F', 'SH', 'CN', 'O']
+labels = ['OH'] * args.copies + others
+doc, page, rects = drawings(labels)
+
+with tempfile.TemporaryDirectory() as root:
+    pdf = stub_models.make_pdf(os.path.join(root, 'file_0.pdf'), 1, 1, 0.05, names)
+    pdfextract.extraction_cache = ExtractionCache(os.path.join(root, 'cache'))
+
+    for dpi in args.dpi:
+        images = crops(page, rects, dpi)
+        signatures = [segment_signature(image) for image in images]
+        index = SegmentIndex()
+        entries = []
+        for signature in signatures:
+            entries.append(index.find(signature) or index.add(signature))
+        copies, rest = entries[:args.copies], entries[args.copies:]
+        check(all(entry is copies[0] for entry in copies), f"{dpi} dpi: {args.copies} copies of OH share one entry")
+        check(len({id(entry) for entry in rest}) == len(others) and all(entry is not copies[0] for entry in rest),
+              f"{dpi} dpi: each other label is its own drawing")
+        check(index.find(signatures[labels.index('NH')]) is not copies[0] and distance(signatures[0].thumbnail, signatures[labels.index('NH')].thumbnail) > 16,
+              f"{dpi} dpi: OH and NH stay apart")
+
+        # Exact repeats on top of the near-duplicates; MolScribe must run once per drawing
+        extractor = StructureExtractor(pdf, os.path.join(root, 'out'), dedup=True)
+        recognized = []
+        recognize = extractor.recognize
+        extractor.recognize = lambda batch: recognized.extend(batch) or recognize(batch)
+        repeated = images + images[:3]
+        smiles = extractor.recognize_unique(repeated)
+        check(len(recognized) == 1 + len(others), f"{dpi} dpi: {len(repeated)} crops recognized as {len(recognized)}, expected {1 + len(others)}")
+        check(len(set(smiles[:args.copies])) == 1 and smiles[-3:] == smiles[:3], f"{dpi} dpi: copies and repeats get the same SMILES")
+
+        store = StructureStore(':memory:')
+        store.put(signatures[0], 'Oc1ccccc1', 'check')
+        found = [store.get(signature, 'check')[0] for signature in signatures]
+        check(all(found[:args.copies]) and not any(found[args.copies:]), f"{dpi} dpi: the structure store finds the copies and nothing else")
+        check(not store.get(signatures[0], 'other')[0], f"{dpi} dpi: the structure store keeps versions apart")
+
+    # Both BatchExtractor paths keep one memo per document, so their results must agree
+    os.makedirs(os.path.join(root, 'in'))
+    for f in range(2):
+        stub_models.make_pdf(os.path.join(root, 'in', f'file_{f}.pdf'), args.pages, 4, 0.05, names, seed=f)
+    results = {}
+    for pipelined in (False, True):
+        pdfextract.extraction_cache = ExtractionCache(os.path.join(root, f'cache_{pipelined}'))
+        output = os.path.join(root, f'out_{pipelined}')
+        shutil.rmtree(output, ignore_errors=True)
+        os.makedirs(output)
+        extractor = BatchExtractor(os.path.join(root, 'in'), output, pipelined=pipelined)
+        results[pipelined] = json.loads(json.dumps(asyncio.run(extractor.toSMILES())['PDF_SMILES']))
+    check(results[False] == results[True], f"sequential and pipelined give the same {sum(len(r) for r in results[False])} structure results")
+
+if failures:
+    print(f"{len(failures)} check(s) failed")
+    sys.exit(1)
+print("all checks passed")
@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+# Accuracy and throughput of the NER backends against the eager model. Every backend tags
+# the text of each reference PDF; keywords (the strings TextExtractor would keep) are
+# compared with the eager model's, along with per-token label agreement, and the median
+# time per document gives tokens per second. Exits with status 1 if any backend's keyword
+# F1 against eager falls below --min-f1.
+# Usage: python testing/ner_parity.py testing/research.pdf testing/downloaded.pdf --backends int8 onnx
+
+parser = argparse.ArgumentParser()
+parser.add_argument('pdfs', nargs='*', default=[os.path.join(os.path.dirname(__file__), name) for name in ('research.pdf', 'downloaded.pdf')])
+parser.add_argument('--backends', nargs='+', default=['int8', 'onnx'])
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--threads', type=int, default=None)
+parser.add_argument('--min-f1', type=float, default=0.99)
+parser.add_argument('--stub-models', action='store_true', help='use the offline NER model from stub_models.py')
+parser.add_argument('--output', default=None, help='write the results as JSON')
+args = parser.parse_args()
+
+os.environ['CHEMEXTRACT_NER_BACKEND'] = 'eager'
+
+import torch
+import ner_backend
+from pdfextract import NEREngine, TextExtractor, model_registry, ner_onnx_path
+
+if args.threads:
+    torch.set_num_threads(args.threads)
+if args.stub_models:
+    import tempfile
+    import stub_models
+    stub_models.install(model_registry)
+    # Keep the stub's export away from the real model's
+    os.environ['CHEMEXTRACT_ONNX_DIR'] = tempfile.mkdtemp(prefix='ner_onnx_')
+
+tokenizer, eager = model_registry.ner()
+models = {'eager': eager}
+for backend in args.backends:
+    # Converted directly rather than through with_ner_backend, which falls back to eager on
+    # failure and would have eager scored against itself
+    start = time.perf_counter()
+    models[backend] = ner_backend.convert(eager, backend, ner_onnx_path(), threads=args.threads)
+    assert ner_backend.backend_name(models[backend]) == backend, f"{backend} conversion gave {ner_backend.backend_name(models[backend])}"
+    print(f"{backend}: prepared in {time.perf_counter() - start:.1f}s")
+
+
+def keywords(text, spans):
+    # As in TextExtractor.getKeywords
+    return [text[start:end].strip() for start, end in spans if len(text[start:end].strip()) > 3]
+
+
+def f1(found, expected):
+    found, expected = set(found), set(expected)
+    if not found and not expected:
+        return 1.0, 1.0, 1.0
+    true = len(found & expected)
+    precision = true / len(found) if found else 0.0
+    recall = true / len(expected) if expected else 0.0
+    return precision, recall, 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+documents = []
+for pdf in args.pdfs:
+    extractor = TextExtractor(pdf)
+    extractor.extract()
+    text = extractor.total_text
+    documents.append((pdf, text, tokenizer(text, add_special_tokens=False)['input_ids']))
+
+results = {}
+reference = {}
+for backend, model in models.items():
+    engine = NEREngine(tokenizer, model)
+    per_document = []
+    for pdf, text, input_ids in documents:
+        seconds = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            spans = engine.predict(text)
+            seconds.append(time.perf_counter() - start)
+        labels = engine.predict_labels(input_ids)
+        found = keywords(text, spans)
+        if backend == 'eager':
+            reference[pdf] = (found, labels)
+        expected, expected_labels = reference[pdf]
+        precision, recall, score = f1(found, expected)
+        per_document.append({
+            'pdf': pdf,
+            'tokens': len(input_ids),
+            'median_seconds': statistics.median(seconds),
+            'keywords': len(set(found)),
+            'precision': precision,
+            'recall': recall,
+            'f1': score,
+            'token_agreement': sum(a == b for a, b in zip(labels, expected_labels)) / max(len(labels), 1),
+            'missing': sorted(set(expected) - set(found))[:20],
+            'extra': sorted(set(found) - set(expected))[:20],
+        })
+    tokens = sum(document['tokens'] for document in per_document)
+    seconds = sum(document['median_seconds'] for document in per_document)
+    results[backend] = {
+        'tokens_per_second': tokens / seconds if seconds else None,
+        'seconds': seconds,
+        'f1': min(document['f1'] for document in per_document),
+        'token_agreement': min(document['token_agreement'] for document in per_document),
+        'documents': per_document,
+    }
+
+eager_seconds = results['eager']['seconds']
+print(f"{'backend':>8} {'tokens/s':>10} {'speedup':>8} {'min F1':>7} {'min token agreement':>20}")
+for backend, result in results.items():
+    print(f"{backend:>8} {result['tokens_per_second']:>10.0f} {eager_seconds / result['seconds']:>7.2f}x {result['f1']:>7.4f} {result['token_agreement']:>20.4f}")
+    for document in result['documents']:
+        if document['missing'] or document['extra']:
+            print(f"         {os.path.basename(document['pdf'])}: missing {document['missing']}, extra {document['extra']}")
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump({'threads': torch.get_num_threads(), 'backends': results}, f, indent=2)
+
+failed = [backend for backend, result in results.items() if result['f1'] < args.min_f1]
+if failed:
+    print(f"below --min-f1 {args.min_f1}: {', '.join(failed)}")
+    sys.exit(1)
@@ -0,0 +1,121 @@
+import json
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Minimal stand-in for the PUG REST endpoints used by pubchem.PubChemClient:
+#   POST /rest/pug/compound/{name,smiles}/cids/JSON
+#   POST /rest/pug/compound/cid/property/<names>/JSON
+# Point the client at it with PubChemClient(base_url=url) or CHEMEXTRACT_PUBCHEM_URL.
+
+COMPOUNDS = [
+    {'CID': 702, 'names': ['ethanol'], 'SMILES': 'CCO', 'IUPACName': 'ethanol', 'MolecularFormula': 'C2H6O', 'MolecularWeight': '46.07'},
+    {'CID': 241, 'names': ['benzene'], 'SMILES': 'C1=CC=CC=C1', 'IUPACName': 'benzene', 'MolecularFormula': 'C6H6', 'MolecularWeight': '78.11'},
+    {'CID': 1140, 'names': ['toluene'], 'SMILES': 'CC1=CC=CC=C1', 'IUPACName': 'toluene', 'MolecularFormula': 'C7H8', 'MolecularWeight': '92.14'},
+    {'CID': 962, 'names': ['water'], 'SMILES': 'O', 'IUPACName': 'oxidane', 'MolecularFormula': 'H2O', 'MolecularWeight': '18.015'},
+]
+
+
+def synthetic_compounds(count, start_cid=100000):
+    return [
+        {'CID': start_cid + i, 'names': [f'compound-{i}'], 'SMILES': 'C' * (i % 20 + 1) + f'O{i}',
+         'IUPACName': f'compound-{i}', 'MolecularFormula': 'C', 'MolecularWeight': '12.01'}
+        for i in range(count)
+    ]
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, compounds=None, busy_rate=0.0, latency=0.0):
+        super().__init__(address, StubHandler)
+        compounds = compounds or COMPOUNDS
+        self.by_cid = {c['CID']: c for c in compounds}
+        self.by_name = {name.lower(): c['CID'] for c in compounds for name in c['names']}
+        self.by_smiles = {c['SMILES']: c['CID'] for c in compounds}
+        self.busy_rate = busy_rate
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/rest/pug'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            threading.Event().wait(server.latency)
+        if random.random() < server.busy_rate:
+            return self.reply(503, {'Fault': {'Code': 'PUGREST.ServerBusy'}}, {'Retry-After': '0'})
+
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        parts = unquote(self.path).split('/')[3:]
+
+        if parts[:1] == ['compound'] and parts[2:3] == ['cids']:
+            namespace = parts[1]
+            identifier = form.get(namespace, [''])[0]
+            if namespace == 'name':
+                cid = server.by_name.get(identifier.strip().lower())
+            elif namespace == 'smiles':
+                cid = server.by_smiles.get(identifier, 0)
+            else:
+                return self.reply(400, {'Fault': {'Code': 'PUGREST.BadRequest'}})
+            if cid is None:
+                return self.reply(404, {'Fault': {'Code': 'PUGREST.NotFound'}})
+            return self.reply(200, {'IdentifierList': {'CID': [cid]}})
+
+        if parts[:3] == ['compound', 'cid', 'property']:
+            names = parts[3].split(',')
+            rows = []
+            for cid in form.get('cid', [''])[0].split(','):
+                compound = server.by_cid.get(int(cid)) if cid.isdigit() else None
+                if compound is not None:
+                    row = {'CID': compound['CID']}
+                    row.update({name: compound[name] for name in names if name in compound})
+                    if 'CanonicalSMILES' in names:
+                        row['ConnectivitySMILES'] = compound['SMILES']
+                    rows.append(row)
+            if not rows:
+                return self.reply(404, {'Fault': {'Code': 'PUGREST.NotFound'}})
+            return self.reply(200, {'PropertyTable': {'Properties': rows}})
+
+        self.reply(400, {'Fault': {'Code': 'PUGREST.BadRequest'}})
+
+
+def start_stub(compounds=None, busy_rate=0.0, latency=0.0, port=0):
+    server = StubServer(('127.0.0.1', port), compounds, busy_rate, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--synthetic', type=int, default=0, help='extra compound-<i> records to serve')
+    parser.add_argument('--busy-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = StubServer(('127.0.0.1', args.port), COMPOUNDS + synthetic_compounds(args.synthetic), args.busy_rate, args.latency)
+    print(f'PubChem stub listening on {server.url}')
+    server.serve_forever()
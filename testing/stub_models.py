@@ -0,0 +1,153 @@
+import os
+import zlib
+import tempfile
+
+import cv2
+import fitz
+import numpy as np
+import torch
+
+# Offline stand-ins for the three models in pdfextract.model_registry, plus a generator
+# for synthetic PDFs they understand. Structures are drawn as blue hexagons, which
+# StubDetector finds by colour; chemical names are whole words that StubNER tags.
+# install() swaps the registry loaders and pdfextract.apply_masks, so neither
+# decimer_segmentation nor a download is needed.
+
+FILLER = ('the of and was with in to a for by were from on at reaction mixture solution stirred '
+          'heated cooled filtered washed dried yield product compound added dropwise under '
+          'nitrogen temperature hours minutes room column chromatography purified obtained').split()
+
+SMILES_POOL = ['CCO', 'C1=CC=CC=C1', 'CC1=CC=CC=C1', 'O', 'CC(=O)O', 'CCN(CC)CC', 'C1CCCCC1', 'CC(C)O']
+
+
+def chemical_names(count):
+    # Single-word names (chemba, chembb, ...) so the tokenizer keeps them whole
+    names = []
+    for i in range(count):
+        suffix = ''
+        n = i + 26
+        while n:
+            n, r = divmod(n, 26)
+            suffix = chr(ord('a') + r) + suffix
+        names.append('chem' + suffix)
+    return names
+
+
+def stub_compounds(names, start_cid=500000):
+    return [
+        {'CID': start_cid + i, 'names': [name], 'SMILES': SMILES_POOL[i % len(SMILES_POOL)] + f'.[Na+]{i}',
+         'IUPACName': name, 'MolecularFormula': 'C', 'MolecularWeight': '12.01'}
+        for i, name in enumerate(names)
+    ]
+
+
+def make_pdf(path, pages=10, structures=2, keyword_density=0.05, names=None, words_per_page=300, seed=0):
+    # keyword_density is the fraction of words on a page that are chemical names
+    rng = np.random.default_rng(seed)
+    names = names or chemical_names(50)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        words = [names[rng.integers(len(names))] if rng.random() < keyword_density else FILLER[rng.integers(len(FILLER))]
+                 for _ in range(words_per_page)]
+        text_box = fitz.Rect(54, 54, 558, 400)
+        page.insert_textbox(text_box, ' '.join(words) + '.', fontsize=9)
+        for k in range(structures):
+            cx = 110 + (k % 4) * 130
+            cy = 470 + (k // 4) * 120
+            radius = 30 + rng.integers(10)
+            points = [fitz.Point(cx + radius * np.cos(a), cy + radius * np.sin(a)) for a in np.linspace(0, 2 * np.pi, 7)]
+            page.draw_polyline(points, color=(0, 0, 1), width=2)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+class StubDetector:
+    # Mask R-CNN stand-in: one mask per connected blob of blue pixels
+    def detect(self, images, verbose=0):
+        results = []
+        for img in images:
+            blue = (img[:, :, 2] > 150) & (img[:, :, 0] < 100) & (img[:, :, 1] < 100)
+            blue = cv2.dilate(blue.astype(np.uint8), np.ones((15, 15), np.uint8))
+            count, labels = cv2.connectedComponents(blue)
+            masks = np.stack([labels == i for i in range(1, count)], axis=-1) if count > 1 else np.zeros(img.shape[:2] + (0,), bool)
+            results.append({'masks': masks, 'rois': None, 'class_ids': None, 'scores': None})
+        return results
+
+
+def stub_apply_masks(img, masks):
+    # decimer_segmentation.apply_masks stand-in: each mask's bounding box, white outside the
+    # mask, with the (y0, x0, y1, x1) box
+    segments, boxes = [], []
+    for i in range(masks.shape[-1]):
+        ys, xs = np.where(masks[:, :, i])
+        y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        segment = np.full((y1 - y0, x1 - x0, 3), 255, np.uint8)
+        inside = masks[y0:y1, x0:x1, i]
+        segment[inside] = img[y0:y1, x0:x1, :3][inside]
+        segments.append(segment)
+        boxes.append((y0, x0, y1, x1))
+    return segments, boxes
+
+
+class StubMolScribe:
+    # Deterministic SMILES from the image contents
+    def predict_image(self, image):
+        return self.predict_images([image])[0]
+
+    def predict_images(self, images, batch_size=16):
+        predictions = []
+        for image in images:
+            checksum = zlib.crc32(np.ascontiguousarray(image).tobytes())
+            predictions.append({'smiles': SMILES_POOL[checksum % len(SMILES_POOL)]})
+        return predictions
+
+
+class _Config:
+    id2label = {0: 'O', 1: 'B-Chemical', 2: 'I-Chemical'}
+
+
+class StubNER(torch.nn.Module):
+    # Tags every token in chemical_ids as B-Chemical; logits are built with tensor ops so
+    # the cost still scales with window count and length like the real model
+    config = _Config
+
+    def __init__(self, chemical_ids):
+        super().__init__()
+        self.chemical_ids = torch.tensor(sorted(chemical_ids), dtype=torch.long)
+
+    def forward(self, ids, attention_mask=None):
+        # Not torch.isin, which the ONNX exporter does not support
+        chemical = (ids.unsqueeze(-1) == self.chemical_ids).any(-1)
+        logits = torch.zeros(ids.shape + (3,))
+        logits[..., 0] = (~chemical).float()
+        logits[..., 1] = chemical.float()
+
+        class Output:
+            pass
+        output = Output()
+        output.logits = logits
+        return output
+
+
+def stub_ner(names):
+    from transformers import BertTokenizerFast
+    vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + list('.,;:-()') + FILLER + list(names)
+    vocab_file = os.path.join(tempfile.mkdtemp(prefix='stub_ner_'), 'vocab.txt')
+    with open(vocab_file, 'w') as f:
+        f.write('\n'.join(dict.fromkeys(vocab)) + '\n')
+    tokenizer = BertTokenizerFast(vocab_file)
+    return tokenizer, StubNER(tokenizer.convert_tokens_to_ids(list(names)))
+
+
+def install(model_registry, names=None):
+    import pdfextract
+    names = names or chemical_names(50)
+    pdfextract.apply_masks = stub_apply_masks
+    model_registry.loaders = {
+        'molscribe': StubMolScribe,
+        'mrcnn': StubDetector,
+        'ner': lambda: stub_ner(names),
+    }
+    return names
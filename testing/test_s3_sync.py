@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import tempfile
+import boto3
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from s3sync import S3Sync
+
+# Checks the incremental S3 sync against moto's in-memory S3: the first sync uploads
+# everything, an unchanged folder uploads nothing, and only edited or new files go up
+# afterwards. Usage: python testing/test_s3_sync.py
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+bucket_name = 'chemextract'
+
+with mock_aws(), tempfile.TemporaryDirectory() as root:
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=bucket_name)
+    sync = S3Sync(bucket_name, client=s3, multipart_threshold=5 * 1024 ** 2, multipart_chunksize=5 * 1024 ** 2)
+
+    folder = os.path.join(root, 'temp_files_test')
+    os.makedirs(os.path.join(folder, 'segments'))
+    for i in range(20):
+        with open(os.path.join(folder, 'segments', f'file_0_{i}.png'), 'wb') as f:
+            f.write(os.urandom(1024))
+    with open(os.path.join(folder, 'file_0.pdf'), 'wb') as f:
+        f.write(os.urandom(12 * 1024 ** 2))
+
+    stats = sync.sync(folder, 'temp_files_test')
+    print('first sync:', stats)
+    assert stats['uploaded'] == 21 and stats['skipped'] == 0
+
+    keys = {obj['Key'] for obj in s3.list_objects_v2(Bucket=bucket_name)['Contents']}
+    assert 'temp_files_test/file_0.pdf' in keys and 'temp_files_test/segments/file_0_3.png' in keys
+    assert not any(key.endswith('.s3manifest.json') for key in keys)
+    # 12 MiB with a 5 MiB threshold goes up as a multipart upload
+    assert '-' in s3.head_object(Bucket=bucket_name, Key='temp_files_test/file_0.pdf')['ETag']
+
+    stats = sync.sync(folder, 'temp_files_test')
+    print('unchanged:', stats)
+    assert stats['uploaded'] == 0 and stats['skipped'] == 21
+
+    # Touched but identical content is not re-uploaded
+    os.utime(os.path.join(folder, 'segments', 'file_0_1.png'), (time.time() + 5, time.time() + 5))
+    with open(os.path.join(folder, 'segments', 'file_0_2.png'), 'wb') as f:
+        f.write(b'changed')
+    with open(os.path.join(folder, 'smiles_data.json'), 'w') as f:
+        f.write('[]')
+
+    stats = sync.sync_in_background(folder, 'temp_files_test').result()
+    print('after edits:', stats)
+    assert stats['uploaded'] == 2 and stats['skipped'] == 20
+    body = s3.get_object(Bucket=bucket_name, Key='temp_files_test/segments/file_0_2.png')['Body'].read()
+    assert body == b'changed'
+
+print('ok')
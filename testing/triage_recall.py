@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from pdfextract import StructureExtractor, model_registry
+from triage import PageTriage
+
+# Checks page triage against detection on every page: how many detection calls it saves,
+# and whether any page it skips has segments when detected anyway (lost recall).
+# Usage: python testing/triage_recall.py testing/research.pdf testing/downloaded.pdf [--thumbnails]
+#        python testing/triage_recall.py --stub-models --pages 20 --structures 1
+
+parser = argparse.ArgumentParser()
+parser.add_argument('pdfs', nargs='*')
+parser.add_argument('--thumbnails', action='store_true', help='enable the thumbnail check')
+parser.add_argument('--stub-models', action='store_true', help='use the offline models from stub_models.py')
+parser.add_argument('--pages', type=int, default=20, help='pages of the generated PDF used with --stub-models')
+parser.add_argument('--structures', type=int, default=1, help='structures on every other generated page')
+args = parser.parse_args()
+
+if args.stub_models:
+    import stub_models
+    stub_models.install(model_registry)
+
+root = tempfile.mkdtemp(prefix='triage_')
+pdfs = list(args.pdfs)
+if not pdfs:
+    if not args.stub_models:
+        sys.exit('give PDFs to check, or --stub-models to generate one')
+    import fitz
+    # Alternate pages with and without structures
+    with_structures = stub_models.make_pdf(os.path.join(root, 'structures.pdf'), args.pages // 2 + args.pages % 2, args.structures)
+    without = stub_models.make_pdf(os.path.join(root, 'text.pdf'), args.pages // 2, 0)
+    doc, a, b = fitz.open(), fitz.open(with_structures), fitz.open(without)
+    for page in range(args.pages):
+        doc.insert_pdf(a if page % 2 == 0 else b, from_page=page // 2, to_page=page // 2)
+    pdfs = [os.path.join(root, 'mixed.pdf')]
+    doc.save(pdfs[0])
+
+triage = PageTriage(thumbnails=args.thumbnails)
+total_pages = total_detect = lost = 0
+for pdf in pdfs:
+    start = time.perf_counter()
+    decisions = triage.pages(pdf)
+    triage_seconds = time.perf_counter() - start
+
+    # Detection on every page, triage disabled
+    extractor = StructureExtractor(pdf, tempfile.mkdtemp(dir=root), triage=False)
+    found = {}
+    start = time.perf_counter()
+    for page, img in extractor.pages():
+        found[page] = len(extractor.detect(img, page))
+    detect_seconds = time.perf_counter() - start
+
+    detect = sum(decision['detect'] for decision in decisions)
+    print(f"{pdf}: detect {detect} of {len(decisions)} pages, triage {triage_seconds:.3f}s vs {detect_seconds:.2f}s rendering and detecting all pages")
+    for decision in decisions:
+        segments = found[decision['page']]
+        missed = not decision['detect'] and segments
+        lost += bool(missed)
+        flag = '  <-- MISSED' if missed else ''
+        print(f"  page {decision['page']:>3}: {'detect' if decision['detect'] else 'skip  '} {segments:>2} segments  {decision['reason']}{flag}")
+    total_pages += len(decisions)
+    total_detect += detect
+
+print(f"detection calls: {total_detect} of {total_pages} pages ({1 - total_detect / max(total_pages, 1):.0%} fewer), "
+      f"pages with segments skipped: {lost}")